@@ -0,0 +1,238 @@
+"""
+File containing the admission control sitting in front of the EventHandler
+Events are checked before any User is created: malformed commands are rejected
+right away, token buckets limit each user and the bot as a whole, and admitted
+events wait in a bounded queue. Events over the limits are deferred, left received
+and unread, and offered again on the next ticks; only the events beyond the
+deferred limits are dropped, with a reply telling that nothing was sent
+"""
+
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from time import monotonic
+from typing import Deque, Dict, List, Union
+
+from praw.models.reddit.comment import Comment
+from praw.models.reddit.message import Message
+
+from logs import logger
+from utils import COMMENT_COMMANDS, MESSAGE_COMMANDS
+
+USER_RATE = 0.2 # Events per second per user
+USER_BURST = 3
+GLOBAL_RATE = 5.0 # Events per second for all users
+GLOBAL_BURST = 20
+QUEUE_SIZE = 100
+DEFERRED_SIZE = 500 # Events over the limits kept to be offered again
+DEFERRED_PER_USER = 5
+EVENTS_PER_TICK = 10
+SLOW_DOWN_INTERVAL = 300 # Seconds between two "slow down" replies to the same user
+STATS_INTERVAL = 600 # Seconds between two logs of the counters
+
+# Possible outcomes of AdmissionController.offer
+QUEUED, DUPLICATE, INVALID, DEFERRED, DROPPED = "queued", "duplicate", "invalid", "deferred", "dropped"
+# Reasons for not queuing a valid event
+LIMITED, SHED = "limited", "shed"
+
+@dataclass
+class TokenBucket:
+    """
+    Class representing a token bucket, refilled continuously at rate
+    tokens per second up to capacity
+    """
+    rate: float
+    capacity: float
+    tokens: float = None
+    updated: float = field(default_factory=monotonic)
+
+    def __post_init__(self) -> None:
+        if self.tokens is None:
+            self.tokens = self.capacity
+
+    def refill(self) -> None:
+        """
+        Adds the tokens earned since the last update
+        """
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, cost: float = 1) -> bool:
+        """
+        Takes cost tokens from the bucket if there are enough
+
+        Returns:
+            Boolean:
+                True if the tokens were taken
+                False otherwise
+        """
+        self.refill()
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+    @property
+    def full(self) -> bool:
+        """
+        Returns whether the bucket is full, in which case it can be dropped
+        """
+        self.refill()
+        return self.tokens >= self.capacity
+
+class AdmissionController: # pylint: disable=R0902
+    """
+    Class deciding which events get handled, and in which order
+    """
+    def __init__(self, user_rate: float = USER_RATE, user_burst: float = USER_BURST, # pylint: disable=R0913
+                 global_rate: float = GLOBAL_RATE, global_burst: float = GLOBAL_BURST,
+                 queue_size: int = QUEUE_SIZE) -> None:
+        self.user_rate, self.user_burst = user_rate, user_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.user_buckets: Dict[str, TokenBucket] = {}
+        self.queue: Deque[Union[Comment, Message]] = deque()
+        self.queue_size = queue_size
+        self.queued_ids = set()
+        self.deferred: Dict[str, Union[Comment, Message]] = {} # fullname: event, oldest first
+        self.deferred_users = Counter()
+        self.slowed_down: Dict[str, float] = {}
+        self.counters = Counter()
+        self.last_stats = monotonic()
+
+    @staticmethod
+    def valid(event: Union[Comment, Message]) -> bool:
+        """
+        Cheap check of the shape of the event, done before any User is created
+        """
+        if event.author is None or not event.body:
+            return False
+        words = event.body.split()
+        if not words:
+            return False
+        if isinstance(event, Comment):
+            return words[0].lower() in COMMENT_COMMANDS
+        return words[0].lower() in MESSAGE_COMMANDS
+
+    def offer(self, event: Union[Comment, Message]) -> str:
+        """
+        Decides whether the event is queued to be handled
+
+        Returns:
+            str: one of QUEUED, DUPLICATE (already queued or deferred), INVALID,
+                 DEFERRED (over the limits, offered again later) or DROPPED (over the deferred limits)
+        """
+        if event.id in self.queued_ids or event.fullname in self.deferred:
+            return DUPLICATE
+        if not self.valid(event):
+            return self.count(INVALID)
+
+        reason = self.admit(event)
+        if reason is None:
+            return self.count(QUEUED)
+        if reason == SHED:
+            self.count(SHED)
+        else:
+            self.count(LIMITED, reason)
+
+        name = event.author.name.lower()
+        if len(self.deferred) >= DEFERRED_SIZE or self.deferred_users[name] >= DEFERRED_PER_USER:
+            return self.count(DROPPED)
+        self.deferred[event.fullname] = event
+        self.deferred_users[name] += 1
+        return self.count(DEFERRED)
+
+    def admit(self, event: Union[Comment, Message]) -> str:
+        """
+        Queues a valid event if the queue has room and its user and the bot have tokens
+
+        Returns:
+            str: None if the event was queued, SHED if the queue is full,
+                 "user" or "global" for the bucket that ran out of tokens
+        """
+        if len(self.queue) >= self.queue_size:
+            return SHED
+        name = event.author.name.lower()
+        bucket = self.user_buckets.get(name)
+        if bucket is None:
+            bucket = self.user_buckets[name] = TokenBucket(self.user_rate, self.user_burst)
+        if not bucket.take():
+            return "user"
+        if not self.global_bucket.take():
+            bucket.tokens += 1 # Given back, the user wasn't the one over the limit
+            return "global"
+
+        self.queue.append(event)
+        self.queued_ids.add(event.id)
+        return None
+
+    def retry_deferred(self) -> None:
+        """
+        Offers the deferred events again, oldest first, until the bot runs out of tokens or queue room
+        """
+        for fullname, event in list(self.deferred.items()):
+            reason = self.admit(event)
+            if reason is None:
+                del self.deferred[fullname]
+                self.deferred_users[event.author.name.lower()] -= 1
+                self.count(QUEUED, "deferred")
+            elif reason != "user": # Nothing else can be admitted this tick
+                break
+        self.deferred_users += Counter() # Drops the users left with no deferred event
+
+    def should_reply(self, event: Union[Comment, Message]) -> bool:
+        """
+        Returns whether a reply should be sent for this rejected event
+        Only one reply is sent per user every SLOW_DOWN_INTERVAL seconds,
+        so that rejected events never cost a reddit call each
+        """
+        if event.author is None:
+            return False
+        name, now = event.author.name.lower(), monotonic()
+        if now - self.slowed_down.get(name, -SLOW_DOWN_INTERVAL) < SLOW_DOWN_INTERVAL:
+            return False
+        self.slowed_down[name] = now
+        self.counters["slow_down_replies"] += 1
+        return True
+
+    def next_events(self, count: int = EVENTS_PER_TICK) -> List[Union[Comment, Message]]:
+        """
+        Pops the next events to handle from the queue
+        """
+        events = []
+        while self.queue and len(events) < count:
+            event = self.queue.popleft()
+            self.queued_ids.discard(event.id)
+            events.append(event)
+        return events
+
+    def count(self, outcome: str, detail: str = None) -> str:
+        """
+        Increments the counter of an outcome and returns the outcome
+        """
+        self.counters[outcome] += 1
+        if detail:
+            self.counters[f"{outcome}_{detail}"] += 1
+        return outcome
+
+    def stats(self) -> dict:
+        """
+        Returns the counters, the queue depth and the number of tracked users
+        """
+        return dict(self.counters, queue_depth=len(self.queue), deferred_depth=len(self.deferred),
+                    tracked_users=len(self.user_buckets))
+
+    def log_stats(self) -> None:
+        """
+        Logs the counters every STATS_INTERVAL seconds,
+        and drops the state of the users that are back to full tokens
+        """
+        now = monotonic()
+        if now - self.last_stats < STATS_INTERVAL:
+            return
+        self.last_stats = now
+        for name in [name for name, bucket in self.user_buckets.items()
+                     if bucket.full and name not in self.deferred_users]:
+            del self.user_buckets[name]
+        self.slowed_down = {name: when for name, when in self.slowed_down.items()
+                            if now - when < SLOW_DOWN_INTERVAL}
+        logger.info("Admission control", **self.stats())
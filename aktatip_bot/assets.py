@@ -0,0 +1,101 @@
+"""
+File containing the registry of the assets the bot can send
+The metadata of each asset (unit name, decimals) is fetched from algod once,
+then kept in the database and in memory, so converting amounts never costs an algod call
+"""
+
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from clients import algod, db
+
+AKTA_ID = 10458941
+
+# Unit names accepted in the commands, and the id of the ASA they refer to
+# Any ASA can be added, its decimals and unit name are fetched from algod
+SUPPORTED_ASSETS = {
+    "AKTA": AKTA_ID,
+}
+DEFAULT_ASSET = "AKTA"
+
+@dataclass(frozen=True)
+class Asset:
+    """
+    Class representing an asset, Algos or an ASA
+    """
+    asset_id: int
+    unit_name: str
+    decimals: int
+    name: str
+
+    def to_units(self, amount: float) -> int:
+        """
+        Converts an amount to the base unit of the asset (microalgos for Algos)
+        """
+        return int(round(amount * 10 ** self.decimals))
+
+    def from_units(self, units: int) -> float:
+        """
+        Converts an amount in the base unit of the asset to a decimal amount
+        """
+        return units / 10 ** self.decimals
+
+    @property
+    def is_algo(self) -> bool: # pylint: disable=C0116
+        return self.asset_id == 0
+
+ALGO = Asset(0, "Algos", 6, "Algorand")
+
+class AssetRegistry:
+    """
+    Class caching the metadata of the assets
+    """
+    def __init__(self) -> None:
+        self.assets: Dict[int, Asset] = {0: ALGO}
+
+    def get(self, asset_id: int) -> Asset:
+        """
+        Returns the asset with the given id, from memory, the db or algod in that order
+        """
+        asset = self.assets.get(asset_id)
+        if asset is not None:
+            return asset
+
+        row = db.read_one("SELECT asset_id, unit_name, decimals, name FROM assets WHERE asset_id = ?", (asset_id, ))
+        if row is not None:
+            asset = Asset(*row)
+        else:
+            params = algod.asset_info(asset_id)["params"]
+            asset = Asset(asset_id, params.get("unit-name", f"ASA #{asset_id}"), params.get("decimals", 0),
+                          params.get("name", ""))
+            db.write("INSERT OR REPLACE INTO assets VALUES (?, ?, ?, ?)",
+                     (asset.asset_id, asset.unit_name, asset.decimals, asset.name))
+
+        self.assets[asset_id] = asset
+        return asset
+
+    def is_supported(self, unit_name: str) -> bool: # pylint: disable=C0116
+        return unit_name.upper() in SUPPORTED_ASSETS
+
+    def find(self, unit_name: str) -> Optional[Asset]:
+        """
+        Returns the supported asset with the given unit name, None if it isn't supported
+        """
+        asset_id = SUPPORTED_ASSETS.get(unit_name.upper())
+        return self.get(asset_id) if asset_id is not None else None
+
+    @property
+    def default(self) -> Asset:
+        """
+        Returns the asset sent when none is given in a command
+        """
+        return self.get(SUPPORTED_ASSETS[DEFAULT_ASSET])
+
+    @property
+    def supported(self) -> Dict[str, Asset]:
+        """
+        Returns the supported assets, keyed by unit name
+        """
+        return {unit_name: self.get(asset_id) for unit_name, asset_id in SUPPORTED_ASSETS.items()}
+
+asset_registry = AssetRegistry()
@@ -8,12 +8,14 @@ Reddit: API wrapper to communicate with reddit
 import os
 
 import praw
-from algosdk.v2client import algod
 from rich.console import Console
-import sqlite3
+
+from db import Database
+from deadline import DeadlineRequestor
+from replay import OFF, RECORD, REPLAY, Traffic, TrafficAlgod
+from router import AlgodRouter, TimedAlgodClient
 ######################### Initialize sqlite connection #########################
-con = sqlite3.connect('tips.db')
-cur = con.cursor()
+db = Database('tips.db')
 
 ######################### Initialize Algod connection #########################
 
@@ -27,7 +29,24 @@ headers = {
     "x-api-key": ALGOD_TOKEN
 }
 
-algod = algod.AlgodClient(ALGOD_TOKEN, algod_address, headers)
+# (address, token, headers) of every algod node, the first one is the primary used for the writes
+ALGOD_ENDPOINTS = [
+    (algod_address, ALGOD_TOKEN, headers),
+]
+
+algod = AlgodRouter([TimedAlgodClient(token, address, endpoint_headers)
+                     for address, token, endpoint_headers in ALGOD_ENDPOINTS])
+
+######################### Initialize traffic record/replay #########################
+
+if os.environ.get("AKTATIP_REPLAY"):
+    traffic = Traffic(REPLAY, os.environ["AKTATIP_REPLAY"], os.environ.get("AKTATIP_REPLAY_SPEED", "1"))
+    algod = TrafficAlgod(None, traffic)
+elif os.environ.get("AKTATIP_RECORD"):
+    traffic = Traffic(RECORD, os.environ["AKTATIP_RECORD"])
+    algod = TrafficAlgod(algod, traffic)
+else:
+    traffic = Traffic(OFF)
 
 
 ######################### Initialize Reddit connection #########################
@@ -44,7 +63,8 @@ reddit = praw.Reddit(
             client_secret=CLIENT_SECRET,
             password=PASSWORD,
             username=USERNAME,
-            user_agent=USER_AGENT
+            user_agent=USER_AGENT,
+            requestor_class=DeadlineRequestor
 )
 
 ######################### Initialize Rich console #########################
@@ -0,0 +1,194 @@
+"""
+File containing the Database class, the only access to the sqlite database
+
+Writes are serialized through a queue and run by a single writer thread,
+each in its own transaction, in the order they were submitted.
+Reads use a pool of read-only connections to the database in WAL mode,
+so they run concurrently with each other and with the writer.
+Every connection keeps its prepared statements in a cache, so the queries
+must be constant strings with ? parameters to be prepared only once.
+
+Running this file runs a benchmark of concurrent reads and writes:
+    python db.py [threads] [operations per thread]
+"""
+
+import os
+import queue
+import sqlite3
+import sys
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Any, Callable, Iterable, List, Optional
+
+DB_PATH = "tips.db"
+READERS = 4 # Maximum number of read-only connections
+STATEMENT_CACHE_SIZE = 256 # Prepared statements kept per connection
+BUSY_TIMEOUT = 5.0 # Seconds a connection waits for a lock
+
+class Database:
+    """
+    Class giving thread-safe access to the sqlite database
+    """
+    def __init__(self, path: str = DB_PATH, readers: int = READERS) -> None:
+        self.path = path
+        self.writes = queue.Queue()
+        self.readers = queue.LifoQueue()
+        self.reader_slots = threading.BoundedSemaphore(readers)
+
+        started = Future()
+        self.writer = threading.Thread(target=self.write_loop, args=(started, ), name="db-writer", daemon=True)
+        self.writer.start()
+        started.result() # The database and its WAL exist before the first read
+
+    def connect(self, read_only: bool = False) -> sqlite3.Connection:
+        """
+        Opens a connection to the database, read-only connections can't create it
+        """
+        if read_only:
+            connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, timeout=BUSY_TIMEOUT,
+                                         check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+        else:
+            connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, cached_statements=STATEMENT_CACHE_SIZE)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def write_loop(self, started: Future) -> None:
+        """
+        Runs the queued writes one after the other on the writer connection
+        """
+        connection = self.connect()
+        started.set_result(True)
+        while True:
+            function, future = self.writes.get()
+            if function is None:
+                connection.close()
+                future.set_result(None)
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                with connection: # Commits, or rolls back if the function raises
+                    result = function(connection)
+            except Exception as e: # pylint: disable=W0703, C0103
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def run(self, function: Callable[[sqlite3.Connection], Any]) -> Future:
+        """
+        Queues a function to run on the writer connection, in a single transaction
+
+        Args:
+            function: called with the writer connection, its result is the result of the future
+        Returns:
+            Future: resolved once the transaction is committed
+        """
+        future = Future()
+        self.writes.put((function, future))
+        return future
+
+    def write(self, query: str, params: Iterable = ()) -> Future:
+        """
+        Queues a statement
+
+        Returns:
+            Future: resolved with the rowid of the last inserted row once committed
+        """
+        return self.run(lambda connection: connection.execute(query, params).lastrowid)
+
+    def write_many(self, query: str, rows: Iterable[Iterable]) -> Future:
+        """
+        Queues a statement executed for every row, in a single transaction
+        """
+        rows = list(rows)
+        return self.run(lambda connection: connection.executemany(query, rows).rowcount)
+
+    @contextmanager
+    def reader(self) -> sqlite3.Connection:
+        """
+        Lends a read-only connection of the pool, opening it if needed
+        """
+        self.reader_slots.acquire()
+        try:
+            try:
+                connection = self.readers.get_nowait()
+            except queue.Empty:
+                connection = self.connect(read_only=True)
+            try:
+                yield connection
+            finally:
+                self.readers.put(connection)
+        finally:
+            self.reader_slots.release()
+
+    def read(self, query: str, params: Iterable = ()) -> List[tuple]:
+        """
+        Runs a query on a read-only connection
+
+        Returns:
+            list: all the rows of the result
+        """
+        with self.reader() as connection:
+            return connection.execute(query, params).fetchall()
+
+    def read_one(self, query: str, params: Iterable = ()) -> Optional[tuple]:
+        """
+        Runs a query on a read-only connection
+
+        Returns:
+            tuple: the first row of the result, None if there is none
+        """
+        with self.reader() as connection:
+            return connection.execute(query, params).fetchone()
+
+    def close(self) -> None:
+        """
+        Waits for the queued writes and closes the connections
+        """
+        future = Future()
+        self.writes.put((None, future))
+        future.result()
+        while not self.readers.empty():
+            self.readers.get_nowait().close()
+
+def benchmark(threads: int, operations: int) -> None:
+    """
+    Measures the throughput of lookups and inserts run from several threads at once,
+    on a temporary database shaped like the wallets table
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        database = Database(os.path.join(directory, "benchmark.db"))
+        database.run(lambda connection: connection.execute(
+            "CREATE TABLE wallets (user_id INTEGER PRIMARY KEY, private_key TEXT, public_key TEXT)")).result()
+        database.write_many("INSERT INTO wallets VALUES (?, ?, ?)",
+                            ((user_id, "k" * 88, "p" * 58) for user_id in range(10000))).result()
+
+        def reads(worker):
+            for operation in range(operations):
+                database.read_one("SELECT * FROM wallets WHERE user_id = ?", ((worker * operations + operation) % 10000, ))
+
+        def writes(worker):
+            futures = [database.write("INSERT INTO wallets VALUES (?, ?, ?)",
+                                      (10000 + worker * operations + operation, "k" * 88, "p" * 58))
+                       for operation in range(operations)]
+            for future in futures:
+                future.result()
+
+        for name, work in (("reads", reads), ("writes", writes)):
+            started = perf_counter()
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                list(executor.map(work, range(threads)))
+            elapsed = perf_counter() - started
+            print(f"{threads} threads - {name}: {threads * operations / elapsed:.0f} per second")
+
+        database.close()
+
+if __name__ == "__main__":
+    THREADS = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    OPERATIONS = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    for thread_count in sorted({1, THREADS}):
+        benchmark(thread_count, OPERATIONS)
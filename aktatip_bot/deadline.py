@@ -0,0 +1,189 @@
+"""
+File containing the deadlines of the events
+Every event is handled within a time budget, kept in a context variable
+by the main loop, that the reddit and algod calls made while handling it respect:
+ * reads time out when the budget runs out, and aren't started once it is spent
+ * algod writes aren't started once the budget is spent, but are never cut short
+   once started, since a transaction may reach the network anyway
+ * reddit writes (replies) always go through, they carry the outcome of the event
+An event running out of budget is parked, left unread and received, and handled
+again a few ticks later with a fresh budget. The time spent by every stage is recorded.
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import monotonic
+from typing import Dict, Iterator, List, Optional
+
+from prawcore import Requestor
+from prawcore.const import TIMEOUT
+from prawcore.exceptions import RequestException
+
+from errors import DeadlineExceededError
+
+EVENT_BUDGET = 20.0 # Seconds to handle an event
+RETRY_DELAYS = (30, 120, 600) # Seconds before each retry of a parked event
+REDDIT_READS = {"GET"}
+
+current_deadline: ContextVar[Optional["Deadline"]] = ContextVar("deadline", default=None)
+
+class Deadline:
+    """
+    Class representing the time budget of an event, and how each stage spent it
+    """
+    def __init__(self, budget: float) -> None:
+        self.budget = budget
+        self.started = monotonic()
+        self.expires_at = self.started + budget
+        self.stages = Counter()
+
+    @property
+    def remaining(self) -> float: # pylint: disable=C0116
+        return max(0.0, self.expires_at - monotonic())
+
+    @property
+    def expired(self) -> bool: # pylint: disable=C0116
+        return monotonic() >= self.expires_at
+
+    def check(self, stage: str) -> None:
+        """
+        Raises DeadlineExceededError if the budget is spent, before starting the given stage
+        """
+        if self.expired:
+            raise DeadlineExceededError(stage, self.budget)
+
+    def spend(self, stage: str, seconds: float) -> None: # pylint: disable=C0116
+        self.stages[stage] += seconds
+
+def check(stage: str) -> None:
+    """
+    Raises DeadlineExceededError if the budget of the event being handled is spent
+    Does nothing outside of an event
+    """
+    deadline = current_deadline.get()
+    if deadline is not None:
+        deadline.check(stage)
+
+def timeout_for(stage: str, default: float) -> float:
+    """
+    Returns the timeout of a call, its default timeout bounded by the budget left
+
+    Args:
+        stage: name of the call, recorded in the deadline
+        default: timeout of the call outside of an event, in seconds
+    """
+    deadline = current_deadline.get()
+    if deadline is None:
+        return default
+    deadline.check(stage)
+    return min(default, deadline.remaining)
+
+def timed_out(stage: str, error: Exception) -> Exception:
+    """
+    Returns the error to raise for a failed call, DeadlineExceededError if the budget ran out
+    """
+    deadline = current_deadline.get()
+    if deadline is not None and deadline.expired:
+        return DeadlineExceededError(stage, deadline.budget)
+    return error
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    Records the time spent in the block in the deadline of the event being handled
+    """
+    started = monotonic()
+    try:
+        yield
+    finally:
+        deadline = current_deadline.get()
+        if deadline is not None:
+            deadline.spend(name, monotonic() - started)
+
+class DeadlineRequestor(Requestor):
+    """
+    Requestor of praw bounding the reads by the deadline of the event being handled
+    prawcore retries a failed read with the same timeout, so every attempt is bounded
+    """
+    def request(self, *args, timeout=TIMEOUT, **kwargs): # pylint: disable=W0221
+        method = str(args[0] if args else kwargs.get("method")).upper()
+        name = f"reddit.{method.lower()}"
+        if method in REDDIT_READS:
+            timeout = timeout_for(name, timeout)
+        with stage(name):
+            try:
+                return super().request(*args, timeout=timeout, **kwargs)
+            except RequestException as e: # pylint: disable=C0103
+                error = timed_out(name, e)
+                if error is e:
+                    raise
+                raise error from e
+
+class EventDeadlines:
+    """
+    Class giving their budget to the events, parking the ones that run out of it
+    and keeping the time spent by every stage for the logs
+    """
+    def __init__(self, budget: float = EVENT_BUDGET, retry_delays: tuple = RETRY_DELAYS) -> None:
+        self.budget, self.retry_delays = budget, retry_delays
+        self.parked: Dict[str, tuple] = {} # fullname: (retry_at, event)
+        self.attempts: Dict[str, int] = {} # fullname: times the event was parked
+        self.stages = Counter()
+        self.counters = Counter()
+
+    @contextmanager
+    def budget_of(self, event) -> Iterator[Deadline]:
+        """
+        Runs the block with the budget of the event as the current deadline
+        """
+        deadline = Deadline(self.budget)
+        token = current_deadline.set(deadline)
+        try:
+            yield deadline
+        except DeadlineExceededError:
+            self.counters["exceeded"] += 1
+            raise
+        else:
+            self.attempts.pop(event.fullname, None)
+        finally:
+            current_deadline.reset(token)
+            self.stages.update(deadline.stages)
+            self.stages["total"] += monotonic() - deadline.started
+            self.counters["events"] += 1
+
+    def park(self, event) -> bool:
+        """
+        Parks an event that ran out of budget, to be handled again later
+
+        Returns:
+            bool: False if the event was retried too many times and should be given up
+        """
+        attempts = self.attempts.get(event.fullname, 0)
+        if attempts >= len(self.retry_delays):
+            self.attempts.pop(event.fullname, None)
+            self.counters["given_up"] += 1
+            return False
+        self.attempts[event.fullname] = attempts + 1
+        self.parked[event.fullname] = (monotonic() + self.retry_delays[attempts], event)
+        self.counters["parked"] += 1
+        return True
+
+    def is_parked(self, fullname: str) -> bool: # pylint: disable=C0116
+        return fullname in self.parked
+
+    def due_events(self) -> List:
+        """
+        Returns the parked events whose retry time has come, and unparks them
+        """
+        now = monotonic()
+        due = [fullname for fullname, (retry_at, _) in self.parked.items() if retry_at <= now]
+        return [self.parked.pop(fullname)[1] for fullname in due]
+
+    def stats(self) -> dict:
+        """
+        Returns the counters, and the average time spent by every stage per event, in seconds
+        """
+        events = self.counters["events"] or 1
+        return {**self.counters, "waiting": len(self.parked),
+                "stages": {name: round(seconds / events, 4) for name, seconds in self.stages.items()}}
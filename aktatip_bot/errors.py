@@ -32,3 +32,14 @@ class FirstTransactionError(Exception):
     def __init__(self, amount: float) -> None:
         self.amount = amount
 
+class PoolError(Exception):
+    def __init__(self, transaction_id: str, pool_error: str) -> None:
+        self.transaction_id, self.pool_error = transaction_id, pool_error
+
+class DeadlineExceededError(Exception):
+    def __init__(self, stage: str, budget: float) -> None:
+        self.stage, self.budget = stage, budget
+
+class ReplayMissError(Exception):
+    def __init__(self, target: str, method: str) -> None:
+        self.target, self.method = target, method
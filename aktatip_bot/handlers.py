@@ -5,6 +5,8 @@ File containing the EventHandler class, that takes in
 a praw Event and performs the matching action
 """
 
+import math
+from datetime import datetime
 from time import time_ns
 from typing import Union
 
@@ -13,21 +15,31 @@ from algosdk import encoding
 from praw.models.reddit.comment import Comment
 from praw.models.reddit.message import Message
 
-from clients import console
+import rain
+from assets import ALGO, Asset, asset_registry
+from indexer import block_indexer
+from logs import logger
 from errors import (InsufficientFundsError, InvalidCommandError, AlreadyOptedInError, ReceiverNotOptedInError,
                       UserNotOptedInError, UserNotOptedInError, InvalidUserError, ZeroTransactionError)
 from instances import User
-from templates import (EVENT_RECEIVED, INSUFFICIENT_FUNDS, SENDER_NOT_OPT_IN,
-                              RECEIVER_NOT_OPT_IN, NO_WALLET, ZERO_TRANSACTION)
-from utils import is_float, valid_user,  COMMENT_COMMANDS
+from profiler import DEFAULT_DURATION, MAX_DURATION, profiler
+from stats import ALL, leaderboard, week_of
+from templates import (INSUFFICIENT_FUNDS, SENDER_NOT_OPT_IN,
+                              RECEIVER_NOT_OPT_IN, NO_WALLET, ZERO_TRANSACTION,
+                              HISTORY_TIP_SENT, HISTORY_TIP_RECEIVED, HISTORY_WITHDRAWAL,
+                              HISTORY_OPT_IN, HISTORY_NEXT_PAGE, HISTORY_EMPTY, HISTORY_DETAILS, HISTORY_INTERNAL,
+                              HISTORY_FAILED, PROFILE_STARTED)
+from utils import (is_float, valid_user,  COMMENT_COMMANDS, HISTORY_PAGE_SIZE, ADMINS, get_transaction_history,
+                   save_finished_event, save_submitted_event)
+
+LOGGED_BODY_LENGTH = 100
 
 class EventHandler:
     """
     Class used to handle an incoming event
-    and keep in memory the unconfirmed transactions
+    The unconfirmed transactions are kept by the block indexer
     note: could probably do  without a class
     """
-    unconfirmed_transactions: set = set()
 
     def handle_comment(self, comment: Comment) -> None:
         """
@@ -50,20 +62,22 @@ class EventHandler:
   
         if not is_float(amountIn): raise InvalidCommandError(comment.body)
         amount = float(amountIn)
+        asset = self.parse_asset(command)
         note = " ".join(command)
 
         try:
-            transaction = author.send(receiver, amount, note, comment)
-            self.unconfirmed_transactions.add(transaction)
+            transaction = author.send(receiver, amount, note, comment, asset)
+            self.submitted(comment, transaction)
         except UserNotOptedInError:
-            comment.reply(SENDER_NOT_OPT_IN)
+            comment.reply(SENDER_NOT_OPT_IN.substitute(unit=asset.unit_name))
         except ReceiverNotOptedInError:
-            comment.reply(RECEIVER_NOT_OPT_IN)
+            comment.reply(RECEIVER_NOT_OPT_IN.substitute(unit=asset.unit_name))
         except ZeroTransactionError:
-            comment.reply(ZERO_TRANSACTION)
+            comment.reply(self.zero_transaction(asset))
         except InsufficientFundsError as e: # pylint: disable=C0103
             comment.reply(INSUFFICIENT_FUNDS.substitute(balance=e.balance,
-                                                         amount=e.amount))
+                                                         amount=e.amount,
+                                                         unit=asset.unit_name))
     def handle_message(self, message: Message) -> None: # pylint: disable=R0912, R0915
         """
         Parses the incoming message to determine what action to take
@@ -82,6 +96,8 @@ class EventHandler:
 
             amountIn = command.pop(0)
             if not is_float(amountIn): raise InvalidCommandError(message.body)
+            asset = self.parse_asset(command)
+            if not command: raise InvalidCommandError(message.body)
             username = command.pop(0)
             if not valid_user(username): raise InvalidUserError(username)
 
@@ -90,35 +106,43 @@ class EventHandler:
             note = " ".join(command)
 
             try:
-                transaction = author.send(receiver, amount, note, message)
-                self.unconfirmed_transactions.add(transaction)
+                transaction = author.send(receiver, amount, note, message, asset)
+                self.submitted(message, transaction)
             except UserNotOptedInError:
-                message.reply(SENDER_NOT_OPT_IN)
+                message.reply(SENDER_NOT_OPT_IN.substitute(unit=asset.unit_name))
             except ReceiverNotOptedInError:
-                message.reply(RECEIVER_NOT_OPT_IN)
+                message.reply(RECEIVER_NOT_OPT_IN.substitute(unit=asset.unit_name))
             except ZeroTransactionError:
-                message.reply(ZERO_TRANSACTION)
+                message.reply(self.zero_transaction(asset))
             except InsufficientFundsError as e: # pylint: disable=C0103
                 message.reply(INSUFFICIENT_FUNDS.substitute(balance=e.balance,
-                                                             amount=e.amount))
+                                                             amount=e.amount,
+                                                             unit=asset.unit_name))
 
         ######################### Handle withdraw command #########################
         elif main_cmd == "withdraw":
             if len(command) < 2: raise InvalidCommandError(message.body)
             amount = command.pop(0)
             if not ((amount) or is_float(amount)): raise InvalidCommandError(message.body)
+            asset = self.parse_asset(command)
+            if not command: raise InvalidCommandError(message.body)
             address = command.pop(0)
             if not encoding.is_valid_address(address): raise InvalidCommandError(message.body)
             note = " ".join(command)
 
             try:
-                transaction = author.withdraw(amount, address, note, message, False)
-                self.unconfirmed_transactions.add(transaction)
+                transaction = author.withdraw(amount, address, note, message, asset)
+                self.submitted(message, transaction)
+            except UserNotOptedInError:
+                message.reply(SENDER_NOT_OPT_IN.substitute(unit=asset.unit_name))
+            except ReceiverNotOptedInError:
+                message.reply(RECEIVER_NOT_OPT_IN.substitute(unit=asset.unit_name))
             except ZeroTransactionError:
-                message.reply(ZERO_TRANSACTION)
+                message.reply(self.zero_transaction(asset))
             except InsufficientFundsError as e: # pylint: disable=C0103
                 message.reply(INSUFFICIENT_FUNDS.substitute(balance=e.balance,
-                                                             amount=e.amount))
+                                                             amount=e.amount,
+                                                             unit=asset.unit_name))
         ######################### Handle algo withdraw command #########################
         elif main_cmd == "algowithdraw":
             if len(command) < 2: raise InvalidCommandError(message.body)
@@ -129,30 +153,49 @@ class EventHandler:
             note = " ".join(command)
 
             try:
-                transaction = author.withdraw(amount, address, note, message, True)
-                self.unconfirmed_transactions.add(transaction)
+                transaction = author.withdraw(amount, address, note, message, ALGO)
+                self.submitted(message, transaction)
             except ZeroTransactionError:
-                message.reply(ZERO_TRANSACTION)
+                message.reply(self.zero_transaction(ALGO))
             except InsufficientFundsError as e: # pylint: disable=C0103
                 message.reply(INSUFFICIENT_FUNDS.substitute(balance=e.balance,
-                                                             amount=e.amount))
+                                                             amount=e.amount,
+                                                             unit=ALGO.unit_name))
         ######################### Handle opt in command #########################
         elif main_cmd == "optin":
+            asset = self.parse_asset(command)
             if len(command) > 0: raise InvalidCommandError(message.body)
 
             if author.new:
                 pass
 
             try:
-                transaction = author.optin(message)
-                self.unconfirmed_transactions.add(transaction)
+                transaction = author.optin(message, asset)
+                self.submitted(message, transaction)
             except ZeroTransactionError:
-                message.reply(ZERO_TRANSACTION)
+                message.reply(self.zero_transaction(asset))
             except AlreadyOptedInError:
                 message.reply("Already opted in, no need to repeate")
             except InsufficientFundsError as e: # pylint: disable=C0103
                 message.reply(INSUFFICIENT_FUNDS.substitute(balance=e.balance,
-                                                             amount=e.amount))
+                                                             amount=e.amount,
+                                                             unit=ALGO.unit_name))
+        ######################### Handle rain command #########################
+        elif main_cmd == "rain":
+            if len(command) < 2: raise InvalidCommandError(message.body)
+            amountIn = command.pop(0)
+            if not is_float(amountIn): raise InvalidCommandError(message.body)
+            asset = self.parse_asset(command)
+            if not command or author.new: raise InvalidCommandError(message.body)
+
+            amount = asset.to_units(float(amountIn))
+            if amount < 1:
+                message.reply(self.zero_transaction(asset))
+            elif not author.wallet.opted_in(asset):
+                message.reply(SENDER_NOT_OPT_IN.substitute(unit=asset.unit_name))
+            else:
+                rain.start(author.user_id, author.name.lower(), amount, asset, command, message.fullname)
+
         ######################### Handle wallet command #########################
         elif main_cmd == "wallet":
             if len(command) > 0: raise InvalidCommandError(message.body)
@@ -162,24 +205,127 @@ class EventHandler:
             else:
                 message.reply(str(author.wallet))
 
-            console.log(f"Wallet information sent to {author.name} (#{author.user_id})")
+            logger.info("Wallet information sent", event_id=message.id, user=author.name, user_id=author.user_id)
+
+        ######################### Handle history command #########################
+        elif main_cmd == "history":
+            if len(command) > 1: raise InvalidCommandError(message.body)
+            cursor = command.pop(0) if command else None
+            if cursor is not None and not cursor.isdigit(): raise InvalidCommandError(message.body)
+
+            rows = get_transaction_history(author.user_id, int(cursor) if cursor else None)
+            message.reply(self.format_history(author, rows))
+
+        ######################### Handle leaderboard command #########################
+        elif main_cmd == "leaderboard":
+            if len(command) > 3: raise InvalidCommandError(message.body)
+            week = week_of(time_ns() * 1e-9)
+            subreddit = ALL
+            asset = asset_registry.default
+            for arg in command:
+                if arg.lower() == "all":
+                    week = ALL
+                elif asset_registry.is_supported(arg):
+                    asset = asset_registry.find(arg)
+                else:
+                    subreddit = arg.lower().replace("r/", "", 1).strip("/")
+
+            message.reply(leaderboard(subreddit, week, asset))
+
+        ######################### Handle profile command #########################
+        elif main_cmd == "profile" and author.name in ADMINS:
+            if len(command) > 1: raise InvalidCommandError(message.body)
+            duration = command.pop(0) if command else DEFAULT_DURATION
+            if not is_float(duration): raise InvalidCommandError(message.body)
+            duration = float(duration)
+            if not (math.isfinite(duration) and duration > 0): raise InvalidCommandError(message.body) # nan, inf, <= 0
+            duration = min(duration, MAX_DURATION)
+
+            profiler.request(duration)
+            message.reply(PROFILE_STARTED.substitute(duration=duration))
 
         ######################### Handle unknown command #########################
         else:
             raise InvalidCommandError(message.body)
 
+    @staticmethod
+    def parse_asset(command: list) -> Asset:
+        """
+        Pops the unit name following the amount of a command if it is one of a supported asset
+
+        Returns:
+            Asset: the asset named in the command, the default asset if there is none
+        """
+        if command and asset_registry.is_supported(command[0]):
+            return asset_registry.find(command.pop(0))
+        return asset_registry.default
+
+    @staticmethod
+    def zero_transaction(asset: Asset) -> str:
+        """
+        Returns the reply to a transaction rounding to 0 in the base unit of its asset
+        """
+        return ZERO_TRANSACTION.substitute(smallest=f"{asset.from_units(1):g}", unit=asset.unit_name)
+
+    @staticmethod
+    def submitted(event: Union[Comment, Message], transaction: "Transaction") -> None:
+        """
+        Saves that a transaction was sent for the event, so that the event is never
+        handled twice, then waits for the confirmation of the transaction
+        Transactions settled on the internal ledger are confirmed right away
+        """
+        if transaction.internal:
+            transaction.send_confirmation()
+            save_finished_event(event.fullname, confirmed=True)
+            transaction.log()
+            return
+        save_submitted_event(event.fullname, transaction.tx_id)
+        block_indexer.watch_transaction(transaction)
+
+    @staticmethod
+    def format_history(author: User, rows: list) -> str:
+        """
+        Formats a page of transaction history rows into a reply,
+        with the command to send to get the next page
+        """
+        if not rows:
+            return HISTORY_EMPTY
+
+        lines = []
+        for (row_id, kind, sender, receiver, destination, amount, asset_id, # pylint: disable=W0612
+             tx_id, confirmed_round, subreddit, created_at, error) in rows:
+            asset = asset_registry.get(asset_id)
+            fields = dict(date=datetime.utcfromtimestamp(created_at).strftime("%Y-%m-%d %H:%M"),
+                          amount=asset.from_units(amount),
+                          unit=asset.unit_name,
+                          subreddit=f" in r/{subreddit}" if subreddit else "",
+                          details=HISTORY_DETAILS.substitute(transaction_id=tx_id) if tx_id else HISTORY_INTERNAL)
+            if error is not None: # Kept in the history, but the amount never moved
+                fields["details"] = HISTORY_FAILED
+            if kind == "tip" and sender == author.name:
+                lines.append(HISTORY_TIP_SENT.substitute(receiver=receiver, **fields))
+            elif kind == "tip":
+                lines.append(HISTORY_TIP_RECEIVED.substitute(sender=sender, **fields))
+            elif kind == "optin":
+                lines.append(HISTORY_OPT_IN.substitute(**fields))
+            else:
+                lines.append(HISTORY_WITHDRAWAL.substitute(destination=destination, **fields))
+
+        if len(rows) == HISTORY_PAGE_SIZE:
+            lines.append(HISTORY_NEXT_PAGE.substitute(cursor=rows[-1][0]))
+        return "\n\n".join(lines)
+
     def handle_event(self, event: Union[Comment, Message]) -> None:
         """
         Logs the incoming event and distributes it to handle_comment
         or handle_message depending on the type
         """
-        console.log(EVENT_RECEIVED.substitute(author=event.author,
-                                              event_type=type(event).__name__.lower(),
-                                              body=event.body))
+        logger.info("Event received", event_id=event.id, event_type=type(event).__name__.lower(),
+                    author=str(event.author), body=event.body[:LOGGED_BODY_LENGTH])
 
         if isinstance(event, Message):
             self.handle_message(event)
         elif isinstance(event, Comment):
             self.handle_comment(event)
         else:
-            console.log(f"Unknown event was received, of type : {type(event)}")
+            logger.warning("Unknown event received", event_id=event.id, event_type=type(event).__name__)
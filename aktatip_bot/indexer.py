@@ -0,0 +1,282 @@
+"""
+File containing the BlockIndexer class, that follows the rounds of
+the blockchain and matches every transaction of every new block against
+the wallets managed by the bot and the transactions waiting for a confirmation
+"""
+
+import base64
+from concurrent.futures import Future
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+
+import msgpack
+from algosdk import encoding
+
+from assets import asset_registry
+from clients import algod, reddit, traffic
+from errors import PoolError
+from logs import logger
+from pending import PendingTransaction
+from templates import DEPOSIT_RECEIVED, DEPOSIT_SUBJECT
+from utils import get_indexed_round, get_name_by_userId, get_wallet_index, save_block
+
+NOTIFY_DEPOSITS = False
+MAX_ROUNDS_PER_ADVANCE = 10
+MAX_RESUME_ROUNDS = 1000 # Rounds caught up on after a restart, blocks older than that are pruned by the nodes
+WAIT_TIMEOUT_ROUNDS = 20
+
+def block_txid(signed_txn: dict, block: dict) -> str:
+    """
+    Computes the id of a transaction found in a block
+
+    Transactions are stored in blocks without their genesis hash and genesis id,
+    so they have to be put back before hashing the canonical encoding
+
+    Args:
+        signed_txn: the signed transaction as decoded from the msgpack block
+        block: the block containing the transaction
+    Returns:
+        str: the transaction id
+    """
+    txn = dict(signed_txn["txn"])
+    txn["gh"] = block["gh"]
+    if signed_txn.get("hgi"):
+        txn["gen"] = block["gen"]
+    raw = msgpack.packb(dict(sorted(txn.items())), use_bin_type=True)
+    return base64.b32encode(encoding.checksum(b"TX" + raw)).decode().strip("=")
+
+class BlockIndexer:
+    """
+    Class following the rounds of the blockchain, fetching each block once
+    Replaces polling account_info for every wallet and pending_transaction_info
+    for every unconfirmed transaction
+    """
+    def __init__(self) -> None:
+        self.last_round: Optional[int] = None
+        self.head_round: Optional[int] = None
+        self.wallets: Dict[str, int] = get_wallet_index()
+        self.waiters: Dict[str, Tuple[Future, int]] = {}
+        self.pending_transactions: Dict[str, PendingTransaction] = {}
+        self.finished_transactions: List[PendingTransaction] = [] # Confirmed or failed
+
+    def watch_wallet(self, public_key: str, user_id: int) -> None:
+        """
+        Adds a newly created wallet to the index
+        """
+        self.wallets[public_key] = user_id
+
+    def start(self) -> None:
+        """
+        Resumes from the last round processed by the previous run, so that the deposits made
+        while the bot was down are found, at most MAX_RESUME_ROUNDS behind the chain
+        Starts from the last round of the chain on the first run
+        """
+        self.head_round = algod.status()["last-round"]
+        saved_round = get_indexed_round()
+        if saved_round is None:
+            self.last_round = self.head_round
+        else:
+            self.last_round = max(saved_round, self.head_round - MAX_RESUME_ROUNDS)
+            logger.info("Block indexer resumed", round=self.last_round, behind=self.head_round - self.last_round)
+
+    def wait(self, transaction_id: str, timeout: int = WAIT_TIMEOUT_ROUNDS, timeout_round: int = None) -> Future:
+        """
+        Registers a transaction to wait for, all the waiters are served by
+        the same round loop so waiting costs no algod call per transaction
+
+        Args:
+            transaction_id: the transaction to wait for
+            timeout: maximum number of rounds to wait, from the last round of the chain
+            timeout_round: round after which to stop waiting, overrides timeout
+        Returns:
+            Future: resolved with the confirmed round, or failed with a PoolError
+                    if the transaction was rejected or a TimeoutError if it is
+                    not confirmed in the next timeout rounds
+        """
+        if transaction_id in self.waiters:
+            return self.waiters[transaction_id][0]
+        if self.last_round is None:
+            self.start()
+        if timeout_round is None:
+            timeout_round = max(self.last_round, self.head_round or 0) + timeout
+        future = Future()
+        future.set_running_or_notify_cancel()
+        self.waiters[transaction_id] = (future, timeout_round)
+        return future
+
+    def rescan_from(self, round_num: int) -> None:
+        """
+        Moves the indexer back to process again the blocks from the given round,
+        the deposits already saved are ignored
+        """
+        if self.last_round is None:
+            self.start()
+        self.last_round = min(self.last_round, round_num - 1)
+
+    def watch_transaction(self, transaction: "Transaction") -> None:
+        """
+        Adds a sent transaction to the ones waiting for a confirmation
+        Only its compact record is kept, the transaction itself can be freed
+        """
+        self.watch_pending(transaction.pending())
+
+    def watch_pending(self, transaction: PendingTransaction, timeout_round: int = None) -> None:
+        """
+        Adds the record of a sent transaction to the ones waiting for a confirmation
+        """
+        self.pending_transactions[transaction.tx_id] = transaction
+        self.wait(transaction.tx_id, timeout_round=timeout_round).add_done_callback(
+            partial(self.transaction_done, transaction.tx_id))
+
+    def resume_transaction(self, transaction: PendingTransaction, last_round: int = None) -> None:
+        """
+        Watches again a transaction sent before a restart, until its last valid round
+        The blocks it may be in are rescanned by the caller with rescan_from, so a transaction
+        confirmed while the bot was down is found there, the node forgets it once confirmed.
+        A single pending_transaction_info call resolves the ones still known to the node.
+        """
+        self.watch_pending(transaction, last_round)
+        try:
+            pending_txn = algod.pending_transaction_info(transaction.tx_id)
+        except Exception: # pylint: disable=W0703
+            return # Unknown to the node: confirmed in a rescanned block, or failed after its last valid round
+        future, _ = self.waiters.get(transaction.tx_id, (None, None))
+        if future is None:
+            return
+        if pending_txn.get("confirmed-round", 0) > 0:
+            del self.waiters[transaction.tx_id]
+            future.set_result(pending_txn["confirmed-round"])
+        elif pending_txn.get("pool-error"):
+            del self.waiters[transaction.tx_id]
+            future.set_exception(PoolError(transaction.tx_id, pending_txn["pool-error"]))
+
+    def transaction_done(self, transaction_id: str, future: Future) -> None:
+        """
+        Callback of the futures of the watched transactions
+        Failed transactions are returned too, so that their senders are told
+        """
+        transaction = self.pending_transactions.pop(transaction_id)
+        try:
+            transaction.confirmed_round = future.result()
+        except PoolError as e: # pylint: disable=C0103
+            transaction.error = e.pool_error
+        except TimeoutError:
+            transaction.error = "not confirmed in time"
+        self.finished_transactions.append(transaction)
+
+    def advance(self) -> List[PendingTransaction]:
+        """
+        Processes the blocks committed since the last call, at most
+        MAX_ROUNDS_PER_ADVANCE of them so that the main loop stays responsive
+
+        Returns:
+            list: the watched transactions confirmed or failed in the processed blocks
+        """
+        if self.last_round is None:
+            self.start()
+        else:
+            self.head_round = algod.status()["last-round"]
+        for _ in range(min(self.head_round - self.last_round, MAX_ROUNDS_PER_ADVANCE)):
+            self.process_block(self.last_round + 1)
+            self.last_round += 1
+            self.expire_waiters()
+
+        finished, self.finished_transactions = self.finished_transactions, []
+        return finished
+
+    def follow(self) -> None:
+        """
+        Blocking loop following the rounds one after the other,
+        for when the indexer is run on its own
+        """
+        while True:
+            if self.last_round is None:
+                self.start()
+            algod.status_after_block(self.last_round)
+            for transaction in self.advance():
+                transaction.send_confirmation()
+                transaction.log()
+
+    def expire_waiters(self) -> None:
+        """
+        Fails the waiters whose timeout round was reached
+        A single pending_transaction_info call tells a rejected transaction
+        apart from a transaction that is still in the pool
+        """
+        expired = [transaction_id for transaction_id, (_, timeout_round) in self.waiters.items()
+                   if timeout_round <= self.last_round]
+        for transaction_id in expired:
+            future, _ = self.waiters.pop(transaction_id)
+            try:
+                pending_txn = algod.pending_transaction_info(transaction_id)
+            except Exception: # pylint: disable=W0703
+                pending_txn = {}
+            if pending_txn.get("confirmed-round", 0) > 0:
+                future.set_result(pending_txn["confirmed-round"])
+            elif pending_txn.get("pool-error"):
+                future.set_exception(PoolError(transaction_id, pending_txn["pool-error"]))
+            else:
+                future.set_exception(TimeoutError(
+                    'pending tx not found in timeout rounds, transaction id = : {}'.format(transaction_id)))
+
+    def process_block(self, round_num: int) -> None:
+        """
+        Fetches the block of the given round and matches its transactions
+        against the wallet index and the waiters, resolving the confirmed ones
+
+        Args:
+            round_num: the round of the block to process
+        """
+        raw_block = algod.block_info(round_num=round_num, response_format="msgpack")
+        block = msgpack.unpackb(raw_block, raw=False)["block"]
+
+        deposits, opt_ins, opt_outs = [], [], []
+        for signed_txn in block.get("txns", []):
+            txn = signed_txn["txn"]
+            tx_id = block_txid(signed_txn, block)
+
+            if tx_id in self.waiters:
+                future, _ = self.waiters.pop(tx_id)
+                future.set_result(round_num)
+
+            sender = encoding.encode_address(txn["snd"])
+            if sender in self.wallets:
+                if txn.get("type") == "axfer" and txn.get("aclose"):
+                    opt_outs.append((sender, txn.get("xaid", 0)))
+                elif txn.get("type") == "axfer" and txn.get("arcv") == txn["snd"]:
+                    opt_ins.append((sender, txn.get("xaid", 0)))
+                continue # Transfers between bot wallets are not deposits
+
+            if txn.get("type") == "pay" and "rcv" in txn:
+                receiver, asset_id, amount = encoding.encode_address(txn["rcv"]), 0, txn.get("amt", 0)
+            elif txn.get("type") == "axfer" and "arcv" in txn:
+                receiver, asset_id, amount = encoding.encode_address(txn["arcv"]), txn.get("xaid", 0), txn.get("aamt", 0)
+            else:
+                continue
+
+            if receiver in self.wallets and amount > 0:
+                deposits.append((tx_id, self.wallets[receiver], sender, asset_id, amount, round_num))
+
+        save_block(round_num, deposits, opt_ins, opt_outs)
+        if deposits:
+            logger.info("Deposits found", round=round_num, tx_ids=[deposit[0] for deposit in deposits])
+            if NOTIFY_DEPOSITS:
+                for deposit in deposits:
+                    self.notify_deposit(*deposit)
+
+    @staticmethod
+    def notify_deposit(tx_id, user_id, sender, asset_id, amount, round_num): # pylint: disable=R0913, W0613
+        """
+        Sends a message to the owner of the wallet that received a deposit
+        """
+        name = get_name_by_userId(user_id)
+        if name is None:
+            return
+        asset = asset_registry.get(asset_id)
+        traffic.call("reddit", "message", reddit.redditor(name).message, DEPOSIT_SUBJECT,
+                     DEPOSIT_RECEIVED.substitute(amount=asset.from_units(amount),
+                                                 unit=asset.unit_name,
+                                                 sender=sender,
+                                                 transaction_id=tx_id))
+
+block_indexer = BlockIndexer()
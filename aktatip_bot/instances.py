@@ -3,21 +3,27 @@ TODO
 """
 
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from time import time_ns
-from typing import Optional
+from typing import Dict, Optional
 
 from algosdk import transaction
 from algosdk.account import generate_account
 from algosdk.mnemonic import from_private_key
-from algosdk.util import algos_to_microalgos, microalgos_to_algos
-
-from clients import algod, console, reddit
+from algosdk.util import microalgos_to_algos
+
+from assets import ALGO, Asset, asset_registry
+from clients import algod, reddit, traffic
+from indexer import block_indexer
+from ledger import INTERNAL_TRANSFERS, transfer, unsettled_amounts
+from pending import PendingTransaction
+from signing import signing_pipeline, Transfer
+from logs import logger
 from errors import (FirstTransactionError, InsufficientFundsError, ReceiverNotOptedInError,
                                UserNotOptedInError, ZeroTransactionError, AlreadyOptedInError)
-from templates import (TRANSACTION_CONFIRMATION, WALLET_REPR, AKTA_ID, OPT_IN,
-                             WITHDRAWAL_ALGO_CONFIRMATION, WITHDRAWAL_CONFIRMATION)
-from utils import get_next_userId, get_wallet_by_userId, get_userId_by_name, save_user, save_wallet
+from templates import WALLET_REPR
+from utils import (get_next_userId, get_wallet_by_userId, get_userId_by_name, save_user, save_wallet,
+                   queue_transaction)
 
 @dataclass
 class Wallet:
@@ -26,16 +32,20 @@ class Wallet:
     """
     private_key: str
     public_key: str
+    user_id: Optional[int] = field(default=None, repr=False, compare=False)
+    _chain_holdings: Optional[Dict[int, int]] = field(default=None, init=False, repr=False, compare=False)
+    _holdings: Optional[Dict[int, int]] = field(default=None, init=False, repr=False, compare=False)
 
     @classmethod
     def generate(cls) -> "Wallet":
         """
         Generates a public/private key pair
+        The keys go through the traffic, so that a replay creates the wallets of the recording
 
         Returns:
             wallet: an instance of the class Wallet with the generated keys
         """
-        private_key, public_key = generate_account()
+        private_key, public_key = traffic.call("algod", "generate_account", generate_account)
         return cls(private_key, public_key)
 
     @classmethod
@@ -54,7 +64,7 @@ class Wallet:
         if not wallet_dict: # pylint: disable=R1705
             return None
         else:
-            return cls(wallet_dict["private_key"], wallet_dict["public_key"])
+            return cls(wallet_dict["private_key"], wallet_dict["public_key"], user_id)
 
     def log(self, user: "User") -> None:
         """
@@ -63,8 +73,9 @@ class Wallet:
         Args:
             user: an instance of User corresponding to the wallet owner
         """
-        console.log(f"Wallet created for user {user.name} (#{user.user_id})")
+        logger.info("Wallet created", user=user.name, user_id=user.user_id)
         save_wallet(user.user_id, self.private_key, self.public_key)
+        block_indexer.watch_wallet(self.public_key, user.user_id)
 
     @property
     def qrcode(self) -> None:
@@ -74,30 +85,60 @@ class Wallet:
         return f"https://api.qrserver.com/v1/create-qr-code/?data={self.public_key}&size=220x220&margin=4"
 
     @property
-    def balance(self) -> float:
+    def chain_holdings(self) -> Dict[int, int]:
         """
-        Returns the balance of the wallet
+        Returns the amounts held by the wallet on chain, fetched with a single algod call
+        the first time and kept for the lifetime of the instance
 
         Returns:
-            balance: the balance of the wallet as a float, in Algos
+            holdings: the amounts in the base unit of each asset, keyed by asset id (0 for Algos)
+                      The assets the wallet isn't opted in are missing
         """
-        account_info = algod.account_info(self.public_key)
-        balance = float(microalgos_to_algos(account_info["amount"]))
-        return balance
+        if self._chain_holdings is None:
+            account_info = algod.account_info(self.public_key)
+            self._chain_holdings = {held["asset-id"]: held["amount"] for held in account_info.get("assets", [])}
+            self._chain_holdings[ALGO.asset_id] = account_info["amount"]
+        return self._chain_holdings
 
     @property
-    def balanceAKTA(self) -> float:
+    def holdings(self) -> Dict[int, int]:
+        """
+        Returns the amounts available to the owner of the wallet, the on-chain
+        amounts plus the tips not yet settled on the internal ledger
+        """
+        if self._holdings is None:
+            self._holdings = dict(self.chain_holdings)
+            if self.user_id is not None:
+                for asset_id, amount in unsettled_amounts(self.user_id).items():
+                    if asset_id in self._holdings:
+                        self._holdings[asset_id] += amount
+        return self._holdings
+
+    def balance_of(self, asset: Asset, on_chain: bool = False) -> Optional[float]:
+        """
+        Returns the balance of the wallet in the given asset
+
+        Args:
+            asset: the asset of the balance
+            on_chain: True for the on-chain balance, without the unsettled tips
+        Returns:
+            balance: the balance as a float, None if the wallet isn't opted in the asset
+        """
+        units = (self.chain_holdings if on_chain else self.holdings).get(asset.asset_id)
+        return None if units is None else asset.from_units(units)
+
+    def opted_in(self, asset: Asset) -> bool: # pylint: disable=C0116
+        return asset.asset_id in self.chain_holdings
+
+    @property
+    def balance(self) -> float:
         """
         Returns the balance of the wallet
 
         Returns:
-            balance: the balance of the wallet as a float, in AKTAs
+            balance: the balance of the wallet as a float, in Algos
         """
-        account_info = algod.account_info(self.public_key)
-        for scrutinized_asset in account_info['assets']:      
-         if (scrutinized_asset['asset-id'] == AKTA_ID):
-           return microalgos_to_algos(scrutinized_asset['amount'])
-        return "not opt-in"
+        return self.balance_of(ALGO)
 
     def __repr__(self) -> str:
         """
@@ -106,10 +147,11 @@ class Wallet:
         Returns:
             str
         """
+        balances = [f"{self.balance_of(asset)} {unit_name}" if self.opted_in(asset) else f"not opt-in {unit_name}"
+                    for unit_name, asset in asset_registry.supported.items()]
         return WALLET_REPR.substitute(private_key=from_private_key(self.private_key),
                                       public_key=self.public_key,
-                                      balance=self.balance,
-                                      balanceAKTA=self.balanceAKTA,
+                                      balances=", ".join(balances + [f"{self.balance} Algos"]),
                                       qr_code_link=self.qrcode)
 
 class User:
@@ -139,60 +181,66 @@ class User:
             wallet = Wallet.generate()
             wallet.log(self)
 
+        wallet.user_id = self.user_id
         self.wallet = wallet
 
-    def send(self, other_user: "User", amount: float, note: str, message) -> Optional["Transaction"]:
+    def send(self, other_user: "User", amount: float, note: str, message, # pylint: disable=R0913
+             asset: Asset) -> Optional["Transaction"]:
         """
-        Send AKTAs to the targeted user
+        Send an asset to the targeted user
 
         Args:
             other_user:
             amount:
             note:
             event:
+            asset: the asset to send
         Returns:
             trsctn: the Transaction instance representing the transaction that was sent
         """
-        trsctn = TipTransaction(self, other_user, amount, note, message)
+        trsctn = TipTransaction(self, other_user, amount, note, message, asset)
         trsctn.validate()
         trsctn.send()
         return trsctn
     
-    def withdraw(self, amount: float, address: str, note: str, message, isAlgo) -> Optional["Transaction"]:
+    def withdraw(self, amount: float, address: str, note: str, message, # pylint: disable=R0913
+                 asset: Asset) -> Optional["Transaction"]:
         """
-        Withdraw AKTAs to the targeted address
+        Withdraw an asset to the targeted address
 
         Args:
             amount:
             address:
             note:
+            asset: the asset to withdraw, ALGO for Algos
         Returns:
             trsctn: the Transaction  instance representing the transaction that was sent
         """
-        trsctn = WithdrawTransaction(self, address, amount, note, message, isAlgo)
+        trsctn = WithdrawTransaction(self, address, amount, note, message, asset)
         trsctn.validate()
         trsctn.send()
         return trsctn
 
-    def optin(self, message) -> Optional["Transaction"]:
+    def optin(self, message, asset: Asset) -> Optional["Transaction"]:
         """
-        Optin AKTAs to the targeted address
+        Optin the wallet of the user to an asset
 
         Args:
             message:
+            asset: the asset to opt in
         Returns:
             trsctn: the Transaction  instance representing the transaction that was sent
         """
-        trsctn = OptInTransaction(self, message)
+        trsctn = OptInTransaction(self, message, asset)
         trsctn.validate()
         trsctn.send()
         return trsctn
 
     def log(self):
         """
-        Log the user creation in the console and save it in the DB
+        Log the user creation and save it in the DB
         """
-        console.log(f"New user : {self.name} (#{self.user_id})")
+        logger.info("New user", user=self.name, user_id=self.user_id)
         save_user(self.name, self.user_id)
 
 
@@ -201,6 +249,8 @@ class Transaction(ABC):
     Abstract class to define the methods required for a
     transaction
     """
+    internal = False # True when the transaction was settled on the internal ledger
+
     @abstractmethod
     def validate(self) -> bool: # pylint: disable=C0116
         pass
@@ -210,16 +260,20 @@ class Transaction(ABC):
         pass
 
     @abstractmethod
-    def confirmed(self) -> bool: # pylint: disable=C0116
+    def pending(self) -> PendingTransaction: # pylint: disable=C0116
         pass
 
-    @abstractmethod
-    def send_confirmation(self) -> None: # pylint: disable=C0116
-        pass
+    def send_confirmation(self) -> None:
+        """
+        Send a message to confirm the sender of the transaction confirmation
+        """
+        self.pending().send_confirmation()
 
-    @abstractmethod
-    def log(self) -> None: # pylint: disable=C0116
-        pass
+    def log(self) -> None:
+        """
+        Log the confirmation of the transaction
+        """
+        self.pending().log()
 
     @abstractmethod
     def __hash__(self) -> int: # pylint: disable=C0116
@@ -233,6 +287,7 @@ class OptInTransaction(Transaction): # pylint: disable=R0902
     """
     sender: "User"
     reddit_message: "praw.models.Message"
+    asset: Asset
     tx_id: str = None
     fee: float = None
     time: int = None
@@ -243,7 +298,7 @@ class OptInTransaction(Transaction): # pylint: disable=R0902
         Check that the transaction is valid, otherwise raise
         a custom error indicating the issue.
         """
-        if self.sender.wallet.balanceAKTA != "not opt-in":
+        if self.sender.wallet.opted_in(self.asset):
            raise AlreadyOptedInError()
         self.params = algod.suggested_params()
         self.fee = float(microalgos_to_algos(self.params.min_fee))
@@ -271,9 +326,9 @@ class OptInTransaction(Transaction): # pylint: disable=R0902
                                     params.last,
                                     params.gh,
                                     self.sender.wallet.public_key,
-                                    algos_to_microalgos(0.0),
+                                    0,
                                     flat_fee=True,
-                                    index=AKTA_ID)
+                                    index=self.asset.asset_id)
 
         signed_txn = txn.sign(self.sender.wallet.private_key)
 
@@ -281,27 +336,17 @@ class OptInTransaction(Transaction): # pylint: disable=R0902
         self.time = time_ns() * 1e-6
         self.tx_id = signed_txn.transaction.get_txid()
 
-        console.log(f"Transaction #{self.tx_id} opted in AKTA")
-    def confirmed(self) -> bool:
-        """
-        Checks if the transaction has been confirmed
-        Returns:
-            Bool:
-                True if the transaction is confirmed
-                False otherwise
-        """
-        txinfo = algod.pending_transaction_info(self.tx_id)
-        return txinfo.get('confirmed-round') and txinfo.get('confirmed-round') > 0
-    def send_confirmation(self) -> None:
-        """
-        Send a message to confirm the sender of the transaction confirmation
-        """
-        self.reddit_message.reply(OPT_IN)
-    def log(self) -> None:
+        queue_transaction("optin", self.sender.user_id, self.sender.user_id, self.sender.wallet.public_key,
+                          0, self.asset.asset_id, self.tx_id, None, self.params.first, self.params.last)
+
+        logger.info("Opt-in sent", tx_id=self.tx_id, sender=self.sender.name, asset=self.asset.unit_name)
+    def pending(self) -> PendingTransaction:
         """
-        Log the transaction
+        Returns the compact record of the transaction, kept until its confirmation
         """
-        console.log(f"OptInTransaction #{self.tx_id} confirmed")
+        return PendingTransaction(self.tx_id, "optin", 0, self.asset.asset_id, self.reddit_message.fullname,
+                                  self.sender.user_id, self.sender.user_id, self.sender.name,
+                                  self.sender.wallet.public_key)
 
     def __hash__(self) -> int:
         return hash(self.tx_id)
@@ -316,6 +361,7 @@ class TipTransaction(Transaction): # pylint: disable=R0902
     amount: float
     message: str
     reddit_message: "praw.models.Message"
+    asset: Asset
     tx_id: str = None
     fee: float = None
     time: int = None
@@ -326,24 +372,24 @@ class TipTransaction(Transaction): # pylint: disable=R0902
         Check that the transaction is valid, otherwise raise
         a custom error indicating the issue.
         """
-        if self.sender.wallet.balanceAKTA == "not opt-in":
+        if not self.sender.wallet.opted_in(self.asset):
            raise UserNotOptedInError()
-        if self.receiver.wallet.balanceAKTA == "not opt-in":
+        if not self.receiver.wallet.opted_in(self.asset):
            raise ReceiverNotOptedInError()
 
         self.params = algod.suggested_params()
         self.fee = float(microalgos_to_algos(self.params.min_fee))
 
-        if self.amount < 1e-6:
+        if self.asset.to_units(self.amount) < 1:
             raise ZeroTransactionError
 
         if (self.fee + 0.2) > self.sender.wallet.balance:
             raise InsufficientFundsError(self.amount,
                                          self.sender.wallet.balance)
 
-        if (self.amount + 0.2) > self.sender.wallet.balanceAKTA:
+        if self.amount > self.sender.wallet.balance_of(self.asset):
             raise InsufficientFundsError(self.amount,
-                                         self.sender.wallet.balanceAKTA)
+                                         self.sender.wallet.balance_of(self.asset))
 
         if self.receiver.wallet.balance == 0 and self.amount < 0.1:
             raise FirstTransactionError(self.amount)
@@ -357,6 +403,10 @@ class TipTransaction(Transaction): # pylint: disable=R0902
             Transaction: returns itself if the transaction was successfully
                          None otherwise
         """
+        if INTERNAL_TRANSFERS:
+            self.send_internal()
+            return
+
         params = self.params
         txn = transaction.AssetTransferTxn(self.sender.wallet.public_key,
                                     0.001,
@@ -364,42 +414,49 @@ class TipTransaction(Transaction): # pylint: disable=R0902
                                     params.last,
                                     params.gh,
                                     self.receiver.wallet.public_key,
-                                    algos_to_microalgos(self.amount),
-                                    AKTA_ID,
+                                    self.asset.to_units(self.amount),
+                                    self.asset.asset_id,
                                     note=str.encode(self.message))
 
         signed_txn = txn.sign(self.sender.wallet.private_key)
+        # Read before sending: nothing may run out of the event budget once the transaction is sent
+        subreddit = getattr(self.reddit_message, "subreddit", None)
 
         algod.send_transaction(signed_txn)
         self.time = time_ns() * 1e-6
         self.tx_id = signed_txn.transaction.get_txid()
 
-        console.log(f"Transaction #{self.tx_id} sent by {self.sender.name} to {self.receiver.name}")
+        queue_transaction("tip", self.sender.user_id, self.receiver.user_id, self.receiver.wallet.public_key,
+                          self.asset.to_units(self.amount), self.asset.asset_id, self.tx_id,
+                          str(subreddit) if subreddit else None, self.params.first, self.params.last)
 
-    def confirmed(self) -> bool:
-        """
-        Returns a boolean indicating whether or not the
-        transaction is confirmed
-        """
-        txinfo = algod.pending_transaction_info(self.tx_id)
-        return txinfo.get('confirmed-round') and txinfo.get('confirmed-round') > 0
+        logger.info("Tip sent", tx_id=self.tx_id, sender=self.sender.name, receiver=self.receiver.name,
+                    amount=self.amount, asset=self.asset.unit_name)
 
-
-    def send_confirmation(self) -> None:
+    def send_internal(self) -> None:
         """
-        Send a message to confirm the sender of the transaction confirmation
+        Moves the tip on the internal ledger, it is confirmed right away
+        and settled on chain with the next settlement
         """
-        self.reddit_message.reply(TRANSACTION_CONFIRMATION.substitute(
-                                amount=self.amount,
-                                receiver=self.receiver.name,
-                                transaction_id=self.tx_id)
-        )
+        subreddit = getattr(self.reddit_message, "subreddit", None)
+        self.time = time_ns() * 1e-6
+        self.internal = True
+        transaction_id = transfer(self.sender.user_id, self.receiver.user_id, self.receiver.wallet.public_key,
+                                  self.asset.to_units(self.amount), self.asset.asset_id,
+                                  str(subreddit) if subreddit else None, self.reddit_message.fullname)
 
-    def log(self) -> None:
+        logger.info("Tip moved on the internal ledger", transaction_id=transaction_id, sender=self.sender.name,
+                    receiver=self.receiver.name, amount=self.amount, asset=self.asset.unit_name)
+
+    def pending(self) -> PendingTransaction:
         """
-        Log the transaction
+        Returns the compact record of the transaction, kept until its confirmation
         """
-        console.log(f"TipTransaction #{self.tx_id} confirmed")
+        subreddit = getattr(self.reddit_message, "subreddit", None)
+        return PendingTransaction(self.tx_id, "tip", self.asset.to_units(self.amount), self.asset.asset_id,
+                                  self.reddit_message.fullname, self.sender.user_id, self.receiver.user_id,
+                                  self.receiver.name, self.receiver.wallet.public_key,
+                                  str(subreddit) if subreddit else None, self.internal)
 
     def __hash__(self) -> int:
         return hash(self.tx_id)
@@ -416,7 +473,7 @@ class WithdrawTransaction(Transaction): # pylint: disable=R0902
     amount: float
     message: str
     reddit_message: "praw.models.Message"
-    isAlgo: bool
+    asset: Asset
     tx_id: str = None
     close_account: bool = False
     fee: float = None
@@ -428,96 +485,68 @@ class WithdrawTransaction(Transaction): # pylint: disable=R0902
         Chech that the transaction is valid, otherwise raise an error
         that indicates the type of issue
         """
-        print(Wallet("", self.destination).balanceAKTA)
-        if self.isAlgo == False and Wallet("", self.destination).balanceAKTA == "not opt-in":
-            raise ReceiverNotOptedInError() 
+        destination = Wallet("", self.destination)
+        if not self.asset.is_algo and not destination.opted_in(self.asset):
+            raise ReceiverNotOptedInError()
+
+        # The tips received on the internal ledger can only be withdrawn once they are settled on chain
+        balance = self.sender.wallet.balance_of(self.asset)
+        if balance is None:
+            raise UserNotOptedInError()
+        balance = min(balance, self.sender.wallet.balance_of(self.asset, on_chain=True))
 
         self.params = algod.suggested_params()
         self.fee = float(microalgos_to_algos(self.params.min_fee))
 
-        self.amount = self.sender.wallet.balance if self.amount == "all" else float(self.amount)
-        self.close_account = (self.amount == self.sender.wallet.balance)
+        self.amount = balance if self.amount == "all" else float(self.amount)
+        self.close_account = self.asset.is_algo and (self.amount == balance)
 
         if self.close_account:
             self.amount = self.amount - self.fee
 
-        if self.amount < 1e-6:
+        if self.asset.to_units(self.amount) < 1:
             raise ZeroTransactionError
 
         if (self.fee + (int(not self.close_account)*0.2)) > self.sender.wallet.balance:
             raise InsufficientFundsError(self.amount, self.sender.wallet.balance)
 
-        if (self.amount + (int(not self.close_account)*0.2)) > self.sender.wallet.balanceAKTA:
-            raise InsufficientFundsError(self.amount, self.sender.wallet.balanceAKTA)
+        needed = self.amount + self.fee + (int(not self.close_account)*0.2) if self.asset.is_algo else self.amount
+        if self.asset.to_units(needed) > self.asset.to_units(balance):
+            raise InsufficientFundsError(self.amount, balance)
 
-        if Wallet("", self.destination).balance == 0 and self.amount < 0.1:
+        if destination.balance == 0 and self.amount < 0.1:
             raise FirstTransactionError(self.amount)
 
     def send(self) -> "WithdrawTransaction":
         """
         Send the transaction with the parameters given during initialization of the class
+        It is built and signed by the signing pipeline, the key of the sender never leaves its workers
         Gets the db tx id to preserve creation order
         """
-        params = self.params
-        if self.isAlgo:
-         txn = transaction.PaymentTxn(self.sender.wallet.public_key,
-                                     params.min_fee,
-                                     params.first,
-                                     params.last,
-                                     params.gh,
-                                     self.destination,
-                                     algos_to_microalgos(self.amount),
-                                     note=str.encode(self.message),
-                                     close_remainder_to=None if not self.close_account else self.destination,
-                                     flat_fee=True)
-        else:
-         txn = transaction.AssetTransferTxn(self.sender.wallet.public_key,
-                                    0.001,
-                                    params.first,
-                                    params.last,
-                                    params.gh,
-                                    self.destination,
-                                    algos_to_microalgos(self.amount),
-                                    AKTA_ID)
-
-        signed_txn = txn.sign(self.sender.wallet.private_key)
+        transfer = Transfer(self.sender.user_id, self.destination, self.asset.to_units(self.amount),
+                            self.asset.asset_id, str.encode(self.message),
+                            self.destination if self.close_account else None)
+        signed_group = next(signing_pipeline.sign([[transfer]], self.params))
 
-        algod.send_transaction(signed_txn)
+        algod.send_raw_transaction(signed_group.blob)
         self.time = time_ns() * 1e-6
-        self.tx_id = signed_txn.transaction.get_txid()
-
-        console.log(f"Withdrawal #{self.tx_id} sent by {self.sender.name}")
+        self.tx_id = signed_group.tx_ids[0]
 
-    def confirmed(self) -> bool:
-        """
-        Checks if the transaction has been confirmed
-        Returns:
-            Bool:
-                True if the transaction is confirmed
-                False otherwise
-        """
-        txinfo = algod.pending_transaction_info(self.tx_id)
-        return txinfo.get('confirmed-round') and txinfo.get('confirmed-round') > 0
+        queue_transaction("algowithdraw" if self.asset.is_algo else "withdraw", self.sender.user_id, None,
+                          self.destination, self.asset.to_units(self.amount), self.asset.asset_id,
+                          self.tx_id, None, self.params.first, self.params.last)
 
-    def send_confirmation(self) -> None:
-        """
-        Sends a message to the Reddit user to confirm the withdrawal,
-        and give a link to AlgoExplorer to have a proof of transaction
-        """
-        if self.isAlgo:
-          self.reddit_message.reply(WITHDRAWAL_ALGO_CONFIRMATION.substitute(amount=self.amount,
-                                                               address=self.destination,
-                                                               transaction_id=self.tx_id))
-        else:
-          self.reddit_message.reply(WITHDRAWAL_CONFIRMATION.substitute(amount=self.amount,
-                                                               address=self.destination,
-                                                               transaction_id=self.tx_id))
+        logger.info("Withdrawal sent", tx_id=self.tx_id, sender=self.sender.name, amount=self.amount,
+                    asset=self.asset.unit_name)
 
-    def log(self) -> None:
+    def pending(self) -> PendingTransaction:
         """
-        Logs the confirmation of the withdrawal to the console
+        Returns the compact record of the withdrawal, kept until its confirmation
         """
-        console.log(f"Withdrawal #{self.tx_id} confirmed")
+        return PendingTransaction(self.tx_id, "algowithdraw" if self.asset.is_algo else "withdraw",
+                                  self.asset.to_units(self.amount), self.asset.asset_id,
+                                  self.reddit_message.fullname, self.sender.user_id,
+                                  destination=self.destination)
 
     def __hash__(self) -> int:
         """
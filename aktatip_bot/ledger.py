@@ -0,0 +1,317 @@
+"""
+File containing the internal ledger, used to settle the tips between
+the wallets of the bot without waiting for the blockchain
+
+Every tip is written as two entries of a double-entry journal, a debit
+of the sender and a credit of the receiver, and the net position of each
+user is kept up to date in the same commit. The positions are settled on
+chain periodically, with as few transfers as possible, sent in atomic groups
+signed by the signing pipeline. The entries of a settlement only count in the positions once it is confirmed.
+Payers whose wallets can't cover their transfers and the network fees are left out of
+a settlement, and the transfers of a group rejected by the node are sent again one by one,
+so that a single payer never blocks the others. The fees are written as entries of the
+payers, debited from their available balances while the settlement is pending.
+"""
+
+from collections import defaultdict
+from functools import partial
+from time import time
+from typing import Dict, List, Set, Tuple
+
+from algosdk.error import AlgodHTTPError
+
+from clients import algod, db
+from errors import PoolError
+from indexer import block_indexer
+from logs import logger
+from signing import SignedGroup, signing_pipeline, Transfer
+from utils import get_public_keys, SUBMITTED
+
+INTERNAL_TRANSFERS = False # Settle the tips between users of the bot on the internal ledger
+SETTLEMENT_INTERVAL = 600 # Seconds between two settlements of the positions
+GROUP_SIZE = 16 # Maximum number of transactions in an atomic group
+MIN_BALANCE = 100000 # Microalgos an account has to keep, plus as much per opted-in asset
+
+PENDING = "pending"
+CONFIRMED = "confirmed"
+FAILED = "failed"
+
+TRANSFER = "transfer" # Kinds of the ledger entries
+FEE = "fee" # Already paid on chain once confirmed, never applied to the positions
+
+UPSERT_POSITION = """
+    INSERT INTO ledger_positions (user_id, asset_id, amount) VALUES (?, ?, ?)
+    ON CONFLICT (user_id, asset_id) DO UPDATE SET amount = amount + excluded.amount
+"""
+
+def write_transfer(connection, sender_id, receiver_id, destination, amount, asset_id, subreddit, # pylint: disable=R0913
+                   now) -> int:
+    """
+    Writes a transfer on the internal ledger, as part of the transaction of the given connection
+
+    Returns:
+        int: the id of the transaction in the transactions table
+    """
+    transaction_id = connection.execute(
+        "INSERT INTO transactions (kind, sender_id, receiver_id, destination, amount, asset_id, "
+        "tx_id, subreddit, created_at, confirmed_at) VALUES ('tip', ?, ?, ?, ?, ?, NULL, ?, ?, ?)",
+        (sender_id, receiver_id, destination, amount, asset_id, subreddit, now, now)).lastrowid
+    connection.executemany("INSERT INTO ledger_entries (transaction_id, settlement_id, user_id, asset_id, "
+                           "amount, created_at) VALUES (?, NULL, ?, ?, ?, ?)",
+                           [(transaction_id, sender_id, asset_id, -amount, now),
+                            (transaction_id, receiver_id, asset_id, amount, now)])
+    connection.executemany(UPSERT_POSITION, [(sender_id, asset_id, -amount), (receiver_id, asset_id, amount)])
+    return transaction_id
+
+def transfer(sender_id, receiver_id, destination, amount, asset_id, subreddit, fullname) -> int: # pylint: disable=R0913
+    """
+    Moves an amount between two users on the internal ledger
+    The transaction, its entries, the positions and the state of the event are saved in a single commit,
+    so that the event can never be handled twice
+
+    Args:
+        sender_id: user id of the sender
+        receiver_id: user id of the receiver
+        destination: address of the receiver
+        amount: amount moved, in the base unit of the asset
+        asset_id: id of the asset moved
+        subreddit: subreddit the tip was sent from, None for messages
+        fullname: reddit fullname of the event of the tip
+    Returns:
+        int: the id of the transaction in the transactions table
+    """
+    now = int(time())
+    def write(connection):
+        transaction_id = write_transfer(connection, sender_id, receiver_id, destination, amount, asset_id,
+                                        subreddit, now)
+        connection.execute("INSERT OR REPLACE INTO events VALUES (?, ?, NULL, ?)", (fullname, SUBMITTED, now))
+        return transaction_id
+    return db.run(write).result()
+
+def unsettled_amounts(user_id: int) -> Dict[int, int]:
+    """
+    Returns what the on-chain balances of a user are missing to give their available balances
+    The debits of the pending settlements are counted, their credits are not until they are
+    confirmed, so that a settlement confirmed on chain but not yet seen is never counted twice
+
+    Returns:
+        dict: amounts in the base unit of each asset, keyed by asset id
+    """
+    query = """
+        SELECT asset_id, SUM(amount) FROM (
+            SELECT asset_id, amount FROM ledger_positions WHERE user_id = ?
+            UNION ALL
+            SELECT e.asset_id, e.amount FROM settlements s JOIN ledger_entries e ON e.settlement_id = s.id
+            WHERE s.state = ? AND e.user_id = ? AND e.amount < 0
+        ) GROUP BY asset_id
+    """
+    return dict(db.read(query, (user_id, PENDING, user_id)))
+
+def net_transfers(positions: List[Tuple[int, int]]) -> List[Tuple[int, int, int]]:
+    """
+    Matches the users owing an asset with the users owed it, largest positions first,
+    which takes at most one transfer less than the number of users
+
+    Args:
+        positions: (user_id, amount) tuples of a single asset, summing to 0
+    Returns:
+        list: (payer_id, receiver_id, amount) tuples
+    """
+    payers = sorted([[amount, user_id] for user_id, amount in positions if amount < 0])
+    receivers = sorted([[-amount, user_id] for user_id, amount in positions if amount > 0])
+    transfers = []
+    while payers and receivers:
+        payer, receiver = payers[0], receivers[0]
+        amount = min(-payer[0], -receiver[0])
+        transfers.append((payer[1], receiver[1], amount))
+        payer[0] += amount
+        receiver[0] += amount
+        if payer[0] == 0:
+            payers.pop(0)
+        if receiver[0] == 0:
+            receivers.pop(0)
+    return transfers
+
+def spendable_funds(user_ids) -> Dict[int, Dict[int, int]]:
+    """
+    Returns what the wallets of the given users can send, with one account_info call per wallet
+    The Algos exclude the minimum balance of the account, a wallet that can't be read can send nothing
+
+    Returns:
+        dict: amounts in the base unit of each asset keyed by asset id, keyed by user id
+    """
+    funds = {}
+    for user_id, address in get_public_keys(user_ids).items():
+        try:
+            account_info = algod.account_info(address)
+        except Exception as e: # pylint: disable=W0703, C0103
+            logger.warning("Payer balance unavailable", user_id=user_id, error=repr(e))
+            continue
+        holdings = account_info.get("assets", [])
+        funds[user_id] = {held["asset-id"]: held["amount"] for held in holdings}
+        funds[user_id][0] = account_info["amount"] - MIN_BALANCE * (1 + len(holdings))
+    return funds
+
+def plan_transfers(positions: Dict[int, List[Tuple[int, int]]],
+                   fee: int) -> Tuple[Dict[int, List[Tuple[int, int, int]]], Set[int]]:
+    """
+    Nets the positions of every asset, leaving out the payers whose wallets can't cover
+    their transfers and the fee of each of them, until every payer left can pay
+
+    Args:
+        positions: (user_id, amount) tuples keyed by asset id
+        fee: fee of a transfer, in microalgos
+    Returns:
+        tuple: the (payer_id, receiver_id, amount) transfers keyed by asset id, and the payers left out
+    """
+    payer_ids = {user_id for asset_positions in positions.values() for user_id, amount in asset_positions if amount < 0}
+    funds = spendable_funds(payer_ids) if payer_ids else {}
+    left_out = set()
+    while True:
+        transfers = {asset_id: net_transfers([(user_id, amount) for user_id, amount in asset_positions
+                                              if user_id not in left_out])
+                     for asset_id, asset_positions in positions.items()}
+        needs = defaultdict(lambda: defaultdict(int))
+        for asset_id, asset_transfers in transfers.items():
+            for payer_id, _, amount in asset_transfers:
+                needs[payer_id][asset_id] += amount
+                needs[payer_id][0] += fee
+        underfunded = {payer_id for payer_id, need in needs.items()
+                       if any(amount > funds.get(payer_id, {}).get(asset_id, 0) for asset_id, amount in need.items())}
+        if not underfunded:
+            return transfers, left_out
+        left_out |= underfunded
+
+def settle() -> None:
+    """
+    Settles the positions on chain, if the previous settlement is over
+    """
+    if db.read_one("SELECT 1 FROM settlements WHERE state = ? LIMIT 1", (PENDING, )):
+        return
+
+    positions = defaultdict(list)
+    for user_id, asset_id, amount in db.read("SELECT user_id, asset_id, amount FROM ledger_positions "
+                                             "WHERE amount != 0"):
+        positions[asset_id].append((user_id, amount))
+    if not positions:
+        return
+
+    params = algod.suggested_params()
+    transfers, left_out = plan_transfers(positions, params.min_fee)
+    if left_out:
+        logger.warning("Payers left out of the settlement", user_ids=sorted(left_out))
+    groups = []
+    for asset_id, asset_transfers in transfers.items():
+        groups.extend((asset_id, asset_transfers[start:start + GROUP_SIZE])
+                      for start in range(0, len(asset_transfers), GROUP_SIZE))
+    rejected = send_groups(groups, params)
+    if rejected: # Sent again one transfer per group, so that only the failing payers fail
+        send_groups([(asset_id, [transfer]) for asset_id, transfers in rejected for transfer in transfers
+                     if len(transfers) > 1], params)
+
+def send_groups(groups: List[Tuple[int, list]], params) -> List[Tuple[int, list]]:
+    """
+    Signs the groups in a single stream of the signing pipeline and sends them
+
+    Returns:
+        list: the groups rejected by the node
+    """
+    if not groups:
+        return []
+    addresses = get_public_keys({receiver_id for _, transfers in groups for _, receiver_id, _ in transfers})
+    signed_groups = signing_pipeline.sign(([Transfer(payer_id, addresses[receiver_id], amount, asset_id)
+                                            for payer_id, receiver_id, amount in transfers]
+                                           for asset_id, transfers in groups), params)
+    return [(asset_id, transfers) for (asset_id, transfers), signed_group in zip(groups, signed_groups)
+            if not settle_group(asset_id, transfers, signed_group, params)]
+
+def settle_group(asset_id: int, transfers: List[Tuple[int, int, int]], signed_group: SignedGroup, params) -> bool:
+    """
+    Sends the transfers of a settlement as one atomic group
+    The settlement is saved before sending it, and only fails once its last valid round is over,
+    so that a group that may have reached the network is never sent again
+
+    Args:
+        asset_id: id of the asset settled, 0 for Algos
+        transfers: (payer_id, receiver_id, amount) tuples, at most GROUP_SIZE
+        signed_group: the transfers signed by the signing pipeline
+        params: suggested params the transfers were built with
+    Returns:
+        bool: False if the group was rejected by the node
+    """
+    tx_id = signed_group.tx_ids[0]
+
+    now = int(time())
+    def write(connection):
+        settlement_id = connection.execute(
+            "INSERT INTO settlements (asset_id, state, tx_id, first_round, last_round, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)", (asset_id, PENDING, tx_id, params.first, params.last, now)).lastrowid
+        entries = []
+        for payer_id, receiver_id, amount in transfers:
+            entries.append((settlement_id, payer_id, asset_id, amount, now, TRANSFER))
+            entries.append((settlement_id, receiver_id, asset_id, -amount, now, TRANSFER))
+            entries.append((settlement_id, payer_id, 0, -params.min_fee, now, FEE))
+        connection.executemany("INSERT INTO ledger_entries (transaction_id, settlement_id, user_id, asset_id, "
+                               "amount, created_at, kind) VALUES (NULL, ?, ?, ?, ?, ?, ?)", entries)
+        return settlement_id
+    settlement_id = db.run(write).result()
+
+    try:
+        algod.send_raw_transaction(signed_group.blob)
+    except AlgodHTTPError as e: # pylint: disable=C0103
+        if (e.code or 500) < 500: # Rejected by the node, it will never be confirmed
+            settlement_failed(settlement_id, e)
+            return False
+        logger.warning("Settlement sending failed", settlement_id=settlement_id, error=repr(e))
+    except Exception as e: # pylint: disable=W0703, C0103
+        # The group may have reached the network, it fails once its last valid round is over
+        logger.warning("Settlement sending failed", settlement_id=settlement_id, error=repr(e))
+    logger.info("Settlement sent", settlement_id=settlement_id, tx_id=tx_id, asset_id=asset_id,
+                transfers=len(transfers))
+    watch_settlement(settlement_id, tx_id, params.last)
+    return True
+
+def watch_settlement(settlement_id: int, tx_id: str, last_round: int) -> None:
+    """
+    Waits for the confirmation of a settlement until its last valid round
+    """
+    block_indexer.wait(tx_id, timeout_round=last_round).add_done_callback(
+        partial(settlement_done, settlement_id))
+
+def settlement_done(settlement_id: int, future) -> None:
+    """
+    Callback of the futures of the settlements, applying the entries
+    of a confirmed settlement to the positions
+    """
+    try:
+        confirmed_round = future.result()
+    except (PoolError, TimeoutError) as e: # pylint: disable=C0103
+        settlement_failed(settlement_id, e)
+        return
+    def write(connection):
+        entries = connection.execute("SELECT user_id, asset_id, amount FROM ledger_entries "
+                                     "WHERE settlement_id = ? AND kind != ?", (settlement_id, FEE)).fetchall()
+        connection.executemany(UPSERT_POSITION, entries)
+        connection.execute("UPDATE settlements SET state = ?, confirmed_round = ? WHERE id = ?",
+                           (CONFIRMED, confirmed_round, settlement_id))
+    db.run(write).result()
+    logger.info("Settlement confirmed", settlement_id=settlement_id, round=confirmed_round)
+
+def settlement_failed(settlement_id: int, error: Exception) -> None:
+    """
+    Marks a settlement as failed, its entries are then ignored and
+    the positions are settled again by the next settlement
+    """
+    db.write("UPDATE settlements SET state = ? WHERE id = ?", (FAILED, settlement_id)).result()
+    logger.error("Settlement failed", settlement_id=settlement_id, error=repr(error))
+
+def resume_settlements() -> None:
+    """
+    Waits again for the settlements left pending by the previous run,
+    from the first round they could be confirmed in
+    """
+    for settlement_id, tx_id, first_round, last_round in db.read(
+            "SELECT id, tx_id, first_round, last_round FROM settlements WHERE state = ?", (PENDING, )):
+        block_indexer.rescan_from(first_round)
+        watch_settlement(settlement_id, tx_id, last_round)
+        logger.info("Resuming settlement", settlement_id=settlement_id, tx_id=tx_id)
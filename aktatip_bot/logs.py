@@ -0,0 +1,134 @@
+"""
+File containing the structured logger of the bot
+Records are JSON lines put on a bounded queue and written by a background
+thread, so the thread handling the events never waits on the disk or the terminal.
+The rich console is only used to render the records in interactive mode.
+"""
+
+import json
+import sys
+import threading
+from queue import Empty, Full, Queue
+from time import localtime, monotonic, strftime, time
+from typing import Dict
+
+from clients import console
+
+LOG_FILE = "aktatip.jsonl"
+LOG_LEVEL = "INFO"
+QUEUE_SIZE = 10000
+INTERACTIVE = sys.stdout.isatty()
+# Only one record out of N is kept for these high-volume messages, the kept ones carry the rate
+SAMPLE_RATES: Dict[str, int] = {"Event received": 10, "Wallet information sent": 10}
+STATS_INTERVAL = 600 # Seconds between two records of the counters of the logger
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+
+class Logger:
+    """
+    Class queuing the log records for the writer thread
+    """
+    def __init__(self, path: str = LOG_FILE, level: str = LOG_LEVEL, # pylint: disable=R0913
+                 queue_size: int = QUEUE_SIZE, interactive: bool = INTERACTIVE,
+                 sample_rates: Dict[str, int] = None) -> None:
+        self.path, self.interactive = path, interactive
+        self.level = LEVELS[level]
+        self.sample_rates = SAMPLE_RATES if sample_rates is None else sample_rates
+        self.seen: Dict[str, int] = {}
+        self.dropped = 0 # Records lost because the queue was full
+        self.sampled_out = 0
+        self.last_stats = monotonic()
+        self.queue: Queue = Queue(maxsize=queue_size)
+        self.writer = threading.Thread(target=self.write, daemon=True)
+        self.writer.start()
+
+    def log(self, level: str, message: str, **fields) -> None:
+        """
+        Queues a record, never blocks
+        Records under the logger level, skipped by the sampling or arriving
+        while the queue is full are dropped
+
+        Args:
+            level: DEBUG, INFO, WARNING or ERROR
+            message: constant message, used as the sampling key
+            fields: additional JSON serializable values (event_id, tx_id, ...)
+        """
+        if LEVELS[level] < self.level:
+            return
+        rate = self.sample_rates.get(message, 1)
+        if rate > 1:
+            self.seen[message] = seen = self.seen.get(message, 0) + 1
+            if seen % rate != 1:
+                self.sampled_out += 1
+                return
+            fields["sample_rate"] = rate
+        try:
+            self.queue.put_nowait(dict(ts=time(), level=level, msg=message, **fields))
+        except Full:
+            self.dropped += 1
+
+    def debug(self, message: str, **fields) -> None: # pylint: disable=C0116
+        self.log("DEBUG", message, **fields)
+
+    def info(self, message: str, **fields) -> None: # pylint: disable=C0116
+        self.log("INFO", message, **fields)
+
+    def warning(self, message: str, **fields) -> None: # pylint: disable=C0116
+        self.log("WARNING", message, **fields)
+
+    def error(self, message: str, **fields) -> None: # pylint: disable=C0116
+        self.log("ERROR", message, **fields)
+
+    def write(self) -> None:
+        """
+        Loop of the writer thread, the file is flushed whenever the queue is empty
+        """
+        with open(self.path, "a") as log_file:
+            while True:
+                try:
+                    record = self.queue.get(timeout=1)
+                except Empty:
+                    log_file.flush()
+                    continue
+                if record is None:
+                    break
+                log_file.write(json.dumps(record, default=str) + "\n")
+                if self.interactive:
+                    self.render(record)
+                self.queue.task_done()
+                if self.queue.empty():
+                    log_file.flush()
+
+    @staticmethod
+    def render(record: dict) -> None:
+        """
+        Prints a record in a human readable way on the rich console
+        """
+        fields = " ".join(f"{key}={value}" for key, value in record.items()
+                          if key not in ("ts", "level", "msg"))
+        console.print(f"[{strftime('%X', localtime(record['ts']))}] {record['msg']} {fields}",
+                      style={"WARNING": "yellow", "ERROR": "bold red"}.get(record["level"]),
+                      markup=False, highlight=False)
+
+    def log_stats(self) -> None:
+        """
+        Records the counters of the logger every STATS_INTERVAL seconds
+        """
+        now = monotonic()
+        if now - self.last_stats < STATS_INTERVAL:
+            return
+        self.last_stats = now
+        self.info("Logger", dropped=self.dropped, sampled_out=self.sampled_out, queue_depth=self.queue.qsize())
+
+    def close(self) -> None:
+        """
+        Writes the remaining records and stops the writer thread
+        """
+        if not self.writer.is_alive():
+            return
+        if self.dropped:
+            self.queue.put(dict(ts=time(), level="WARNING", msg="Logger", dropped=self.dropped))
+        self.queue.put(None)
+        self.writer.join()
+
+logger = Logger()
@@ -2,36 +2,149 @@
 File containing the main loop
 """
 
+# The signing workers are forked first, while the process has no other thread:
+# the modules imported next start the threads of the database, the logger and algod
+from signing import signing_pipeline
+signing_pipeline.start()
+
+# pylint: disable=C0413
 import traceback
-from time import sleep
+from time import time
+
+from praw.models.reddit.message import Message
 
-from clients import console, reddit
-from errors import (InvalidCommandError, InvalidUserError)
+from admission import AdmissionController, DEFERRED, DROPPED, DUPLICATE, INVALID, QUEUED, STATS_INTERVAL
+from clients import reddit, traffic
+from deadline import EventDeadlines
+from errors import (DeadlineExceededError, InvalidCommandError, InvalidUserError)
 from handlers import EventHandler
-from templates import (INVALID_COMMAND, USER_NOT_FOUND)
-from utils import stream
+from indexer import block_indexer
+from ledger import SETTLEMENT_INTERVAL, resume_settlements, settle
+from logs import logger
+from pending import PendingTransaction
+from profiler import profiler
+from rain import advance as advance_rains, resume_rains
+from stats import SUMMARY_POST_INTERVAL, post_summaries
+from templates import (EVENT_TIMED_OUT, INVALID_COMMAND, SLOW_DOWN, USER_NOT_FOUND)
+from utils import (flush_transactions, get_event_states, get_submitted_transactions, get_unfinished_events,
+                   init_db, save_failed_event, save_finished_event, save_received_events, stream,
+                   RECEIVED, SUBMITTED, SUBREDDITS)
 
 event_handler = EventHandler()
+admission = AdmissionController()
+deadlines = EventDeadlines()
+
+def resume_events() -> set:
+    """
+    Looks for the events left unfinished by the previous run, with a single indexed query
+    Received comments are fetched again to be handled, received messages are still unread
+    and come back with the stream. Submitted events already had their transaction sent,
+    so their transaction is watched again instead of risking a second one, and the blocks
+    from its first valid round are processed again in case it was confirmed in the meantime:
+    the event is finished by the main loop once the transaction is confirmed or failed. Rains are
+    resumed by resume_rains.
+
+    Returns:
+        set: the comments to handle again
+    """
+    comments, submitted = [], {}
+    for fullname, state, tx_id in get_unfinished_events():
+        if state == SUBMITTED and tx_id is not None:
+            submitted[tx_id] = fullname
+        elif state == RECEIVED and fullname.startswith("t1_"):
+            comments.append(fullname)
+
+    transactions = get_submitted_transactions(submitted)
+    for tx_id, fullname in submitted.items():
+        if tx_id not in transactions:
+            logger.error("Submitted event without a saved transaction", event_id=fullname, tx_id=tx_id)
+            continue
+        (kind, sender_id, receiver_id, receiver_name, destination, amount, asset_id,
+         subreddit, confirmed_round, first_round, last_round) = transactions[tx_id]
+        if confirmed_round is not None: # The confirmation was replied before the restart
+            save_finished_event(fullname, confirmed=True)
+            continue
+        if first_round is not None:
+            block_indexer.rescan_from(first_round)
+        block_indexer.resume_transaction(PendingTransaction(tx_id, kind, amount, asset_id, fullname, sender_id,
+                                                            receiver_id, receiver_name, destination, subreddit),
+                                         last_round)
+        logger.info("Resuming transaction sent before restart", event_id=fullname, tx_id=tx_id)
+
+    if not comments:
+        return set()
+    logger.info("Resuming events received before restart", event_ids=comments)
+    return traffic.events(lambda: set(reddit.info(fullnames=comments)))
+
+def finish(event) -> None:
+    """
+    Saves that the event was dealt with and marks it as read
+    """
+    save_finished_event(event.fullname)
+    traffic.call("reddit", "mark_read", reddit.inbox.mark_read, [event])
+    traffic.event_done(event)
 
 def main():
     """
     Function running the main loop of the bot
     """
     waiting = 0
+    last_summary = last_settlement = last_stats = time()
+    init_db()
+    profiler.install_signal_handler()
+    resume_settlements()
+    resume_rains()
+    resumed = resume_events()
 
-    console.log("Started successfully. Waiting for messages ...")
+    logger.info("Started successfully. Waiting for messages ...")
 
-    while True:
+    while not traffic.finished:
         if not waiting:
-            for transaction in event_handler.unconfirmed_transactions.copy():
-                if transaction.confirmed():
-                    transaction.send_confirmation()
-                    transaction.log()
-                    event_handler.unconfirmed_transactions.remove(transaction)
+            try:
+                transactions = block_indexer.advance()
+            except Exception: #pylint: disable=W0703
+                # The indexer resumes from its last processed round on the next tick
+                logger.error("Block indexer failed", traceback=traceback.format_exc())
+                transactions = []
+            for transaction in transactions:
+                transaction.send_confirmation()
+                if transaction.error is None:
+                    save_finished_event(transaction.fullname, confirmed=True)
+                else:
+                    save_failed_event(transaction.fullname)
+                transaction.log()
+
+        events, resumed = stream() | resumed, set()
+        states = get_event_states(event.fullname for event in events)
+        save_received_events(event.fullname for event in events if event.fullname not in states)
+        for event in events:
+            if states.get(event.fullname, RECEIVED) != RECEIVED: # Already handled, only mark it as read
+                traffic.call("reddit", "mark_read", reddit.inbox.mark_read, [event])
+                continue
+            if deadlines.is_parked(event.fullname): # Still unread, handled again once due
+                continue
+            outcome = admission.offer(event)
+            if outcome in (QUEUED, DUPLICATE, DEFERRED): # Deferred events stay received and unread
+                continue
+            if (outcome == DROPPED or outcome == INVALID and isinstance(event, Message)) and admission.should_reply(event):
+                event.reply(SLOW_DOWN if outcome == DROPPED else INVALID_COMMAND)
+            finish(event)
 
-        for event in stream():
+        admission.retry_deferred()
+
+        retried = deadlines.due_events()
+        states = get_event_states(event.fullname for event in retried)
+        retried = [event for event in retried if states.get(event.fullname, RECEIVED) == RECEIVED]
+        for event in admission.next_events() + retried:
             try:
-                event_handler.handle_event(event)
+                with deadlines.budget_of(event):
+                    event_handler.handle_event(event)
+            except DeadlineExceededError as e: # pylint: disable=C0103
+                if deadlines.park(event):
+                    logger.warning("Event parked after running out of budget", event_id=event.id, stage=e.stage)
+                    continue
+                event.reply(EVENT_TIMED_OUT)
+                logger.error("Event given up after running out of budget", event_id=event.id, stage=e.stage)
             except InvalidCommandError:
                 event.reply(INVALID_COMMAND)
             except InvalidUserError as e: # pylint: disable=C0103
@@ -39,14 +152,46 @@ def main():
             except Exception: #pylint: disable=W0703
                 event.reply("Hello, I'm sorry but an unknown issue occured when handling\n\n "
                                              f"***{event.body}*** \n\n Please contact u/RedSwoosh to have it resolved")
-                console.log("An unknown issue occured")
-                traceback.print_exc()
-            reddit.inbox.mark_read([event])
+                logger.error("An unknown issue occured", event_id=event.id, traceback=traceback.format_exc())
+            finish(event)
+
+        try:
+            advance_rains()
+        except Exception: #pylint: disable=W0703
+            # Every job catches its own errors, this only guards the query of the jobs
+            logger.error("Rain advance failed", traceback=traceback.format_exc())
+        flush_transactions()
+        admission.log_stats()
+        logger.log_stats()
+        profiler.tick()
+
+        if time() - last_stats > STATS_INTERVAL:
+            logger.info("Event deadlines", **deadlines.stats())
+            last_stats = time()
+
+        if time() - last_settlement > SETTLEMENT_INTERVAL:
+            try:
+                settle()
+            except Exception: #pylint: disable=W0703
+                # Tried again at the next interval, the groups already sent are watched
+                logger.error("Settlement could not be made", traceback=traceback.format_exc())
+            last_settlement = time()
+
+        if SUMMARY_POST_INTERVAL and time() - last_summary > SUMMARY_POST_INTERVAL:
+            post_summaries(SUBREDDITS)
+            last_summary = time()
 
         waiting = (waiting + 1) % 5
 
-        sleep(0.5)
+        traffic.wait(0.5) # Sped up or skipped when replaying a recording
+
+    logger.info("Replay finished", **traffic.report())
+    traffic.close()
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    finally:
+        signing_pipeline.close()
+        logger.close() # Writes the records still queued
     # Put an option to choose the network I wanna connect to (mainnet or testnet)
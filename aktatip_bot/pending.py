@@ -0,0 +1,99 @@
+"""
+File containing the PendingTransaction class, the record kept for
+a transaction sent on chain until its confirmation is replied
+
+It only holds ids and amounts: the users, their wallets and the praw
+event of the transaction are not kept alive while it waits for a block.
+The event is rebuilt from its fullname to reply, which costs no reddit call.
+"""
+
+from typing import Union
+
+from praw.models.reddit.comment import Comment
+from praw.models.reddit.message import Message
+
+from assets import asset_registry
+from clients import reddit, traffic
+from logs import logger
+from stats import record_tip
+from templates import (TRANSACTION_CONFIRMATION, INTERNAL_TRANSACTION_CONFIRMATION, OPT_IN,
+                       TRANSACTION_FAILED, WITHDRAWAL_CONFIRMATION)
+from utils import queue_confirmation, queue_failure
+
+def event_from_fullname(fullname: str) -> Union[Comment, Message]:
+    """
+    Returns a lazy praw object for an event, enough to reply to it
+    """
+    kind, event_id = fullname.split("_", 1)
+    if kind == "t1":
+        return reddit.comment(id=event_id)
+    return Message(reddit, {"id": event_id})
+
+class PendingTransaction: # pylint: disable=R0902
+    """
+    Class representing a sent transaction, with __slots__ to keep it small
+    """
+    __slots__ = ("tx_id", "kind", "amount", "asset_id", "fullname", "sender_id", "receiver_id",
+                 "receiver_name", "destination", "subreddit", "internal", "confirmed_round", "error")
+
+    def __init__(self, tx_id: str, kind: str, amount: int, asset_id: int, fullname: str, # pylint: disable=R0913
+                 sender_id: int, receiver_id: int = None, receiver_name: str = None, destination: str = None,
+                 subreddit: str = None, internal: bool = False) -> None:
+        """
+        Args:
+            tx_id: id of the Algorand transaction, None for internal tips
+            kind: tip, withdraw, algowithdraw or optin
+            amount: amount sent, in the base unit of the asset
+            asset_id: id of the asset sent, 0 for Algos
+            fullname: reddit fullname of the event of the transaction
+            sender_id: user id of the sender
+            receiver_id: user id of the receiver, None if the receiver isn't a user
+            receiver_name: name of the receiver, None if the receiver isn't a user
+            destination: address the transaction was sent to
+            subreddit: subreddit the tip was sent from, None for messages
+            internal: True when the tip was settled on the internal ledger
+        """
+        self.tx_id, self.kind, self.amount, self.asset_id = tx_id, kind, amount, asset_id
+        self.fullname, self.sender_id, self.receiver_id = fullname, sender_id, receiver_id
+        self.receiver_name, self.destination, self.subreddit = receiver_name, destination, subreddit
+        self.internal = internal
+        self.confirmed_round = None
+        self.error = None # Why the transaction wasn't confirmed, None while it is pending or once confirmed
+
+    def reply(self, body: str) -> None: # pylint: disable=C0116
+        traffic.call("reddit", "reply", event_from_fullname(self.fullname).reply, body)
+
+    def send_confirmation(self) -> None:
+        """
+        Replies to the event of the transaction to confirm it, or to tell that it failed
+        """
+        asset = asset_registry.get(self.asset_id)
+        if self.error is not None:
+            self.reply(TRANSACTION_FAILED.substitute(amount=asset.from_units(self.amount), unit=asset.unit_name,
+                                                     error=self.error))
+        elif self.kind == "tip":
+            template = INTERNAL_TRANSACTION_CONFIRMATION if self.internal else TRANSACTION_CONFIRMATION
+            self.reply(template.substitute(amount=asset.from_units(self.amount), unit=asset.unit_name,
+                                           receiver=self.receiver_name, transaction_id=self.tx_id))
+        elif self.kind == "optin":
+            self.reply(OPT_IN.substitute(unit=asset.unit_name))
+        else:
+            self.reply(WITHDRAWAL_CONFIRMATION.substitute(amount=asset.from_units(self.amount),
+                                                          unit=asset.unit_name,
+                                                          address=self.destination,
+                                                          transaction_id=self.tx_id))
+
+    def log(self) -> None:
+        """
+        Logs the confirmation of the transaction
+        """
+        if self.error is not None:
+            queue_failure(self.tx_id, self.error)
+            logger.warning("Transaction failed", kind=self.kind, tx_id=self.tx_id, error=self.error)
+            return
+        if not self.internal: # Internal tips are saved as confirmed
+            queue_confirmation(self.tx_id, self.confirmed_round)
+        if self.kind == "tip":
+            record_tip(self.sender_id, self.receiver_id, self.amount, self.asset_id, self.subreddit)
+        logger.info("Transaction confirmed", kind=self.kind, tx_id=self.tx_id, round=self.confirmed_round,
+                    internal=self.internal)
@@ -0,0 +1,129 @@
+"""
+File containing the on-demand profiler of the main loop
+A profile is started by sending SIGUSR1 to the bot or the `profile` command
+from an admin, and stops by itself after the requested duration.
+Each profile is written as a pstats file and as a collapsed-stack file
+that can be turned into a flamegraph (flamegraph.pl, speedscope, ...)
+"""
+
+import cProfile
+import os
+import signal
+import sys
+import threading
+from collections import Counter
+from time import monotonic, sleep, strftime
+from typing import Optional
+
+from logs import logger
+
+PROFILE_DIR = "profiles"
+DEFAULT_DURATION = 30 # Seconds
+MAX_DURATION = 600 # Seconds
+SAMPLE_INTERVAL = 0.005 # Seconds between two samples of the main thread stack
+
+class StackSampler(threading.Thread):
+    """
+    Thread sampling the stack of another thread at a fixed interval
+    """
+    def __init__(self, thread_id: int, interval: float = SAMPLE_INTERVAL) -> None:
+        super().__init__(daemon=True)
+        self.thread_id, self.interval = thread_id, interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            frame = sys._current_frames().get(self.thread_id) # pylint: disable=W0212
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+            sleep(self.interval)
+
+    def dump(self, path: str) -> None:
+        """
+        Writes the samples in the collapsed-stack format, one "stack count" per line
+        """
+        with open(path, "w") as collapsed:
+            for stack, count in self.stacks.most_common():
+                collapsed.write(f"{stack} {count}\n")
+
+class Profiler:
+    """
+    Class running at most one time-boxed profile of the main thread at a time
+    When no profile is running, the cost per tick is a couple of attribute checks
+    """
+    def __init__(self) -> None:
+        self.requested: Optional[float] = None
+        self.profile: Optional[cProfile.Profile] = None
+        self.sampler: Optional[StackSampler] = None
+        self.stop_at: float = 0
+
+    @property
+    def active(self) -> bool:
+        """
+        Returns whether a profile is running
+        """
+        return self.profile is not None
+
+    def request(self, duration: float = DEFAULT_DURATION) -> None:
+        """
+        Asks for a profile to be started on the next tick of the main loop
+        Safe to call from a signal handler
+        """
+        self.requested = min(duration, MAX_DURATION)
+
+    def install_signal_handler(self) -> None:
+        """
+        Starts a profile of DEFAULT_DURATION seconds when the process receives SIGUSR1
+        """
+        if hasattr(signal, "SIGUSR1"): # Not available on Windows
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.request())
+
+    def tick(self) -> None:
+        """
+        Starts the requested profile or stops the running one when it's over
+        Must be called from the main loop, which is the thread being profiled
+        """
+        if self.requested is not None and not self.active:
+            self.start(self.requested)
+        elif self.active and monotonic() >= self.stop_at:
+            self.stop()
+
+    def start(self, duration: float) -> None:
+        """
+        Starts profiling the calling thread for the given number of seconds
+        """
+        self.requested = None
+        self.stop_at = monotonic() + duration
+        self.sampler = StackSampler(threading.get_ident())
+        self.sampler.start()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        logger.info("Profiling started", duration=duration)
+
+    def stop(self) -> str:
+        """
+        Stops the running profile and writes its results
+
+        Returns:
+            str: the path of the results, without the .pstats/.collapsed extension
+        """
+        self.profile.disable()
+        self.sampler.stopped.set()
+        self.sampler.join()
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"profile-{strftime('%Y%m%d-%H%M%S')}")
+        self.profile.dump_stats(f"{path}.pstats")
+        self.sampler.dump(f"{path}.collapsed")
+
+        self.profile, self.sampler = None, None
+        logger.info("Profile written", path=path)
+        return path
+
+profiler = Profiler()
@@ -0,0 +1,396 @@
+"""
+File containing the rain command, that tips the same amount to every
+commenter of a thread or to every user of a list
+
+A rain runs as a job checkpointed in the rain_jobs and rain_recipients tables,
+advanced by one batch on every tick of the main loop, so that a restart
+resumes it where it stopped:
+ * collecting: the commenters of the thread are streamed from reddit into rain_recipients
+ * sending: the pending recipients are resolved and validated in bulk, then tipped in
+   atomic groups, or on the internal ledger when it is enabled. The groups of all the
+   jobs being sent go through a single stream of the signing pipeline on every tick
+ * done: every recipient was tipped, skipped or failed, and a single summary is replied
+A job failing, for instance on a thread that can't be read, is stopped with an error
+replied in its summary, without stopping the other jobs or the main loop.
+"""
+
+import re
+import traceback
+from collections import defaultdict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+from time import time
+from typing import List, Tuple
+
+from algosdk.error import AlgodHTTPError
+from praw.exceptions import APIException
+from prawcore.exceptions import Forbidden, NotFound
+
+from assets import Asset, asset_registry
+from clients import algod, db, reddit, traffic, USERNAME
+from errors import PoolError
+from indexer import block_indexer
+from instances import Wallet
+from ledger import GROUP_SIZE, INTERNAL_TRANSFERS, write_transfer
+from logs import logger
+from pending import event_from_fullname
+from signing import SignedGroup, signing_pipeline, Transfer
+from stats import record_tips
+from templates import RAIN_FAILED, RAIN_INSUFFICIENT_FUNDS, RAIN_SUMMARY
+from utils import (get_name_by_userId, get_opted_in, queue_confirmation, queue_failure, queue_transaction,
+                   save_finished_event, save_opt_ins, SUBMITTED)
+
+MAX_RECIPIENTS = 500
+MORE_COMMENTS_LIMIT = 32 # "load more comments" expanded per thread, one reddit call each
+INTERNAL_BATCH_SIZE = 100 # Recipients moved on the internal ledger per tick
+GROUPS_PER_TICK = 16 # Atomic groups signed and sent per tick, over all the jobs
+RESOLVE_WORKERS = 8 # Concurrent opt-in checks
+THREAD_URL = re.compile(r"/comments/([a-z0-9]+)", re.IGNORECASE)
+
+# States of the jobs
+COLLECTING = "collecting"
+SENDING = "sending"
+DONE = "done"
+
+# States of the recipients
+PENDING = "pending" # Not tipped yet
+SENT = "sent" # Tipped in a group waiting for its confirmation
+CONFIRMED = "confirmed"
+SKIPPED = "skipped" # No wallet opted in the asset
+FAILED = "failed"
+
+RainJob = namedtuple("RainJob", "job_id fullname sender_id asset_id amount thread_id state")
+
+resolver = ThreadPoolExecutor(max_workers=RESOLVE_WORKERS, thread_name_prefix="rain")
+
+def parse_targets(targets: List[str], sender: str) -> Tuple[str, List[str]]:
+    """
+    Returns the id of the thread given in the command, or the names of the users of the list
+
+    Returns:
+        tuple: (thread_id, None) for a thread, (None, names) for a list of users
+    """
+    match = THREAD_URL.search(targets[0]) if len(targets) == 1 else None
+    if match:
+        return match.group(1), None
+    names = (name.strip().lower().replace("u/", "", 1).strip("/") for target in targets for name in target.split(","))
+    names = dict.fromkeys(name for name in names if name and name != sender)
+    return None, list(islice(names, MAX_RECIPIENTS))
+
+def start(sender_id: int, sender: str, amount: int, asset: Asset, targets: List[str], fullname: str) -> int:
+    """
+    Saves a new rain job, with its recipients when they are given as a list
+    The event is saved as submitted in the same commit, the job replies to it once done
+
+    Args:
+        sender_id: user id of the sender
+        sender: name of the sender, who never rains on themselves
+        amount: amount tipped to each recipient, in the base unit of the asset
+        asset: the asset tipped
+        targets: the url of a thread, or names of users
+        fullname: reddit fullname of the event of the command
+    Returns:
+        int: the id of the job
+    """
+    thread_id, names = parse_targets(targets, sender)
+    now = int(time())
+    def write(connection):
+        job_id = connection.execute("INSERT INTO rain_jobs (fullname, sender_id, asset_id, amount, thread_id, state, "
+                                    "created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    (fullname, sender_id, asset.asset_id, amount, thread_id,
+                                     COLLECTING if thread_id else SENDING, now)).lastrowid
+        connection.executemany("INSERT OR IGNORE INTO rain_recipients (job_id, name, state) VALUES (?, ?, ?)",
+                               [(job_id, name, PENDING) for name in names or []])
+        connection.execute("INSERT OR REPLACE INTO events VALUES (?, ?, NULL, ?)", (fullname, SUBMITTED, now))
+        return job_id
+    job_id = db.run(write).result()
+    logger.info("Rain started", job_id=job_id, sender=sender, thread_id=thread_id, recipients=len(names or []))
+    return job_id
+
+def advance() -> None:
+    """
+    Runs the next step of every unfinished job, oldest first, and sends
+    the groups of all of them in a single stream of the signing pipeline
+    """
+    groups = []
+    for row in db.read("SELECT id, fullname, sender_id, asset_id, amount, thread_id, state FROM rain_jobs "
+                       "WHERE state != ? ORDER BY id", (DONE, )):
+        job = RainJob(*row)
+        try:
+            if job.state == COLLECTING:
+                collect(job)
+            elif len(groups) < GROUPS_PER_TICK:
+                groups.extend(send_batch(job, GROUPS_PER_TICK - len(groups), groups))
+        except Exception as e: # pylint: disable=W0703, C0103
+            fail(job, e)
+    if not groups:
+        return
+    try:
+        send_groups(groups)
+    except Exception as e: # pylint: disable=W0703, C0103
+        for job in {job for job, _ in groups}:
+            fail(job, e)
+
+def collect(job: RainJob) -> None:
+    """
+    Streams the authors of the comments of the thread into the recipients of the job
+    Collecting again after a restart is harmless, recipients already saved are ignored
+    """
+    excluded = {(get_name_by_userId(job.sender_id) or "").lower(), USERNAME.lower()}
+    def fetch():
+        submission = reddit.submission(id=job.thread_id)
+        submission.comments.replace_more(limit=MORE_COMMENTS_LIMIT)
+        authors = (comment.author.name.lower() for comment in submission.comments.list() if comment.author)
+        return list(islice(dict.fromkeys(name for name in authors if name not in excluded), MAX_RECIPIENTS))
+    names = traffic.call("reddit", "rain_recipients", fetch) or []
+
+    def write(connection):
+        connection.executemany("INSERT OR IGNORE INTO rain_recipients (job_id, name, state) VALUES (?, ?, ?)",
+                               [(job.job_id, name, PENDING) for name in names])
+        connection.execute("UPDATE rain_jobs SET state = ? WHERE id = ?", (SENDING, job.job_id))
+    db.run(write).result()
+    logger.info("Rain recipients collected", job_id=job.job_id, recipients=len(names))
+
+def resolve(names: List[str], asset: Asset) -> List[tuple]:
+    """
+    Looks up the wallets of the recipients with a single query, and checks
+    that they are opted in the asset with a second one, against the opt-ins seen by
+    the block indexer. Only the wallets never seen opting in are checked with
+    concurrent algod calls, and cached when they are opted in.
+
+    Returns:
+        list: (name, user_id, public_key) of the recipients that can be tipped
+    """
+    rows = db.read("SELECT lower(users.name), users.id, wallets.public_key FROM users "
+                   "JOIN wallets ON wallets.user_id = users.id "
+                   f"WHERE users.name COLLATE NOCASE IN ({', '.join('?' * len(names))})", names)
+    if asset.is_algo:
+        return rows
+    known = get_opted_in((public_key for _, _, public_key in rows), asset.asset_id)
+    unknown = [row for row in rows if row[2] not in known]
+    opted_in = dict(zip((public_key for _, _, public_key in unknown),
+                        resolver.map(lambda row: Wallet("", row[2]).opted_in(asset), unknown)))
+    found = [(public_key, asset.asset_id) for public_key, flag in opted_in.items() if flag]
+    if found:
+        save_opt_ins(found)
+    return [row for row in rows if row[2] in known or opted_in.get(row[2])]
+
+def send_batch(job: RainJob, max_groups: int,
+               planned: List[Tuple[RainJob, List[tuple]]]) -> List[Tuple[RainJob, List[tuple]]]:
+    """
+    Tips the next batch of pending recipients on the internal ledger, or returns
+    the groups to send on chain, or finishes the job when no recipient is left
+
+    Args:
+        job: the job being sent
+        max_groups: maximum number of groups to return
+        planned: the groups of the other jobs to send in the same tick
+    Returns:
+        list: (job, recipients) of each group to send, recipients being (name, user_id, public_key) tuples
+    """
+    batch_size = INTERNAL_BATCH_SIZE if INTERNAL_TRANSFERS else GROUP_SIZE * max_groups
+    names = [row[0] for row in db.read("SELECT name FROM rain_recipients WHERE job_id = ? AND state = ? LIMIT ?",
+                                       (job.job_id, PENDING, batch_size))]
+    if not names:
+        if db.read_one("SELECT 1 FROM rain_recipients WHERE job_id = ? AND state = ? LIMIT 1",
+                       (job.job_id, SENT)) is None:
+            finish(job)
+        return []
+
+    asset = asset_registry.get(job.asset_id)
+    recipients = resolve(names, asset)
+    skipped = set(names) - {name for name, _, _ in recipients}
+    if skipped:
+        db.write_many("UPDATE rain_recipients SET state = ? WHERE job_id = ? AND name = ?",
+                      [(SKIPPED, job.job_id, name) for name in skipped]).result()
+    if not recipients:
+        return []
+
+    sender = Wallet.load(job.sender_id)
+    if not has_funds(sender, asset, job.amount * len(recipients), 0 if INTERNAL_TRANSFERS else len(recipients),
+                     planned):
+        stop(job, RAIN_INSUFFICIENT_FUNDS)
+        return []
+
+    if INTERNAL_TRANSFERS:
+        send_internal(job, recipients)
+        return []
+    return [(job, recipients[start:start + GROUP_SIZE]) for start in range(0, len(recipients), GROUP_SIZE)]
+
+def has_funds(sender: Wallet, asset: Asset, total: int, transactions: int, # pylint: disable=R0913
+              planned: List[Tuple[RainJob, List[tuple]]]) -> bool:
+    """
+    Checks that the sender can pay a batch, and the fees of its on-chain transactions,
+    on top of the tips of all their rains that are sent but not confirmed yet, which the
+    balances don't show yet, and of the groups of their other jobs planned in the same tick
+
+    Args:
+        sender: wallet of the sender
+        asset: the asset tipped
+        total: amount tipped to the whole batch, in the base unit of the asset
+        transactions: number of on-chain transactions of the batch
+        planned: the groups of the other jobs to send in the same tick
+    """
+    pending = defaultdict(int) # Amounts keyed by asset id
+    pending_transactions = 0
+    unconfirmed = db.read("SELECT j.asset_id, SUM(j.amount), COUNT(*) FROM rain_jobs j "
+                          "JOIN rain_recipients r ON r.job_id = j.id "
+                          "WHERE j.state = ? AND j.sender_id = ? AND r.state = ? GROUP BY j.asset_id",
+                          (SENDING, sender.user_id, SENT))
+    planned_totals = [(job.asset_id, job.amount * len(recipients), len(recipients))
+                      for job, recipients in planned if job.sender_id == sender.user_id]
+    for asset_id, amount, count in list(unconfirmed) + planned_totals:
+        pending[asset_id] += amount
+        pending_transactions += count
+
+    fee = algod.suggested_params().min_fee if transactions or pending_transactions else 0
+    available = sender.holdings.get(asset.asset_id, 0)
+    if transactions: # Only what is on chain can be sent on chain
+        available = min(available, sender.chain_holdings.get(asset.asset_id, 0))
+    available -= pending[asset.asset_id]
+    fees = (transactions + pending_transactions) * fee
+    if asset.is_algo:
+        return available >= total + fees
+    return available >= total and sender.chain_holdings[0] - pending[0] >= fees
+
+def send_internal(job: RainJob, recipients: List[tuple]) -> None:
+    """
+    Moves the tips of a batch on the internal ledger, in the same commit as the checkpoint
+    """
+    now = int(time())
+    def write(connection):
+        for _, user_id, public_key in recipients:
+            write_transfer(connection, job.sender_id, user_id, public_key, job.amount, job.asset_id, None, now)
+        connection.executemany("UPDATE rain_recipients SET state = ?, user_id = ? WHERE job_id = ? AND name = ?",
+                               [(CONFIRMED, user_id, job.job_id, name) for name, user_id, _ in recipients])
+    db.run(write).result()
+    record_tips((job.sender_id, user_id, job.amount, job.asset_id, None) for _, user_id, _ in recipients)
+
+def send_groups(groups: List[Tuple[RainJob, List[tuple]]]) -> None:
+    """
+    Signs the groups in a single stream of the signing pipeline, each group being sent
+    while the next ones are signed
+    """
+    params = algod.suggested_params()
+    signed_groups = signing_pipeline.sign(([Transfer(job.sender_id, public_key, job.amount, job.asset_id)
+                                            for _, _, public_key in recipients]
+                                           for job, recipients in groups), params)
+    for (job, recipients), signed_group in zip(groups, signed_groups):
+        send_group(job, recipients, signed_group, params)
+
+def send_group(job: RainJob, recipients: List[tuple], signed_group: SignedGroup, params) -> None:
+    """
+    Sends the tips of a batch as one atomic group
+    The group is saved before sending it, and only fails once its last valid round is over
+    """
+    tx_ids = signed_group.tx_ids
+    group_id = tx_ids[0]
+
+    db.write_many("UPDATE rain_recipients SET state = ?, user_id = ?, tx_id = ?, group_id = ?, first_round = ?, "
+                  "last_round = ? WHERE job_id = ? AND name = ?",
+                  [(SENT, user_id, tx_id, group_id, params.first, params.last, job.job_id, name)
+                   for (name, user_id, _), tx_id in zip(recipients, tx_ids)]).result()
+    for (_, user_id, public_key), tx_id in zip(recipients, tx_ids):
+        queue_transaction("tip", job.sender_id, user_id, public_key, job.amount, job.asset_id, tx_id, None,
+                          params.first, params.last)
+
+    try:
+        algod.send_raw_transaction(signed_group.blob)
+    except AlgodHTTPError as e: # pylint: disable=C0103
+        if (e.code or 500) < 500: # Rejected by the node, it will never be confirmed
+            failed = Future()
+            failed.set_exception(PoolError(group_id, str(e)))
+            group_done(job.job_id, group_id, failed)
+            return
+        logger.warning("Rain group sending failed", job_id=job.job_id, group_id=group_id, error=repr(e))
+    except Exception as e: # pylint: disable=W0703, C0103
+        # The group may have reached the network, it fails once its last valid round is over
+        logger.warning("Rain group sending failed", job_id=job.job_id, group_id=group_id, error=repr(e))
+    logger.info("Rain group sent", job_id=job.job_id, group_id=group_id, recipients=len(recipients))
+    watch_group(job.job_id, group_id, params.last)
+
+def watch_group(job_id: int, group_id: str, last_round: int) -> None:
+    """
+    Waits for the confirmation of a group until its last valid round
+    """
+    block_indexer.wait(group_id, timeout_round=last_round).add_done_callback(partial(group_done, job_id, group_id))
+
+def group_done(job_id: int, group_id: str, future: Future) -> None:
+    """
+    Callback of the futures of the groups, saving the outcome of their recipients
+    """
+    try:
+        confirmed_round = future.result()
+    except (PoolError, TimeoutError) as e: # pylint: disable=C0103
+        db.write("UPDATE rain_recipients SET state = ? WHERE group_id = ?", (FAILED, group_id)).result()
+        for (tx_id, ) in db.read("SELECT tx_id FROM rain_recipients WHERE group_id = ?", (group_id, )):
+            queue_failure(tx_id, e.pool_error if isinstance(e, PoolError) else "not confirmed in time")
+        logger.warning("Rain group not confirmed", job_id=job_id, group_id=group_id, error=repr(e))
+        return
+
+    job = db.read_one("SELECT sender_id, asset_id, amount FROM rain_jobs WHERE id = ?", (job_id, ))
+    recipients = db.read("SELECT user_id, tx_id FROM rain_recipients WHERE group_id = ?", (group_id, ))
+    db.write("UPDATE rain_recipients SET state = ? WHERE group_id = ?", (CONFIRMED, group_id)).result()
+    for _, tx_id in recipients:
+        queue_confirmation(tx_id, confirmed_round)
+    record_tips((job[0], user_id, job[2], job[1], None) for user_id, _ in recipients)
+    logger.info("Rain group confirmed", job_id=job_id, group_id=group_id, round=confirmed_round)
+
+def stop(job: RainJob, reason: str) -> None:
+    """
+    Fails the recipients left and finishes the job with the given reason
+    """
+    def write(connection):
+        connection.execute("UPDATE rain_recipients SET state = ? WHERE job_id = ? AND state = ?",
+                           (FAILED, job.job_id, PENDING))
+        # The first reason is kept, a job failing while it finishes was already stopped
+        connection.execute("UPDATE rain_jobs SET error = COALESCE(error, ?), state = ? WHERE id = ?",
+                           (reason, SENDING, job.job_id))
+    db.run(write).result()
+
+def fail(job: RainJob, error: Exception) -> None:
+    """
+    Stops a job that raised an error, its summary is replied once its sent groups are over
+    """
+    logger.error("Rain failed", job_id=job.job_id, state=job.state, error=repr(error),
+                 traceback=traceback.format_exc())
+    try:
+        stop(job, RAIN_FAILED)
+    except Exception as e: # pylint: disable=W0703, C0103
+        logger.error("Rain could not be stopped", job_id=job.job_id, error=repr(e))
+
+def finish(job: RainJob) -> None:
+    """
+    Replies the summary of the job to its event
+    """
+    counts = dict(db.read("SELECT state, COUNT(*) FROM rain_recipients WHERE job_id = ? GROUP BY state",
+                          (job.job_id, )))
+    error = db.read_one("SELECT error FROM rain_jobs WHERE id = ?", (job.job_id, ))[0]
+    asset = asset_registry.get(job.asset_id)
+    summary = RAIN_SUMMARY.substitute(amount=asset.from_units(job.amount), unit=asset.unit_name,
+                                      count=counts.get(CONFIRMED, 0), skipped=counts.get(SKIPPED, 0),
+                                      failed=counts.get(FAILED, 0))
+    try:
+        traffic.call("reddit", "reply", event_from_fullname(job.fullname).reply,
+                     summary + (f"\n\n{error}" if error else ""))
+    except (APIException, Forbidden, NotFound) as e: # pylint: disable=C0103
+        # The command was deleted or can't be replied to, retrying would never succeed
+        logger.warning("Rain summary not replied", job_id=job.job_id, error=repr(e))
+
+    db.write("UPDATE rain_jobs SET state = ?, finished_at = ? WHERE id = ?",
+             (DONE, int(time()), job.job_id)).result()
+    save_finished_event(job.fullname, confirmed=True)
+    logger.info("Rain finished", job_id=job.job_id, **counts)
+
+def resume_rains() -> None:
+    """
+    Waits again for the groups left unconfirmed by the previous run,
+    from the first round they could be confirmed in
+    """
+    for job_id, group_id, first_round, last_round in db.read(
+            "SELECT DISTINCT r.job_id, r.group_id, r.first_round, r.last_round FROM rain_jobs j "
+            "JOIN rain_recipients r ON r.job_id = j.id WHERE j.state = ? AND r.state = ?", (SENDING, SENT)):
+        block_indexer.rescan_from(first_round)
+        watch_group(job_id, group_id, last_round)
+        logger.info("Resuming rain group", job_id=job_id, group_id=group_id)
@@ -0,0 +1,329 @@
+"""
+File containing the record and replay of the traffic of the bot
+
+In record mode, the events returned by utils.stream and the results, errors and timings
+of the reddit and algod calls are written to a gzipped JSON lines file, with the keys of
+the wallets generated meanwhile so that their calls match on replay: a recording must be
+kept as private as the database.
+In replay mode, the file is fed back through offline stand-ins, at the recorded
+pace divided by the replay speed ("max" to never wait), so that two versions of
+the bot can be compared on the exact same workload.
+
+The mode is chosen with environment variables:
+    AKTATIP_RECORD=<file>                 records the traffic to the file
+    AKTATIP_REPLAY=<file>                 replays the traffic of the file
+    AKTATIP_REPLAY_SPEED=<1|10|...|max>   speed of the replay, 1 by default
+The replay sends transactions to nobody, but still uses the local database,
+so it should be run against a copy of the database of the recording.
+"""
+
+import base64
+import gzip
+import hashlib
+import importlib
+import json
+import threading
+from collections import defaultdict, deque
+from functools import partial
+from time import monotonic, sleep
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional
+
+from praw.models.reddit.comment import Comment
+from praw.models.reddit.message import Message
+
+from errors import ReplayMissError
+
+OFF, RECORD, REPLAY = "off", "record", "replay"
+
+def encode(value: Any) -> Any:
+    """
+    Converts a result to something JSON serializable
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, bytes):
+        return {"__bytes__": base64.b64encode(value).decode()}
+    if isinstance(value, (list, tuple, set)):
+        return [encode(item) for item in value]
+    if isinstance(value, dict):
+        return {key: encode(item) for key, item in value.items()}
+    return {"__object__": f"{type(value).__module__}.{type(value).__name__}",
+            "attributes": encode(vars(value))}
+
+def decode(value: Any) -> Any:
+    """
+    Converts a value written by encode back to the original result
+    """
+    if isinstance(value, list):
+        return [decode(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if "__bytes__" in value:
+        return base64.b64decode(value["__bytes__"])
+    if "__object__" in value:
+        module, name = value["__object__"].rsplit(".", 1)
+        cls = getattr(importlib.import_module(module), name)
+        obj = cls.__new__(cls)
+        obj.__dict__.update(decode(value["attributes"]))
+        return obj
+    return {key: decode(item) for key, item in value.items()}
+
+def encode_error(error: Exception) -> dict:
+    """
+    Converts an exception raised by a call to something JSON serializable,
+    only its message is kept when its arguments or attributes can't be converted
+    """
+    try:
+        args, attributes = encode(error.args), encode(vars(error))
+        json.dumps([args, attributes])
+    except (TypeError, ValueError, RecursionError):
+        args, attributes = [str(error)], {}
+    return {"type": f"{type(error).__module__}.{type(error).__qualname__}", "args": args, "attributes": attributes}
+
+def decode_error(value: dict) -> Exception:
+    """
+    Converts an exception written by encode_error back to an exception of the same type
+    """
+    module, name = value["type"].rsplit(".", 1)
+    cls = getattr(importlib.import_module(module), name)
+    error = cls.__new__(cls)
+    error.args = tuple(decode(value["args"]))
+    error.__dict__.update(decode(value["attributes"]))
+    return error
+
+def identify(value: Any) -> Any:
+    """
+    Converts an argument of a call to something JSON serializable that identifies it,
+    reddit objects are identified by their fullname so the stand-ins match the recorded ones
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if hasattr(value, "fullname"):
+        return value.fullname
+    if isinstance(value, (bytes, list, tuple, set)):
+        return encode(value) if isinstance(value, bytes) else [identify(item) for item in value]
+    if isinstance(value, dict):
+        return {key: identify(item) for key, item in value.items()}
+    if hasattr(value, "__dict__"):
+        return [type(value).__name__, identify(vars(value))]
+    return repr(value)
+
+def call_key(method: str, args: tuple, kwargs: dict) -> str:
+    """
+    Returns the hash of a call and its arguments, used to find its result in a recording
+    """
+    call = json.dumps([method, identify(args), identify(kwargs)], sort_keys=True)
+    return hashlib.sha1(call.encode()).hexdigest()
+
+def set_attributes(obj: Any, **attributes) -> None:
+    """
+    Sets attributes without going through the PRAW __setattr__ that objectifies them
+    """
+    for name, value in attributes.items():
+        object.__setattr__(obj, name, value)
+
+class ReplayAuthor(SimpleNamespace):
+    """
+    Stand-in for a praw Redditor, only knowing its name
+    """
+    def __str__(self) -> str:
+        return self.name
+
+class ReplayComment(Comment):
+    """
+    Stand-in for a praw Comment read from a recording
+    """
+    def __init__(self, data: dict, traffic: "Traffic") -> None: # pylint: disable=W0231
+        set_attributes(self, _reddit=None, _fetched=True, _replies=[], _submission=None,
+                       id=data["id"], body=data["body"], subreddit=data["subreddit"],
+                       author=ReplayAuthor(name=data["author"]) if data["author"] else None,
+                       _fullname=data["fullname"], _parent_author=data["parent_author"], _traffic=traffic)
+
+    @property
+    def fullname(self) -> str:
+        return self._fullname
+
+    def parent(self) -> SimpleNamespace:
+        return SimpleNamespace(author=ReplayAuthor(name=self._parent_author))
+
+    def reply(self, body: str) -> None:
+        self._traffic.call("reddit", "reply", None, body)
+
+class ReplayMessage(Message):
+    """
+    Stand-in for a praw Message read from a recording
+    """
+    def __init__(self, data: dict, traffic: "Traffic") -> None: # pylint: disable=W0231
+        set_attributes(self, _reddit=None, _fetched=True, id=data["id"], body=data["body"], subreddit=None,
+                       author=ReplayAuthor(name=data["author"]) if data["author"] else None,
+                       _fullname=data["fullname"], _traffic=traffic)
+
+    @property
+    def fullname(self) -> str:
+        return self._fullname
+
+    def reply(self, body: str) -> None:
+        self._traffic.call("reddit", "reply", None, body)
+
+def describe(event) -> dict:
+    """
+    Returns the fields of a praw event needed to replay it
+    """
+    data = {"id": event.id, "fullname": event.fullname, "body": event.body,
+            "author": event.author.name if event.author else None}
+    if isinstance(event, Comment):
+        parent = event.parent()
+        data.update(type="comment", subreddit=str(event.subreddit),
+                    parent_author=parent.author.name if parent.author else None)
+    else:
+        data.update(type="message")
+    return data
+
+class Traffic: # pylint: disable=R0902
+    """
+    Class every reddit and algod call of the bot goes through
+    When the mode is OFF, call only calls the given function
+    """
+    def __init__(self, mode: str = OFF, path: str = None, speed: str = "1") -> None:
+        self.mode = mode
+        self.speed = float("inf") if speed == "max" else float(speed)
+        self.lock = threading.Lock()
+        self.start = monotonic()
+        self.finished = False
+        self.latencies: List[float] = []
+        self.arrivals: Dict[str, float] = {}
+        self.output = gzip.open(path, "wt") if mode == RECORD else None
+
+        self.batches = deque()
+        self.results: Dict[str, deque] = defaultdict(deque)
+        self.last_results: Dict[str, dict] = {}
+        if mode == REPLAY:
+            with gzip.open(path, "rt") as recording:
+                for line in recording:
+                    record = json.loads(line)
+                    if record["kind"] == "events":
+                        self.batches.append(record)
+                    else:
+                        self.results[record["key"]].append(record)
+
+    def write(self, **record) -> None:
+        """
+        Appends a record to the recording
+        """
+        record["t"] = monotonic() - self.start
+        with self.lock:
+            self.output.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def wait(self, seconds: float) -> None:
+        """
+        Waits the given recorded number of seconds, scaled by the replay speed
+        """
+        if seconds > 0 and self.speed != float("inf"):
+            sleep(seconds / self.speed)
+
+    def call(self, target: str, method: str, function: Optional[Callable], *args, **kwargs) -> Any:
+        """
+        Calls function, records it or replays its recorded result depending on the mode
+        Recorded results are found by the hash of the method and its arguments, the results
+        of identical calls are replayed in order and the last one is repeated once they run out
+        A call that raised is recorded with its error, which is raised again on replay
+
+        Args:
+            target: "reddit" or "algod"
+            method: name of the call
+            function: the function doing the call, not called when replaying
+        Raises:
+            ReplayMissError: when replaying a call never made with these arguments in the recording
+        """
+        if self.mode == OFF:
+            return function(*args, **kwargs)
+
+        key = call_key(method, args, kwargs)
+        if self.mode == RECORD:
+            started = monotonic()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e: # pylint: disable=C0103
+                self.write(kind="call", target=target, method=method, key=key,
+                           error=encode_error(e), elapsed=monotonic() - started)
+                raise
+            self.write(kind="call", target=target, method=method, key=key,
+                       result=encode(result), elapsed=monotonic() - started)
+            return result
+
+        record = self.results[key].popleft() if self.results[key] else self.last_results.get(key)
+        if record is None:
+            raise ReplayMissError(target, method)
+        self.last_results[key] = record
+        self.wait(record["elapsed"])
+        if "error" in record:
+            raise decode_error(record["error"])
+        return decode(record["result"])
+
+    def events(self, fetch: Callable[[], set]) -> set:
+        """
+        Returns the events fetched by fetch, or the next recorded batch of events
+        In replay mode, waits for the time of the batch and flags the end of the recording
+        """
+        if self.mode == OFF:
+            return fetch()
+
+        if self.mode == RECORD:
+            events = fetch()
+            self.write(kind="events", events=[describe(event) for event in events])
+            for event in events:
+                set_attributes(event, reply=partial(self.call, "reddit", "reply", event.reply))
+        elif not self.batches:
+            self.finished = True
+            return set()
+        else:
+            batch = self.batches.popleft()
+            self.wait(batch["t"] - (monotonic() - self.start) * self.speed)
+            events = {ReplayComment(data, self) if data["type"] == "comment" else ReplayMessage(data, self)
+                      for data in batch["events"]}
+
+        now = monotonic()
+        for event in events:
+            self.arrivals.setdefault(event.id, now)
+        return events
+
+    def event_done(self, event) -> None:
+        """
+        Records the latency of an event, from the moment it was streamed to the end of its handling
+        """
+        arrival = self.arrivals.pop(event.id, None)
+        if self.mode != OFF and arrival is not None:
+            self.latencies.append(monotonic() - arrival)
+
+    def report(self) -> dict:
+        """
+        Returns the throughput and latency percentiles of the handled events
+        """
+        elapsed = monotonic() - self.start
+        latencies = sorted(self.latencies)
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else None
+        return {"events": len(latencies), "elapsed": elapsed,
+                "events_per_second": len(latencies) / elapsed if elapsed else None,
+                "p50": percentile(0.5), "p95": percentile(0.95), "p99": percentile(0.99)}
+
+    def close(self) -> None:
+        """
+        Closes the recording
+        """
+        if self.output is not None:
+            self.output.close()
+
+class TrafficAlgod:
+    """
+    Stand-in for the algod client sending every call through the traffic
+    """
+    def __init__(self, client, traffic: Traffic) -> None:
+        self.client, self.traffic = client, traffic
+
+    def __getattr__(self, method: str) -> Callable:
+        function = getattr(self.client, method) if self.client is not None else None
+        def call(*args, **kwargs):
+            return self.traffic.call("algod", method, function, *args, **kwargs)
+        return call
@@ -0,0 +1,317 @@
+"""
+File containing the AlgodRouter class, a facade over several algod clients
+Reads go to the fastest healthy endpoint according to its recent latencies,
+and are hedged on the next one when they are slower than usual.
+Writes go to the primary endpoint and fail over to the others.
+Every call has a deadline, bounded by the budget of the event being handled
+(see deadline.py), and an endpoint failing several times in a row
+is taken out of the rotation for a while (circuit breaker): once the
+while is over, a single trial call is let through (half-open), closing
+the circuit if it succeeds and opening it again if it fails.
+
+A call the router stops waiting for, because it missed its deadline or was
+hedged away, counts as a failure of its endpoint, and the HTTP request itself
+times out with the deadline of the call, so that a hung endpoint gets its circuit
+opened and never keeps the threads of the pool.
+
+The endpoints can be any TimedAlgodClient, including ones pointing to local
+HTTP stand-ins (http://127.0.0.1:port) with injected latency.
+"""
+
+import json
+import threading
+import urllib.error
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from statistics import median
+from time import monotonic
+from typing import Callable, Iterable, List, Optional
+from urllib import parse
+from urllib.request import Request, urlopen
+
+from algosdk import constants
+from algosdk.error import AlgodHTTPError
+from algosdk.v2client import algod
+
+from deadline import check, stage, timed_out, timeout_for
+
+READ_DEADLINE = 5.0 # Seconds
+WRITE_DEADLINE = 10.0 # Seconds
+LONG_POLL_DEADLINE = 65.0 # Seconds, algod waits up to a minute in status_after_block
+HEDGE_FACTOR = 3 # A read is hedged when it takes HEDGE_FACTOR times the usual latency
+MIN_HEDGE_DELAY = 0.2 # Seconds
+FAILURE_THRESHOLD = 3 # Consecutive failures opening the circuit of an endpoint
+OPEN_DURATION = 30.0 # Seconds during which an open circuit gets no traffic
+LATENCY_WINDOW = 50 # Number of latencies kept per endpoint
+WORKERS = 16
+
+WRITES = {"send_transaction", "send_transactions", "send_raw_transaction"}
+LONG_POLLS = {"status_after_block"}
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+request_timeout = threading.local() # Socket timeout of the call run by the current thread of the pool
+
+class TimedAlgodClient(algod.AlgodClient):
+    """
+    AlgodClient whose HTTP requests time out with the deadline of the call being run
+    """
+    def algod_request(self, method, requrl, params=None, data=None, # pylint: disable=R0913
+                      headers=None, response_format="json"):
+        """
+        Same as AlgodClient.algod_request, with a timeout given to urlopen
+        """
+        header = dict(self.headers or {}, **(headers or {}))
+        if requrl not in constants.no_auth:
+            header[constants.algod_auth_header] = self.algod_token
+        if requrl not in constants.unversioned_paths:
+            requrl = algod.api_version_path_prefix + requrl
+        if params:
+            requrl = requrl + "?" + parse.urlencode(params)
+
+        request = Request(self.algod_address + requrl, headers=header, method=method, data=data)
+        try:
+            response = urlopen(request, timeout=getattr(request_timeout, "seconds", LONG_POLL_DEADLINE))
+        except urllib.error.HTTPError as e: # pylint: disable=C0103
+            body = e.read().decode("utf-8")
+            try:
+                message = json.loads(body)["message"]
+            except (ValueError, KeyError, TypeError):
+                message = body
+            raise AlgodHTTPError(message, e.code) from None
+        if response_format == "json":
+            try:
+                return json.load(response)
+            except json.JSONDecodeError:
+                return None
+        return response.read()
+
+class Endpoint:
+    """
+    Class keeping the health of one algod client
+    """
+    def __init__(self, client) -> None:
+        self.client = client
+        self.name = client.algod_address
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False # Whether the trial call of the half-open circuit is running
+        self.lock = threading.Lock()
+
+    @property
+    def latency(self) -> float:
+        """
+        Returns the median of the recent latencies, 0 if the endpoint wasn't used yet
+        so that every endpoint gets tried
+        """
+        with self.lock:
+            return median(self.latencies) if self.latencies else 0.0
+
+    @property
+    def state(self) -> str:
+        """
+        Returns CLOSED, OPEN, or HALF_OPEN once the circuit has been open for OPEN_DURATION
+        """
+        if self.opened_at is None:
+            return CLOSED
+        return HALF_OPEN if monotonic() - self.opened_at > OPEN_DURATION else OPEN
+
+    @property
+    def available(self) -> bool:
+        """
+        Returns whether a call could go through: the circuit is closed, or half-open without a trial call running
+        """
+        state = self.state
+        return state == CLOSED or state == HALF_OPEN and not self.probing
+
+    def acquire(self) -> bool:
+        """
+        Returns whether a call can go through, the first call let through a half-open circuit
+        becomes its trial call and the following ones are refused until it ends
+        """
+        with self.lock:
+            state = self.state
+            if state == CLOSED:
+                return True
+            if state == OPEN or self.probing:
+                return False
+            self.probing = True
+            return True
+
+    def success(self, latency: float) -> None: # pylint: disable=C0116
+        with self.lock:
+            self.latencies.append(latency)
+            self.failures, self.opened_at, self.probing = 0, None, False
+
+    def failure(self) -> None: # pylint: disable=C0116
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= FAILURE_THRESHOLD:
+                self.opened_at, self.probing = monotonic(), False
+
+class Call:
+    """
+    Class recording the outcome of a call on an endpoint exactly once: when it ends,
+    or as a failure when the router stops waiting for it
+    """
+    def __init__(self, endpoint: Endpoint) -> None:
+        self.endpoint = endpoint
+        self.recorded = False
+        self.lock = threading.Lock()
+
+    def record(self, succeeded: bool, latency: float = 0.0) -> None: # pylint: disable=C0116
+        with self.lock:
+            if self.recorded:
+                return
+            self.recorded = True
+        if succeeded:
+            self.endpoint.success(latency)
+        else:
+            self.endpoint.failure()
+
+class AlgodRouter:
+    """
+    Class exposing the methods of AlgodClient, routed over several endpoints
+    The first client is the primary, used for the writes
+    """
+    def __init__(self, clients: list) -> None:
+        self.endpoints = [Endpoint(client) for client in clients]
+        self.executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="algod")
+
+    def __getattr__(self, method: str) -> Callable:
+        def call(*args, **kwargs):
+            with stage(f"algod.{method}"):
+                if method in WRITES:
+                    return self.write(method, *args, **kwargs)
+                return self.read(method, *args, **kwargs)
+        return call
+
+    def submit(self, endpoint: Endpoint, deadline: float, method: str, *args, **kwargs) -> Future:
+        """
+        Runs the call on an endpoint in the thread pool, keeping track of its health
+        Algod errors other than 5xx are answers from a healthy endpoint
+        The HTTP request times out at the deadline, the future carries the Call recording its outcome
+        """
+        call = Call(endpoint)
+        def run():
+            started = monotonic()
+            request_timeout.seconds = max(deadline - started, 0.01)
+            try:
+                result = getattr(endpoint.client, method)(*args, **kwargs)
+            except AlgodHTTPError as e: # pylint: disable=C0103
+                call.record((e.code or 500) < 500, monotonic() - started)
+                raise
+            except Exception:
+                call.record(False)
+                raise
+            call.record(True, monotonic() - started)
+            return result
+        future = self.executor.submit(run)
+        future.call = call
+        return future
+
+    @staticmethod
+    def abandon(futures: Iterable[Future]) -> None:
+        """
+        Counts the calls the router stops waiting for as failures of their endpoints
+        """
+        for future in futures:
+            future.call.record(False)
+
+    def candidates(self) -> List[Endpoint]:
+        """
+        Returns the available endpoints, fastest first
+        """
+        available = [endpoint for endpoint in self.endpoints if endpoint.available]
+        return sorted(available, key=lambda endpoint: endpoint.latency)
+
+    @staticmethod
+    def acquire(candidates: deque) -> Optional[Endpoint]:
+        """
+        Pops the candidates until one lets the call through, None if none does
+        """
+        while candidates:
+            endpoint = candidates.popleft()
+            if endpoint.acquire():
+                return endpoint
+        return None
+
+    def read(self, method: str, *args, **kwargs):
+        """
+        Sends a read to the fastest endpoint, hedges it on the next one
+        if it is slow, and tries the following ones if it fails
+        The calls still running when the read returns or raises are abandoned
+        """
+        long_poll = method in LONG_POLLS
+        deadline = monotonic() + timeout_for(f"algod.{method}", LONG_POLL_DEADLINE if long_poll else READ_DEADLINE)
+        candidates = deque(self.candidates())
+        running, error = set(), None
+
+        try:
+            while True:
+                if not running:
+                    endpoint = self.acquire(candidates)
+                    if endpoint is None:
+                        raise error if error is not None else TimeoutError(f"algod {method} failed on every endpoint")
+                    running.add(self.submit(endpoint, deadline, method, *args, **kwargs))
+                    hedge_delay = max(MIN_HEDGE_DELAY, HEDGE_FACTOR * endpoint.latency)
+
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    raise timed_out(f"algod.{method}", TimeoutError(f"algod {method} missed its deadline"))
+                timeout = remaining if long_poll or not candidates else min(remaining, hedge_delay)
+                done, running = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    if future.exception() is None:
+                        return future.result()
+                    error = future.exception()
+                    if isinstance(error, AlgodHTTPError) and (error.code or 500) < 500:
+                        raise error # The endpoint answered, the request itself is wrong
+
+                if not done and candidates and not long_poll: # Slow read, hedge it
+                    endpoint = self.acquire(candidates)
+                    if endpoint is not None:
+                        running.add(self.submit(endpoint, deadline, method, *args, **kwargs))
+                        hedge_delay = max(MIN_HEDGE_DELAY, HEDGE_FACTOR * endpoint.latency)
+        finally:
+            self.abandon(running)
+
+    def write(self, method: str, *args, **kwargs):
+        """
+        Sends a write to the primary endpoint, and to the next ones if it is unavailable
+        Sending the same signed transaction twice is harmless, it has a single id
+        A write isn't started once the budget of the event is spent, but keeps its
+        whole deadline once started, since the transaction may reach the network anyway
+        """
+        check(f"algod.{method}")
+        deadline = monotonic() + WRITE_DEADLINE
+        error = None
+        for endpoint in self.endpoints:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            if not endpoint.acquire():
+                continue
+            future = self.submit(endpoint, deadline, method, *args, **kwargs)
+            try:
+                return future.result(timeout=remaining)
+            except AlgodHTTPError as e: # pylint: disable=C0103
+                if (e.code or 500) < 500:
+                    raise
+                error = e
+            except Exception as e: # pylint: disable=W0703, C0103
+                error = e
+            finally:
+                if not future.done():
+                    self.abandon([future])
+        raise error if error is not None else TimeoutError(f"algod {method} found no endpoint available in time")
+
+    def health(self) -> List[dict]:
+        """
+        Returns the state of every endpoint, for logging
+        """
+        return [{"endpoint": endpoint.name, "latency": endpoint.latency,
+                 "failures": endpoint.failures, "state": endpoint.state}
+                for endpoint in self.endpoints]
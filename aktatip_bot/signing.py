@@ -0,0 +1,189 @@
+"""
+File containing the SigningPipeline class, that builds, signs and encodes
+batches of transfers in a pool of worker processes
+
+The workers get the transfers as user ids, addresses and amounts, and load the
+private keys of the senders from their own read-only connection to the database:
+the keys never leave the workers. Every group comes back as the base64 blob
+send_raw_transaction expects, in the order the groups were given, so the caller
+sends a group while the workers sign the next ones.
+The workers are forked once, before the process starts any other thread
+(see main.py), so they never inherit a lock held by one, and open their
+connection to the database on first use, once it exists.
+
+Running this file runs a benchmark of the signed transactions per second by number of workers:
+    python signing.py [transactions] [max workers]
+"""
+
+import base64
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from time import perf_counter
+from typing import Iterable, Iterator, List, Optional
+
+from algosdk import account, encoding, transaction
+from algosdk.future.transaction import SuggestedParams
+
+from db import DB_PATH
+
+WORKERS = min(4, os.cpu_count() or 1)
+IN_FLIGHT = 4 # Groups queued per worker ahead of the one being sent
+KEY_CACHE_SIZE = 1024 # Wallets kept by each worker
+
+# amount in the base unit of the asset, note in bytes, close_to: address receiving the remaining Algos
+Transfer = namedtuple("Transfer", "sender_id receiver amount asset_id note close_to", defaults=(None, None))
+SignedGroup = namedtuple("SignedGroup", "tx_ids blob") # blob: the group encoded for send_raw_transaction
+
+######################### Worker side #########################
+
+db_path: Optional[str] = None
+connection: Optional[sqlite3.Connection] = None
+
+def init_worker(path: str) -> None:
+    """
+    Sets the database of a worker, connected to on first use
+    """
+    global db_path, connection # pylint: disable=W0603
+    db_path, connection = path, None
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def keys_of(user_id: int) -> tuple:
+    """
+    Returns the (private_key, public_key) of the wallet of a user
+    """
+    global connection # pylint: disable=W0603
+    if connection is None:
+        connection = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    row = connection.execute("SELECT private_key, public_key FROM wallets WHERE user_id = ?", (user_id, )).fetchone()
+    if row is None:
+        raise KeyError(f"No wallet for user {user_id}")
+    return row
+
+def transfer_txn(sender: str, transfer: Transfer, params) -> transaction.Transaction:
+    """
+    Returns an unsigned transfer of an amount of an asset, a payment for Algos
+
+    Args:
+        sender: address of the sender
+        transfer: the receiver, amount, asset, note and close address of the transfer
+        params: suggested params of algod
+    """
+    if transfer.asset_id == 0:
+        return transaction.PaymentTxn(sender, params.min_fee, params.first, params.last, params.gh,
+                                      transfer.receiver, transfer.amount, close_remainder_to=transfer.close_to,
+                                      note=transfer.note, flat_fee=True)
+    return transaction.AssetTransferTxn(sender, params.min_fee, params.first, params.last, params.gh,
+                                        transfer.receiver, transfer.amount, transfer.asset_id,
+                                        close_assets_to=transfer.close_to, note=transfer.note, flat_fee=True)
+
+def sign_group(transfers: List[Transfer], params) -> SignedGroup:
+    """
+    Builds the transfers as one atomic group, signs them with the keys of their senders and encodes them
+    """
+    txns = [transfer_txn(keys_of(transfer.sender_id)[1], transfer, params) for transfer in transfers]
+    if len(txns) > 1:
+        transaction.assign_group_id(txns)
+    signed_txns = [txn.sign(keys_of(transfer.sender_id)[0]) for txn, transfer in zip(txns, transfers)]
+    blob = b"".join(base64.b64decode(encoding.msgpack_encode(signed_txn)) for signed_txn in signed_txns)
+    return SignedGroup([signed_txn.transaction.get_txid() for signed_txn in signed_txns],
+                       base64.b64encode(blob).decode())
+
+def warm_up(_) -> int: # pylint: disable=C0116
+    return os.getpid()
+
+######################### Parent side #########################
+
+class SigningPipeline:
+    """
+    Class streaming groups of transfers through the signing workers
+    """
+    def __init__(self, workers: int = WORKERS, path: str = DB_PATH) -> None:
+        self.workers, self.path = workers, path
+        self.executor = None
+
+    def start(self) -> None:
+        """
+        Forks all the workers at once, to be called before the process starts any other thread
+        """
+        if self.executor is not None:
+            return
+        self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                            mp_context=multiprocessing.get_context("fork"),
+                                            initializer=init_worker, initargs=(self.path, ))
+        list(self.executor.map(warm_up, range(self.workers)))
+
+    def sign(self, groups: Iterable[List[Transfer]], params) -> Iterator[SignedGroup]:
+        """
+        Signs the groups in the workers, keeping IN_FLIGHT groups per worker queued
+
+        Args:
+            groups: lists of at most 16 transfers, each sent as one atomic group
+            params: suggested params of algod, shared by all the groups
+        Returns:
+            iterator: the signed groups, in the order of the groups, as soon as each is ready
+        """
+        self.start()
+        pending = deque()
+        for group in groups:
+            pending.append(self.executor.submit(sign_group, list(group), params))
+            if len(pending) >= self.workers * IN_FLIGHT:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def close(self) -> None: # pylint: disable=C0116
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+signing_pipeline = SigningPipeline()
+
+def benchmark(transactions: int, max_workers: int) -> None:
+    """
+    Measures the signed transactions per second, inline and with more and more workers,
+    on a temporary database of wallets sending groups of 16 transfers to each other
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "benchmark.db")
+        accounts = [account.generate_account() for _ in range(32)]
+        with sqlite3.connect(path) as database:
+            database.execute("CREATE TABLE wallets (user_id INTEGER PRIMARY KEY, private_key TEXT, public_key TEXT)")
+            database.executemany("INSERT INTO wallets VALUES (?, ?, ?)",
+                                 [(user_id, private_key, public_key)
+                                  for user_id, (private_key, public_key) in enumerate(accounts)])
+
+        params = SuggestedParams(1000, 1000, 2000, base64.b64encode(bytes(32)).decode(), flat_fee=True,
+                                 min_fee=1000)
+        transfers = [Transfer(index % 32, accounts[(index + 1) % 32][1], 1000, 10458941)
+                     for index in range(transactions)]
+        groups = [transfers[start:start + 16] for start in range(0, transactions, 16)]
+
+        init_worker(path)
+        started = perf_counter()
+        for group in groups:
+            sign_group(group, params)
+        print(f"inline: {transactions / (perf_counter() - started):.0f} signed transactions per second")
+        keys_of.cache_clear()
+
+        workers = 1
+        while workers <= max_workers:
+            pipeline = SigningPipeline(workers, path)
+            pipeline.start()
+            started = perf_counter()
+            for _ in pipeline.sign(groups, params):
+                pass
+            elapsed = perf_counter() - started
+            pipeline.close()
+            print(f"{workers} workers: {transactions / elapsed:.0f} signed transactions per second")
+            workers *= 2
+
+if __name__ == "__main__":
+    TRANSACTIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    MAX_WORKERS = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count() or 1
+    benchmark(TRANSACTIONS, MAX_WORKERS)
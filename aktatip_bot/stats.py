@@ -0,0 +1,158 @@
+"""
+File containing the tipping statistics, kept as rollups per subreddit and per week
+that are updated when a tip is confirmed, so that reading a leaderboard never
+scans the transaction history
+
+Running this file rebuilds the rollups from the transactions table:
+    python stats.py rebuild
+"""
+
+import sys
+from collections import defaultdict
+from time import gmtime, strftime, time
+from typing import List, Optional, Tuple
+
+from assets import AKTA_ID, Asset, asset_registry
+from clients import db, reddit, traffic
+from logs import logger
+from templates import LEADERBOARD, LEADERBOARD_LINE, LEADERBOARD_EMPTY, LEADERBOARD_TITLE
+from utils import init_db
+
+ALL = "" # Value of the subreddit/week columns of the rollups over all subreddits/all time
+LEADERBOARD_SIZE = 10
+SUMMARY_POST_INTERVAL = None # Seconds between two leaderboard posts in the subreddits, None to disable
+
+UPSERT_TIP = """
+    INSERT INTO tip_stats (subreddit, week, asset_id, user_id,
+                           sent_amount, sent_count, received_amount, received_count)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (subreddit, week, asset_id, user_id) DO UPDATE SET
+        sent_amount = sent_amount + excluded.sent_amount,
+        sent_count = sent_count + excluded.sent_count,
+        received_amount = received_amount + excluded.received_amount,
+        received_count = received_count + excluded.received_count
+"""
+
+def week_of(timestamp: float) -> str:
+    """
+    Returns the week a timestamp belongs to, formatted like sqlite's strftime('%Y-W%W')
+    """
+    return strftime("%Y-W%W", gmtime(timestamp))
+
+def scopes(subreddit: Optional[str], week: str) -> List[Tuple[str, str]]:
+    """
+    Returns the (subreddit, week) rollups a tip counts in
+    Tips sent by message only count in the rollups over all subreddits
+    """
+    subreddits = [ALL, subreddit.lower()] if subreddit else [ALL]
+    return [(sub, period) for sub in subreddits for period in (ALL, week)]
+
+def tip_rows(sender_id, receiver_id, amount, asset_id, subreddit, timestamp): # pylint: disable=R0913
+    """
+    Returns the upsert parameters of a tip, for the sender and the receiver
+    of every rollup the tip counts in
+    """
+    rows = []
+    for sub, period in scopes(subreddit, week_of(timestamp)):
+        rows.append((sub, period, asset_id, sender_id, amount, 1, 0, 0))
+        rows.append((sub, period, asset_id, receiver_id, 0, 0, amount, 1))
+    return rows
+
+def record_tip(sender_id, receiver_id, amount, asset_id, subreddit): # pylint: disable=R0913
+    """
+    Adds a confirmed tip to the rollups
+
+    Args:
+        sender_id: user id of the sender
+        receiver_id: user id of the receiver
+        amount: amount tipped, in the base unit of the asset
+        asset_id: id of the asset tipped
+        subreddit: subreddit the tip was sent from, None for messages
+    """
+    db.write_many(UPSERT_TIP, tip_rows(sender_id, receiver_id, amount, asset_id, subreddit, time())).result()
+
+def record_tips(tips) -> None:
+    """
+    Adds several confirmed tips to the rollups in a single transaction
+
+    Args:
+        tips: iterable of (sender_id, receiver_id, amount, asset_id, subreddit) tuples
+    """
+    now = time()
+    db.write_many(UPSERT_TIP, [row for tip in tips for row in tip_rows(*tip, now)]).result()
+
+def top(subreddit: str = ALL, week: str = ALL, asset_id: int = AKTA_ID,
+        role: str = "sent", limit: int = LEADERBOARD_SIZE) -> List[Tuple[str, int, int]]:
+    """
+    Returns the top tippers or receivers of a rollup, read from its index
+
+    Args:
+        subreddit: subreddit of the rollup, ALL for every subreddit
+        week: week of the rollup, ALL for all time
+        asset_id: the asset tipped
+        role: "sent" for the top tippers, "received" for the top receivers
+        limit: number of users to return
+    Returns:
+        list: (name, amount, count) tuples, in decreasing amount order
+    """
+    if role not in ("sent", "received"):
+        raise ValueError(role)
+    query = (f"SELECT users.name, {role}_amount, {role}_count FROM tip_stats "
+             "JOIN users ON users.id = tip_stats.user_id "
+             f"WHERE subreddit = ? AND week = ? AND asset_id = ? AND {role}_count > 0 "
+             f"ORDER BY {role}_amount DESC LIMIT ?")
+    return db.read(query, (subreddit.lower(), week, asset_id, limit))
+
+def leaderboard(subreddit: str = ALL, week: str = ALL, asset: Asset = None) -> str:
+    """
+    Returns the leaderboard of a rollup formatted as a reply, for the default asset if none is given
+    """
+    asset = asset or asset_registry.default
+    def lines(rows):
+        if not rows:
+            return LEADERBOARD_EMPTY
+        return "\n\n".join(LEADERBOARD_LINE.substitute(rank=rank, name=name, count=count,
+                                                       amount=asset.from_units(amount), unit=asset.unit_name)
+                           for rank, (name, amount, count) in enumerate(rows, 1))
+
+    return LEADERBOARD.substitute(scope=f"r/{subreddit}" if subreddit else "all subreddits",
+                                  period=f"week {week}" if week else "all time",
+                                  tippers=lines(top(subreddit, week, asset.asset_id, role="sent")),
+                                  receivers=lines(top(subreddit, week, asset.asset_id, role="received")))
+
+def post_summaries(subreddits) -> None:
+    """
+    Posts the leaderboard of the current week in each of the given subreddits
+    """
+    week = week_of(time())
+    for subreddit in subreddits:
+        traffic.call("reddit", "submit", reddit.subreddit(subreddit).submit,
+                     LEADERBOARD_TITLE.substitute(unit=asset_registry.default.unit_name, week=week),
+                     selftext=leaderboard(subreddit, week))
+        logger.info("Leaderboard posted", week=week, subreddit=subreddit)
+
+def rebuild() -> None:
+    """
+    Recomputes every rollup from the confirmed tips of the transactions table
+    """
+    totals = defaultdict(lambda: [0, 0, 0, 0])
+    for sender_id, receiver_id, amount, asset_id, subreddit, confirmed_at in db.read(
+            "SELECT sender_id, receiver_id, amount, asset_id, subreddit, confirmed_at "
+            "FROM transactions WHERE kind = 'tip' AND confirmed_at IS NOT NULL"):
+        for row in tip_rows(sender_id, receiver_id, amount, asset_id, subreddit, confirmed_at):
+            total = totals[row[:4]]
+            for i, value in enumerate(row[4:]):
+                total[i] += value
+
+    def replace(connection):
+        connection.execute("DELETE FROM tip_stats")
+        connection.executemany(UPSERT_TIP, [key + tuple(total) for key, total in totals.items()])
+    db.run(replace).result()
+    logger.info("Tip statistics rebuilt", rows=len(totals))
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["rebuild"]:
+        sys.exit("usage: python stats.py rebuild")
+    init_db()
+    rebuild()
+    logger.close()
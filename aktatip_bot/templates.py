@@ -6,29 +6,28 @@ from string import Template
 
 from clients import NETWORK
 
-AKTA_ID = 10458941
-
 ALGOEXPLORER_LINK = f"https://{'testnet.' if NETWORK == 'testnet' else ''}algoexplorer.io"
 
-TRANSACTION_CONFIRMATION = Template("Your tip to $receiver for $amount AKTAs was successfuly sent \n\n"
+TRANSACTION_CONFIRMATION = Template("Your tip to $receiver for $amount $unit was successfuly sent \n\n"
                                     f"You can check the transaction [here]({ALGOEXPLORER_LINK}/tx/$transaction_id)")
 
+INTERNAL_TRANSACTION_CONFIRMATION = Template("Your tip to $receiver for $amount $unit was successfuly sent \n\n"
+                                             "It will be settled on chain with the next batch of tips")
+
+TRANSACTION_FAILED = Template("Your transaction of $amount $unit could not be confirmed by the network "
+                              "($error), nothing was sent. \n\n"
+                              "Please check your balance with `wallet` and try again")
+
 WALLET_REPR = Template(f"Public key : [$public_key]({ALGOEXPLORER_LINK}/address/$public_key) "
                        "[(QR Code)]($qr_code_link) \n\n"
                        "Private key : $private_key \n\n"
-                       "Balance : $balanceAKTA AKTA, $balance Algos")
+                       "Balance : $balances")
 
 WALLET_CREATED = Template("Wallet created for user $user \n"
                           "Public key : $public_key")
 
-EVENT_RECEIVED = Template("Received a new $event_type from $author\n"
-                          "Event body : $body")
-
 
-WITHDRAWAL_CONFIRMATION = Template(f"Withdrawal of $amount AKTAs to address [$address]({ALGOEXPLORER_LINK}/address/$address) successful \n\n"
-                                   f"You can check the transaction [here]({ALGOEXPLORER_LINK}/tx/$transaction_id)")
-
-WITHDRAWAL_ALGO_CONFIRMATION = Template(f"Withdrawal of $amount Algos to address [$address]({ALGOEXPLORER_LINK}/address/$address) successful \n\n"
+WITHDRAWAL_CONFIRMATION = Template(f"Withdrawal of $amount $unit to address [$address]({ALGOEXPLORER_LINK}/address/$address) successful \n\n"
                                    f"You can check the transaction [here]({ALGOEXPLORER_LINK}/tx/$transaction_id)")
 
 NO_WALLET = ("You do not have an account yet. To open one, click on this "
@@ -38,29 +37,84 @@ NO_WALLET = ("You do not have an account yet. To open one, click on this "
 INVALID_COMMAND = ("Sorry, I didn't understand what you were trying to do. \n\n"
                    "List of available commands: \n\n"
                    "**Comment:** - Comment to a post/comment \n\n"
-                   "!atip *amount* - Give tip to the author of post/comment \n\n"
+                   "!atip *amount* *unit* - Give tip to the author of post/comment \n\n"
                    "**Message:** - Send direct message to the bot \n\n"
                    "wallet -  Get private/public keys of your wallet and your current balance \n\n"
-                   "optin -  Opt-in to AKTA, make sure you have at least 0.11 Algo before send this \n\n"
-                   "withdraw *amount* *address* -  Send AKTAs to any wallet \n\n"
+                   "optin *unit* -  Opt-in to an asset, make sure you have at least 0.11 Algo before send this \n\n"
+                   "withdraw *amount* *unit* *address* -  Send AKTAs or another asset to any wallet \n\n"
                    "algowithdraw *amount* *address* -  Send Algos to any wallet \n\n"
-                   "tip *amount* *redditorName* -  Send anon tip to a redditor")
-INSUFFICIENT_FUNDS = Template("You tried to take $amount AKTA/Algo out of your wallet"
+                   "tip *amount* *unit* *redditorName* -  Send anon tip to a redditor \n\n"
+                   "rain *amount* *unit* *threadUrl|redditorNames* -  Tip every commenter of a thread, or every redditor of a comma-separated list \n\n"
+                   "history -  List your latest transactions \n\n"
+                   "leaderboard *subreddit* *all* *unit* -  Top tippers of the week, optionally of a subreddit or of all time \n\n"
+                   "*unit* is optional and AKTA by default")
+INSUFFICIENT_FUNDS = Template("You tried to take $amount $unit out of your wallet"
                               " but you currently do not have enough funds to do this "
                               "transaction.\n\n"
                               "You can use `wallet` to get your address and fund your account\n\n"
                               "**Note :** the wallet needs to have 0.1 Algos to be active. "
                               "You can still withdraw it by using `withdraw all <address>`")
 
+RAIN_SUMMARY = Template("It rained $amount $unit on $count redditors! \n\n"
+                        "$skipped redditors were skipped because they have no wallet opted in $unit, "
+                        "$failed tips failed")
+RAIN_FAILED = ("The rain stopped early because of an error, for instance a thread that can't be read. "
+               "The tips that were not sent yet were cancelled.")
+RAIN_INSUFFICIENT_FUNDS = ("The rain stopped early because your wallet ran out of funds. \n\n"
+                           "You can use `wallet` to get your address and fund your account")
+
+PROFILE_STARTED = Template("Profiling the main loop for $duration seconds, "
+                           "the results will be written to the profiles directory")
+
+EVENT_TIMED_OUT = ("Sorry, I couldn't reach Reddit or the Algorand network in time to handle your command, "
+                   "even after a few tries. Nothing was sent, please try again later.")
+
+SLOW_DOWN = ("You are sending me commands faster than I can handle them, so I skipped some of them: "
+             "nothing was sent for the skipped commands. "
+             "Please wait a few minutes before sending new ones.")
+
 USER_NOT_FOUND = Template("Hey, I see that you tried to tip `$username`, "
                           "but I can't find a redditor with that username.")
 
-ZERO_TRANSACTION = ("I cancelled your transaction because you tried to do a transaction"
-                    " of less than 1e-6 Algos, which is the smallest fraction "
-                    "of Algos. This transaction would send 0 Algos and make you lose the fee.")
+ZERO_TRANSACTION = Template("I cancelled your transaction because you tried to do a transaction"
+                            " of less than $smallest $unit, which is the smallest fraction "
+                            "of $unit. This transaction would send 0 $unit and make you lose the fee.")
+
+OPT_IN = Template("Sucessfully opted in $unit, from now you can receive tips.")
+
+SENDER_NOT_OPT_IN = Template("You are not opt in $unit, transfer 0.2+ algos and send `optin $unit` message to the bot to opt in.")
+
+RECEIVER_NOT_OPT_IN = Template("The target is not opted in $unit. Transfer cancelled.")
+
+DEPOSIT_SUBJECT = "Deposit received"
+
+DEPOSIT_RECEIVED = Template("Your wallet received a deposit of $amount $unit from "
+                            f"[$sender]({ALGOEXPLORER_LINK}/address/$sender) \n\n"
+                            f"You can check the transaction [here]({ALGOEXPLORER_LINK}/tx/$transaction_id)")
+
+HISTORY_TIP_SENT = Template("$date - Tip of $amount $unit to u/$receiver$subreddit - $details")
+
+HISTORY_TIP_RECEIVED = Template("$date - Tip of $amount $unit from u/$sender$subreddit - $details")
+
+HISTORY_WITHDRAWAL = Template("$date - Withdrawal of $amount $unit to $destination - $details")
+
+HISTORY_OPT_IN = Template("$date - Opt-in to $unit - $details")
+
+HISTORY_DETAILS = Template(f"[details]({ALGOEXPLORER_LINK}/tx/$transaction_id)")
+
+HISTORY_INTERNAL = "off-chain"
+
+HISTORY_FAILED = "failed, nothing was sent"
+
+HISTORY_NEXT_PAGE = Template("Send `history $cursor` to see older transactions")
+
+HISTORY_EMPTY = "No transaction found."
+
+LEADERBOARD = Template("**Top tippers of $scope, $period** \n\n$tippers \n\n"
+                       "**Top receivers of $scope, $period** \n\n$receivers")
 
-OPT_IN = ("Sucessfully opted in AKTA, from now you can receive tips.")
+LEADERBOARD_LINE = Template("$rank. u/$name - $amount $unit ($count tips)")
 
-SENDER_NOT_OPT_IN = "You are not opt in AKTA, transfer 0.2+ algos and send optin message to the bot to opt in."
+LEADERBOARD_EMPTY = "No tips yet."
 
-RECEIVER_NOT_OPT_IN = ("The target is not opted in AKTA. Transfer cancelled.")
+LEADERBOARD_TITLE = Template("$unit tipping leaderboard of $week")
@@ -2,12 +2,161 @@
 Utility functions
 """
 
+from time import time
+
 from prawcore.exceptions import NotFound, ServerError
 
-from clients import algod, reddit, cur, con
+from clients import reddit, db, traffic
 
 COMMENT_COMMANDS = {"!asatip"}
+MESSAGE_COMMANDS = {"tip", "withdraw", "algowithdraw", "optin", "wallet", "history", "leaderboard", "profile",
+                    "rain"}
 SUBREDDITS = {"bottesting"}
+ADMINS = {"redswoosh"}
+
+TABLES = """
+CREATE TABLE IF NOT EXISTS deposits (
+    tx_id TEXT PRIMARY KEY,
+    user_id INTEGER,
+    sender TEXT,
+    asset_id INTEGER,
+    amount INTEGER,
+    round INTEGER
+);
+CREATE INDEX IF NOT EXISTS deposits_user_id ON deposits (user_id);
+CREATE INDEX IF NOT EXISTS users_id ON users (id);
+CREATE INDEX IF NOT EXISTS users_name_nocase ON users (name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS wallets_user_id ON wallets (user_id);
+CREATE TABLE IF NOT EXISTS assets (
+    asset_id INTEGER PRIMARY KEY,
+    unit_name TEXT,
+    decimals INTEGER,
+    name TEXT
+);
+CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY,
+    kind TEXT,
+    sender_id INTEGER,
+    receiver_id INTEGER,
+    destination TEXT,
+    amount INTEGER,
+    asset_id INTEGER,
+    tx_id TEXT,
+    round INTEGER,
+    subreddit TEXT,
+    first_round INTEGER,
+    last_round INTEGER,
+    created_at INTEGER,
+    confirmed_at INTEGER,
+    error TEXT -- Why the transaction was never confirmed, NULL while pending or once confirmed
+);
+CREATE UNIQUE INDEX IF NOT EXISTS transactions_tx_id ON transactions (tx_id);
+CREATE INDEX IF NOT EXISTS transactions_sender_id ON transactions (sender_id, id);
+CREATE INDEX IF NOT EXISTS transactions_receiver_id ON transactions (receiver_id, id);
+CREATE TABLE IF NOT EXISTS tip_stats (
+    subreddit TEXT,
+    week TEXT,
+    asset_id INTEGER,
+    user_id INTEGER,
+    sent_amount INTEGER DEFAULT 0,
+    sent_count INTEGER DEFAULT 0,
+    received_amount INTEGER DEFAULT 0,
+    received_count INTEGER DEFAULT 0,
+    PRIMARY KEY (subreddit, week, asset_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS tip_stats_sent ON tip_stats (subreddit, week, asset_id, sent_amount DESC);
+CREATE INDEX IF NOT EXISTS tip_stats_received ON tip_stats (subreddit, week, asset_id, received_amount DESC);
+CREATE TABLE IF NOT EXISTS events (
+    fullname TEXT PRIMARY KEY,
+    state TEXT,
+    tx_id TEXT,
+    updated_at INTEGER
+);
+CREATE INDEX IF NOT EXISTS events_state ON events (state);
+INSERT OR IGNORE INTO events SELECT 't1_' || id, 'replied', NULL, 0 FROM comments;
+CREATE TABLE IF NOT EXISTS ledger_entries (
+    id INTEGER PRIMARY KEY,
+    transaction_id INTEGER,
+    settlement_id INTEGER,
+    user_id INTEGER NOT NULL,
+    asset_id INTEGER NOT NULL,
+    amount INTEGER NOT NULL,
+    created_at INTEGER,
+    kind TEXT DEFAULT 'transfer'
+);
+CREATE INDEX IF NOT EXISTS ledger_entries_settlement_id ON ledger_entries (settlement_id);
+CREATE TABLE IF NOT EXISTS ledger_positions (
+    user_id INTEGER NOT NULL,
+    asset_id INTEGER NOT NULL,
+    amount INTEGER NOT NULL,
+    PRIMARY KEY (user_id, asset_id)
+);
+CREATE TABLE IF NOT EXISTS settlements (
+    id INTEGER PRIMARY KEY,
+    asset_id INTEGER NOT NULL,
+    state TEXT,
+    tx_id TEXT,
+    first_round INTEGER,
+    last_round INTEGER,
+    created_at INTEGER,
+    confirmed_round INTEGER
+);
+CREATE INDEX IF NOT EXISTS settlements_state ON settlements (state);
+CREATE TABLE IF NOT EXISTS rain_jobs (
+    id INTEGER PRIMARY KEY,
+    fullname TEXT,
+    sender_id INTEGER NOT NULL,
+    asset_id INTEGER NOT NULL,
+    amount INTEGER NOT NULL,
+    thread_id TEXT,
+    state TEXT,
+    error TEXT,
+    created_at INTEGER,
+    finished_at INTEGER
+);
+CREATE INDEX IF NOT EXISTS rain_jobs_state ON rain_jobs (state);
+CREATE TABLE IF NOT EXISTS rain_recipients (
+    job_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    state TEXT,
+    user_id INTEGER,
+    tx_id TEXT,
+    group_id TEXT,
+    first_round INTEGER,
+    last_round INTEGER,
+    PRIMARY KEY (job_id, name)
+);
+CREATE INDEX IF NOT EXISTS rain_recipients_state ON rain_recipients (job_id, state);
+CREATE INDEX IF NOT EXISTS rain_recipients_group_id ON rain_recipients (group_id);
+CREATE TABLE IF NOT EXISTS opt_ins (
+    public_key TEXT NOT NULL,
+    asset_id INTEGER NOT NULL,
+    PRIMARY KEY (asset_id, public_key)
+);
+CREATE TABLE IF NOT EXISTS indexer_state (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    last_round INTEGER NOT NULL
+);
+"""
+
+# States of the events in the events table
+RECEIVED = "received" # Streamed, not handled yet
+SUBMITTED = "submitted" # A transaction was sent, its confirmation wasn't replied yet
+REPLIED = "replied" # Done
+FAILED = "failed" # The transaction was rejected or expired, the failure was replied
+
+HISTORY_PAGE_SIZE = 10
+
+# Transaction rows waiting to be written, flushed once per tick of the main loop
+transactions_to_save = []
+confirmations_to_save = []
+failures_to_save = []
+
+def init_db():
+    """
+    Creates the tables and indexes that are missing from the db
+    """
+    db.run(lambda connection: connection.executescript(TABLES)).result()
 
 def is_float(value: str) -> bool:
     """
@@ -39,108 +188,288 @@ def valid_user(username: str) -> bool:
             True if username exists
             False otherwise
     """
-    try:
-        reddit.redditor(username).id
-    except NotFound:
-        return False
-    return True
+    def exists():
+        try:
+            reddit.redditor(username).id
+        except NotFound:
+            return False
+        return True
+    return traffic.call("reddit", "valid_user", exists)
 
 def save_wallet(user_id, private_key, public_key):
     """
     Saves the walletdata to the db
     """
-    cur.execute("INSERT INTO wallets VALUES (?, ?, ?)", (user_id, private_key, public_key))
-    con.commit()
+    db.write("INSERT INTO wallets VALUES (?, ?, ?)", (user_id, private_key, public_key)).result()
 
 def get_wallet_by_userId(user_id):
     """
     Gets the wallet private/public kaye from the db based on user id
     """
-    for row in cur.execute('SELECT * FROM wallets WHERE user_id = ?', (user_id, )):
+    row = db.read_one('SELECT * FROM wallets WHERE user_id = ?', (user_id, ))
+    if row is not None:
         return {'private_key': row[1], 'public_key': row[2]}
+    return None
+def get_public_keys(user_ids):
+    """
+    Gets the addresses of the wallets of several users with a single query, without their private keys
+    """
+    user_ids = list(user_ids)
+    return dict(db.read(f"SELECT user_id, public_key FROM wallets WHERE user_id IN ({', '.join('?' * len(user_ids))})",
+                        user_ids))
 def save_user(name, id):
     """
     Saves the user data to the db
     """
-    cur.execute("INSERT INTO users VALUES (?, ?)", (id, name))
-    con.commit()
+    db.write("INSERT INTO users VALUES (?, ?)", (id, name)).result()
 def get_userId_by_name(name):
     """
     Gets the userid from the db based on user name
     """
-    for row in cur.execute("SELECT id FROM users where name = ?", (name, )):
-        return row[0]
-    return None
-def get_next_userId():
+    row = db.read_one("SELECT id FROM users where name = ?", (name, ))
+    return row[0] if row is not None else None
+def get_name_by_userId(user_id):
     """
-    Gets the next userid from the db
+    Gets the user name from the db based on user id
     """
-    for row in cur.execute('SELECT count(*) FROM users'):
-        return row[0] + 1
-
-def get_comment_cache():
+    row = db.read_one("SELECT name FROM users where id = ?", (user_id, ))
+    return row[0] if row is not None else None
+def get_wallet_index():
     """
-    Gets the processed comments from the db
+    Gets a dict mapping every public key managed by the bot to its user id
     """
-    comments = []
-    for row in cur.execute('SELECT id FROM comments'):
-        comments.append(row[0])
-    return comments
-def add_comment_cache(comments):
+    return {row[1]: row[0] for row in db.read('SELECT user_id, public_key FROM wallets')}
+def save_opt_ins(opt_ins, opt_outs=()):
     """
-    Saves the processing comments to the db
+    Saves the assets the wallets opted in and out of, in a single commit
+
+    Args:
+        opt_ins: iterable of (public_key, asset_id) tuples
+        opt_outs: iterable of (public_key, asset_id) tuples
     """
-    for comment in comments:
-        cur.execute("INSERT INTO comments VALUES (?)", (str(comment), ))
-        con.commit()
-  
-def stream():
+    opt_ins, opt_outs = list(opt_ins), list(opt_outs)
+    def write(connection):
+        connection.executemany("INSERT OR IGNORE INTO opt_ins VALUES (?, ?)", opt_ins)
+        connection.executemany("DELETE FROM opt_ins WHERE public_key = ? AND asset_id = ?", opt_outs)
+    db.run(write).result()
+def get_opted_in(public_keys, asset_id):
     """
-    Fetches the unread items in the inbox and all comments in the
-    targeted subreddits that contain an AlgoTip command
-    Adds the comments to a cache to know which ones were already dealt with
+    Gets which of the given wallets are known to be opted in an asset, with a single indexed query
     """
-    try:
-        inbox_unread = set(reddit.inbox.unread())
-        comment_cache = get_comment_cache()
-        comments = {comment for comment in reddit.subreddit("+".join(SUBREDDITS)).comments(limit=100)
-                            if any(command in comment.body for command in COMMENT_COMMANDS)
-                            and comment.id not in comment_cache}
-    except ServerError: # Avoid having the bot crash everytime the Reddit API is struggling
+    public_keys = list(public_keys)
+    if not public_keys:
         return set()
+    return {row[0] for row in db.read("SELECT public_key FROM opt_ins WHERE asset_id = ? AND "
+                                      f"public_key IN ({', '.join('?' * len(public_keys))})",
+                                      [asset_id] + public_keys)}
+def save_block(round_num, deposits, opt_ins, opt_outs):
+    """
+    Saves what the block indexer found in a block and that the block was processed, in a single commit
+    Deposits already saved are ignored
+
+    Args:
+        round_num: the round of the block
+        deposits: iterable of (tx_id, user_id, sender, asset_id, amount, round) tuples
+        opt_ins: iterable of (public_key, asset_id) tuples
+        opt_outs: iterable of (public_key, asset_id) tuples
+    """
+    def write(connection):
+        connection.executemany("INSERT OR IGNORE INTO deposits VALUES (?, ?, ?, ?, ?, ?)", deposits)
+        connection.executemany("INSERT OR IGNORE INTO opt_ins VALUES (?, ?)", opt_ins)
+        connection.executemany("DELETE FROM opt_ins WHERE public_key = ? AND asset_id = ?", opt_outs)
+        connection.execute("INSERT OR REPLACE INTO indexer_state VALUES (1, ?)", (round_num, ))
+    db.run(write).result()
+def get_indexed_round():
+    """
+    Gets the last round processed by the block indexer, None if it never ran
+    """
+    row = db.read_one("SELECT last_round FROM indexer_state WHERE id = 1")
+    return row[0] if row else None
+def queue_transaction(kind, sender_id, receiver_id, destination, amount, asset_id, tx_id, subreddit, # pylint: disable=R0913
+                      first_round, last_round):
+    """
+    Queues a sent transaction to be saved to the db on the next flush
+    Its valid rounds are kept so that a restart can look for it in the blocks it may be in
+
+    Args:
+        kind: tip, withdraw, algowithdraw or optin
+        sender_id: user id of the sender
+        receiver_id: user id of the receiver, None if the receiver isn't a user
+        destination: address the transaction was sent to
+        amount: amount sent, in the base unit of the asset
+        asset_id: id of the asset sent, 0 for Algos
+        tx_id: id of the Algorand transaction
+        subreddit: subreddit the tip was sent from, None for messages
+        first_round: first round the transaction is valid in
+        last_round: last round the transaction is valid in
+    """
+    transactions_to_save.append((kind, sender_id, receiver_id, destination, amount,
+                                 asset_id, tx_id, subreddit, first_round, last_round, int(time())))
+def queue_confirmation(tx_id, confirmed_round):
+    """
+    Queues the confirmation of a transaction to be saved to the db on the next flush
+    """
+    confirmations_to_save.append((confirmed_round, int(time()), tx_id))
+def queue_failure(tx_id, error):
+    """
+    Queues that a transaction was rejected or expired, to be saved to the db on the next flush
+    """
+    failures_to_save.append((error, tx_id))
+def flush_transactions():
+    """
+    Saves the queued transactions, confirmations and failures to the db in a single commit
+    """
+    if not (transactions_to_save or confirmations_to_save or failures_to_save):
+        return
+    transactions, confirmations = list(transactions_to_save), list(confirmations_to_save)
+    failures = list(failures_to_save)
+    transactions_to_save.clear()
+    confirmations_to_save.clear()
+    failures_to_save.clear()
+
+    def flush(connection):
+        insert_transactions(connection, transactions)
+        connection.executemany("UPDATE transactions SET round = ?, confirmed_at = ? WHERE tx_id = ?",
+                               confirmations)
+        connection.executemany("UPDATE transactions SET error = ? WHERE tx_id = ?", failures)
+    db.run(flush).result()
+def insert_transactions(connection, transactions):
+    """
+    Inserts rows queued by queue_transaction, transactions already saved are ignored
+    """
+    connection.executemany("INSERT OR IGNORE INTO transactions (kind, sender_id, receiver_id, destination, "
+                           "amount, asset_id, tx_id, subreddit, first_round, last_round, created_at) "
+                           "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                           transactions)
+def get_submitted_transactions(tx_ids):
+    """
+    Gets the saved transactions with the given ids and the names of their receivers, with a single indexed query
+
+    Args:
+        tx_ids: ids of the Algorand transactions
+    Returns:
+        dict: (kind, sender_id, receiver_id, receiver name, destination, amount, asset_id, subreddit, round,
+              first_round, last_round) tuples keyed by tx_id
+    """
+    tx_ids = list(tx_ids)
+    if not tx_ids:
+        return {}
+    query = f"""
+        SELECT t.tx_id, t.kind, t.sender_id, t.receiver_id, r.name, t.destination, t.amount, t.asset_id,
+               t.subreddit, t.round, t.first_round, t.last_round
+        FROM transactions t LEFT JOIN users r ON r.id = t.receiver_id
+        WHERE t.tx_id IN ({', '.join('?' * len(tx_ids))})
+    """
+    return {row[0]: row[1:] for row in db.read(query, tx_ids)}
+def get_transaction_history(user_id, before_id=None, limit=HISTORY_PAGE_SIZE):
+    """
+    Gets a page of the transactions sent or received by a user, most recent first
+    Uses keyset pagination on the transaction id so that every page costs the same
 
-    if comments:
-        add_comment_cache(comments)
+    Args:
+        user_id: the user whose transactions are fetched
+        before_id: only fetch transactions older than this id, None for the first page
+        limit: maximum number of transactions to fetch
+    Returns:
+        list: rows of (id, kind, sender name, receiver name, destination, amount,
+              asset_id, tx_id, round, subreddit, created_at, error), error being None
+              unless the transaction failed
+    """
+    before_id = before_id if before_id is not None else 2**63 - 1
+    query = """
+        SELECT t.id, t.kind, s.name, r.name, t.destination, t.amount, t.asset_id,
+               t.tx_id, t.round, t.subreddit, t.created_at, t.error
+        FROM (
+            SELECT * FROM (SELECT * FROM transactions WHERE sender_id = ? AND id < ?
+                           ORDER BY id DESC LIMIT ?)
+            UNION
+            SELECT * FROM (SELECT * FROM transactions WHERE receiver_id = ? AND id < ?
+                           ORDER BY id DESC LIMIT ?)
+        ) t
+        LEFT JOIN users s ON s.id = t.sender_id
+        LEFT JOIN users r ON r.id = t.receiver_id
+        ORDER BY t.id DESC LIMIT ?
+    """
+    return db.read(query, (user_id, before_id, limit, user_id, before_id, limit, limit))
+def get_next_userId():
+    """
+    Gets the next userid from the db
+    """
+    return db.read_one('SELECT count(*) FROM users')[0] + 1
 
-    return set.union(inbox_unread, comments)
+def get_event_states(fullnames):
+    """
+    Gets the state of the given events from the db, with a single indexed query
 
+    Args:
+        fullnames: reddit fullnames of the events
+    Returns:
+        dict: state of each event found in the db, keyed by fullname
+    """
+    fullnames = list(fullnames)
+    if not fullnames:
+        return {}
+    query = f"SELECT fullname, state FROM events WHERE fullname IN ({', '.join('?' * len(fullnames))})"
+    return dict(db.read(query, fullnames))
+def save_received_events(fullnames):
+    """
+    Saves newly streamed events to the db, events already saved are left untouched
+    """
+    db.write_many("INSERT OR IGNORE INTO events VALUES (?, ?, NULL, ?)",
+                  [(fullname, RECEIVED, int(time())) for fullname in fullnames]).result()
+def save_submitted_event(fullname, tx_id):
+    """
+    Saves that a transaction was sent for an event, in the same commit as the queued
+    transaction rows so that the event can be resumed from its transaction after a restart
+    """
+    transactions = list(transactions_to_save)
+    transactions_to_save.clear()
 
-# Comes from https://developer.algorand.org/docs/build-apps/hello_world/
-def wait_for_confirmation(transaction_id, timeout):
+    def submit(connection):
+        insert_transactions(connection, transactions)
+        connection.execute("INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?)",
+                           (fullname, SUBMITTED, tx_id, int(time())))
+    db.run(submit).result()
+def save_finished_event(fullname, confirmed=False):
     """
-    Wait until the transaction is confirmed or rejected, or until 'timeout'
-    number of rounds have passed.
+    Saves that an event was dealt with
+    Events with a sent transaction are only finished once its confirmation is replied
+
     Args:
-        transaction_id (str): the transaction to wait for
-        timeout (int): maximum number of rounds to wait
+        fullname: reddit fullname of the event
+        confirmed: True when the confirmation of the transaction of the event was replied
+    """
+    db.write("INSERT INTO events VALUES (?, ?, NULL, ?) ON CONFLICT (fullname) DO UPDATE SET "
+             "state = excluded.state, updated_at = excluded.updated_at WHERE state != ? OR ?",
+             (fullname, REPLIED, int(time()), SUBMITTED, confirmed)).result()
+def save_failed_event(fullname):
+    """
+    Saves that the transaction of an event failed and that the failure was replied
+    """
+    db.write("UPDATE events SET state = ?, updated_at = ? WHERE fullname = ?", (FAILED, int(time()), fullname)).result()
+def get_unfinished_events():
+    """
+    Gets the events that were received or submitted but not replied, with a single indexed query
+
     Returns:
-        dict: pending transaction information, or throws an error if the transaction
-            is not confirmed or rejected in the next timeout rounds
+        list: (fullname, state, tx_id) tuples
     """
-    start_round = algod.status()["last-round"] + 1
-    current_round = start_round
+    return db.read("SELECT fullname, state, tx_id FROM events WHERE state IN (?, ?)", (RECEIVED, SUBMITTED))
 
-    while current_round < start_round + timeout:
+def stream():
+    """
+    Fetches the unread items in the inbox and all comments in the
+    targeted subreddits that contain an AlgoTip command
+    Comments already in the events table were already dealt with
+    """
+    def fetch():
         try:
-            pending_txn = algod.pending_transaction_info(transaction_id)
-        except Exception: # pylint: disable=W0703
-            return None
-        if pending_txn.get("confirmed-round", 0) > 0: # pylint: disable=R1705
-            return pending_txn
-        elif pending_txn["pool-error"]: # pylint: disable=R1705
-            raise Exception(
-                'pool error: {}'.format(pending_txn["pool-error"]))
-        algod.status_after_block(current_round)
-        current_round += 1
-    raise TimeoutError(
-        'pending tx not found in timeout rounds, timeout value = : {}'.format(timeout))
+            inbox_unread = set(reddit.inbox.unread())
+            comments = [comment for comment in reddit.subreddit("+".join(SUBREDDITS)).comments(limit=100)
+                                if any(command in comment.body for command in COMMENT_COMMANDS)]
+        except ServerError: # Avoid having the bot crash everytime the Reddit API is struggling
+            return set()
+
+        known = get_event_states(comment.fullname for comment in comments)
+        return set.union(inbox_unread, {comment for comment in comments if comment.fullname not in known})
+    return traffic.events(fetch)
@@ -0,0 +1,70 @@
+"""
+File containing a local HTTP stand-in of algod, with injected latency and failures
+Every answer carries the name of the stand-in, so the tests know which endpoint answered
+"""
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+
+from router import TimedAlgodClient
+
+class AlgodStandIn:
+    """
+    Class running a fake algod on a free local port until stopped
+    """
+    def __init__(self, name: str, latency: float = 0.0, status: int = 200) -> None:
+        self.name, self.latency, self.status = name, latency, status
+        self.hits = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def address(self) -> str: # pylint: disable=C0116
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def client(self) -> TimedAlgodClient:
+        """
+        Returns an algod client pointing to the stand-in
+        """
+        return TimedAlgodClient("token", self.address)
+
+    def handler(self):
+        """
+        Returns the request handler class answering for this stand-in
+        """
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def answer(self, body: dict) -> None:
+                with stand_in.lock:
+                    stand_in.hits += 1
+                sleep(stand_in.latency)
+                if stand_in.status >= 400:
+                    body = {"message": f"{stand_in.name} failed"}
+                payload = json.dumps(body).encode()
+                self.send_response(stand_in.status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self): # pylint: disable=C0103
+                self.answer({"endpoint": stand_in.name, "last-round": 1})
+
+            def do_POST(self): # pylint: disable=C0103
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self.answer({"txId": stand_in.name})
+
+            def log_message(self, *args) -> None: # pylint: disable=W0221
+                pass
+
+        return Handler
+
+    def stop(self) -> None: # pylint: disable=C0116
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,113 @@
+"""
+File containing the tests of the netting of the internal ledger positions
+"""
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "aktatip_bot"))
+
+from ledger import net_transfers, plan_transfers # pylint: disable=C0413
+
+ASSET_ID = 42
+FEE = 1000
+
+def balances(positions, transfers):
+    """
+    Returns the positions once the transfers are made
+    """
+    balance = dict(positions)
+    for payer_id, receiver_id, amount in transfers:
+        balance[payer_id] += amount
+        balance[receiver_id] -= amount
+    return balance
+
+class TestNetTransfers(unittest.TestCase):
+    """
+    Tests of the matching of the payers with the receivers of a single asset
+    """
+    def test_settles_every_position(self) -> None:
+        positions = [(1, -50), (2, -30), (3, 60), (4, 20)]
+        transfers = net_transfers(positions)
+        self.assertEqual(set(balances(positions, transfers).values()), {0})
+        self.assertLessEqual(len(transfers), len(positions) - 1)
+        self.assertTrue(all(amount > 0 for _, _, amount in transfers))
+
+    def test_largest_positions_first(self) -> None:
+        self.assertEqual(net_transfers([(1, -10), (2, -90), (3, 90), (4, 10)]), [(2, 3, 90), (1, 4, 10)])
+
+    def test_single_payer_pays_every_receiver(self) -> None:
+        transfers = net_transfers([(1, -100), (2, 25), (3, 75)])
+        self.assertEqual(sorted(transfers), [(1, 2, 25), (1, 3, 75)])
+
+    def test_nothing_to_settle(self) -> None:
+        self.assertEqual(net_transfers([]), [])
+        self.assertEqual(net_transfers([(1, 0), (2, 0)]), [])
+
+class TestPlanTransfers(unittest.TestCase):
+    """
+    Tests of the netting of every asset, with the wallets of the payers mocked
+    """
+    def setUp(self) -> None:
+        patcher = mock.patch("ledger.spendable_funds")
+        self.spendable_funds = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def plan(self, positions, funds):
+        """
+        Plans the transfers of the positions with the given spendable funds of the payers
+        """
+        self.spendable_funds.return_value = funds
+        return plan_transfers(positions, FEE)
+
+    def test_funded_payers_are_all_settled(self) -> None:
+        positions = {ASSET_ID: [(1, -50), (2, -30), (3, 80)]}
+        transfers, left_out = self.plan(positions, {1: {ASSET_ID: 50, 0: FEE}, 2: {ASSET_ID: 30, 0: FEE}})
+        self.assertEqual(left_out, set())
+        self.assertEqual(sorted(transfers[ASSET_ID]), [(1, 3, 50), (2, 3, 30)])
+        self.assertEqual(self.spendable_funds.call_args[0][0], {1, 2})
+
+    def test_underfunded_payer_is_left_out(self) -> None:
+        positions = {ASSET_ID: [(1, -50), (2, -30), (3, 80)]}
+        transfers, left_out = self.plan(positions, {1: {ASSET_ID: 49, 0: FEE}, 2: {ASSET_ID: 30, 0: FEE}})
+        self.assertEqual(left_out, {1})
+        self.assertEqual(transfers[ASSET_ID], [(2, 3, 30)])
+
+    def test_payer_without_fee_is_left_out(self) -> None:
+        positions = {ASSET_ID: [(1, -50), (2, -30), (3, 80)]}
+        transfers, left_out = self.plan(positions, {1: {ASSET_ID: 50, 0: FEE - 1}, 2: {ASSET_ID: 30, 0: FEE}})
+        self.assertEqual(left_out, {1})
+        self.assertEqual(transfers[ASSET_ID], [(2, 3, 30)])
+
+    def test_algos_cover_the_transfer_and_its_fee(self) -> None:
+        positions = {0: [(1, -5000), (2, 5000)]}
+        transfers, left_out = self.plan(positions, {1: {0: 5000}})
+        self.assertEqual(left_out, {1})
+        self.assertEqual(transfers[0], [])
+        transfers, left_out = self.plan(positions, {1: {0: 5000 + FEE}})
+        self.assertEqual(left_out, set())
+        self.assertEqual(transfers[0], [(1, 2, 5000)])
+
+    def test_fees_of_every_asset_are_counted(self) -> None:
+        positions = {0: [(1, -5000), (2, 5000)], ASSET_ID: [(1, -50), (2, 50)]}
+        _, left_out = self.plan(positions, {1: {0: 5000 + FEE, ASSET_ID: 50}})
+        self.assertEqual(left_out, {1})
+        transfers, left_out = self.plan(positions, {1: {0: 5000 + 2 * FEE, ASSET_ID: 50}})
+        self.assertEqual(left_out, set())
+        self.assertEqual(transfers, {0: [(1, 2, 5000)], ASSET_ID: [(1, 2, 50)]})
+
+    def test_unreadable_wallet_is_left_out(self) -> None:
+        positions = {ASSET_ID: [(1, -50), (2, -30), (3, 80)]}
+        transfers, left_out = self.plan(positions, {2: {ASSET_ID: 30, 0: FEE}})
+        self.assertEqual(left_out, {1})
+        self.assertEqual(transfers[ASSET_ID], [(2, 3, 30)])
+
+    def test_no_payer_reads_no_wallet(self) -> None:
+        transfers, left_out = self.plan({ASSET_ID: [(1, 0)]}, {})
+        self.assertEqual((transfers, left_out), ({ASSET_ID: []}, set()))
+        self.spendable_funds.assert_not_called()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,167 @@
+"""
+File containing the tests of the AlgodRouter, against local algod stand-ins
+"""
+
+import base64
+import os
+import sys
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "aktatip_bot"))
+
+from algosdk.error import AlgodHTTPError # pylint: disable=C0413
+
+import router # pylint: disable=C0413
+from router import CLOSED, FAILURE_THRESHOLD, HALF_OPEN, OPEN, AlgodRouter # pylint: disable=C0413
+from algod_stand_in import AlgodStandIn # pylint: disable=C0413
+
+TRANSACTION = base64.b64encode(b"signed transaction").decode()
+
+class RouterTestCase(unittest.TestCase):
+    """
+    Class starting a primary and a secondary stand-in for every test
+    """
+    def setUp(self) -> None:
+        self.primary, self.secondary = AlgodStandIn("primary"), AlgodStandIn("secondary")
+        self.router = AlgodRouter([self.primary.client(), self.secondary.client()])
+
+    def tearDown(self) -> None:
+        self.primary.latency = self.secondary.latency = 0
+        self.router.executor.shutdown()
+        self.primary.stop()
+        self.secondary.stop()
+
+    def open_primary(self) -> None:
+        """
+        Fails the primary enough times in a row to open its circuit
+        """
+        self.primary.status = 500
+        for _ in range(FAILURE_THRESHOLD):
+            self.router.write("send_raw_transaction", TRANSACTION)
+        self.assertEqual(self.router.endpoints[0].state, OPEN)
+
+class TestRouting(RouterTestCase):
+    def test_reads_go_to_the_fastest_endpoint(self):
+        self.primary.latency = 0.05
+        self.router.endpoints[0].success(0.05)
+        self.router.endpoints[1].success(0.001)
+        for _ in range(5):
+            self.assertEqual(self.router.status()["endpoint"], "secondary")
+        self.assertEqual(self.primary.hits, 0)
+
+    def test_slow_read_is_hedged(self):
+        self.router.endpoints[0].success(0.001)
+        self.router.endpoints[1].success(0.01)
+        self.primary.latency = 1.0
+        started = monotonic()
+        self.assertEqual(self.router.status()["endpoint"], "secondary")
+        self.assertLess(monotonic() - started, 0.8)
+        self.assertEqual(self.primary.hits, 1)
+
+    def test_client_errors_are_not_retried(self):
+        self.primary.status = 404
+        self.router.endpoints[1].success(1.0)
+        with self.assertRaises(AlgodHTTPError):
+            self.router.status()
+        self.assertEqual(self.secondary.hits, 0)
+        self.assertEqual(self.router.endpoints[0].state, CLOSED)
+
+    def test_writes_go_to_the_primary(self):
+        self.router.endpoints[1].success(0.0001)
+        self.assertEqual(self.router.send_raw_transaction(TRANSACTION), "primary")
+        self.assertEqual(self.secondary.hits, 0)
+
+    def test_hedged_away_call_counts_as_a_failure(self):
+        self.router.endpoints[0].success(0.001)
+        self.router.endpoints[1].success(0.01)
+        self.primary.latency = 1.0
+        self.assertEqual(self.router.status()["endpoint"], "secondary")
+        self.assertEqual(self.router.endpoints[0].failures, 1)
+
+    def test_write_fails_over(self):
+        self.primary.status = 503
+        self.assertEqual(self.router.send_raw_transaction(TRANSACTION), "secondary")
+        self.assertEqual(self.router.endpoints[0].failures, 1)
+
+class TestCircuitBreaker(RouterTestCase):
+    def test_open_circuit_gets_no_traffic(self):
+        self.open_primary()
+        hits = self.primary.hits
+        self.assertEqual(self.router.send_raw_transaction(TRANSACTION), "secondary")
+        self.assertEqual(self.router.status()["endpoint"], "secondary")
+        self.assertEqual(self.primary.hits, hits)
+
+    def test_every_circuit_open_fails_fast(self):
+        self.open_primary()
+        self.secondary.status = 500
+        for _ in range(FAILURE_THRESHOLD):
+            with self.assertRaises(AlgodHTTPError):
+                self.router.status()
+        hits = self.primary.hits + self.secondary.hits
+        with self.assertRaises(TimeoutError):
+            self.router.status()
+        self.assertEqual(self.primary.hits + self.secondary.hits, hits)
+
+    def test_half_open_lets_a_single_trial_through(self):
+        with mock.patch.object(router, "OPEN_DURATION", 0.1):
+            self.open_primary()
+            self.primary.status, self.primary.latency = 200, 0.5
+            sleep(0.2)
+            endpoint = self.router.endpoints[0]
+            self.assertEqual(endpoint.state, HALF_OPEN)
+            self.secondary.latency = 0.05
+            self.router.endpoints[1].latencies.clear()
+            self.router.endpoints[1].success(1.0) # The primary is tried first
+            hits = self.primary.hits
+            with ThreadPoolExecutor(max_workers=5) as executor:
+                answers = list(executor.map(lambda _: self.router.status()["endpoint"], range(5)))
+            self.assertEqual(self.primary.hits - hits, 1)
+            self.assertEqual(answers, ["secondary"] * 5) # The trial was hedged on the secondary
+
+    def test_successful_trial_closes_the_circuit(self):
+        with mock.patch.object(router, "OPEN_DURATION", 0.1):
+            self.open_primary()
+            self.primary.status = 200
+            sleep(0.2)
+            self.assertEqual(self.router.send_raw_transaction(TRANSACTION), "primary")
+            self.assertEqual(self.router.endpoints[0].state, CLOSED)
+            self.assertEqual(self.router.endpoints[0].failures, 0)
+
+    def test_failed_trial_opens_the_circuit_again(self):
+        with mock.patch.object(router, "OPEN_DURATION", 0.1):
+            self.open_primary()
+            sleep(0.2)
+            hits = self.primary.hits
+            self.assertEqual(self.router.send_raw_transaction(TRANSACTION), "secondary")
+            self.assertEqual(self.primary.hits, hits + 1)
+            self.assertEqual(self.router.endpoints[0].state, OPEN)
+
+class TestHungEndpoint(unittest.TestCase):
+    def setUp(self) -> None:
+        self.hung = AlgodStandIn("hung", latency=30)
+        with mock.patch.object(router, "WORKERS", 2):
+            self.router = AlgodRouter([self.hung.client()])
+
+    def tearDown(self) -> None:
+        self.router.executor.shutdown()
+        self.hung.stop()
+
+    def test_hung_endpoint_opens_its_circuit_and_frees_the_threads(self):
+        with mock.patch.object(router, "READ_DEADLINE", 0.5):
+            for _ in range(FAILURE_THRESHOLD):
+                with self.assertRaises(TimeoutError):
+                    self.router.status()
+        endpoint = self.router.endpoints[0]
+        self.assertEqual(endpoint.state, OPEN)
+        self.assertEqual(endpoint.failures, FAILURE_THRESHOLD)
+        # The requests time out with their deadline, so the threads of the pool come back
+        self.assertEqual(self.router.executor.submit(lambda: "free").result(timeout=2), "free")
+        with self.assertRaises(TimeoutError):
+            self.router.status() # Fails fast, the open circuit gets no traffic
+        self.assertEqual(self.hung.hits, FAILURE_THRESHOLD)
+
+if __name__ == "__main__":
+    unittest.main()